@@ -0,0 +1,264 @@
+import os
+import json
+import glob
+import time
+import shutil
+import argparse
+import datetime
+import resource
+import tempfile
+import contextlib
+import subprocess
+import multiprocessing
+import psycopg2
+import create_tables
+
+
+# connection strings of the default database and of the throwaway benchmark database
+DEFAULT_DSN = "host=127.0.0.1 dbname=studentdb user=student password=student"
+BENCH_DB = "sparkifydb_bench"
+BENCH_DSN = "host=127.0.0.1 dbname={} user=student password=student".format(BENCH_DB)
+
+# each copy of the log data is shifted by 31 days, so that copies add new start times
+LOG_SHIFT_MS = 31 * 24 * 3600 * 1000
+
+# each copy of the log data gets its own range of session ids
+SESSION_SHIFT = 100000
+
+TABLES = ['songplays', 'users', 'songs', 'artists', 'time']
+
+
+def generate_data(source, target, scale):
+    """
+        Description: Generates a synthetic data directory `scale` times the size of
+            `source`, in the same JSON layout. Copy 0 is the source data itself; the
+            other copies get their own song and artist ids and titles, and their log
+            records are shifted in time and session ids.
+
+        Arguments:
+            source: directory holding song_data and log_data
+            target: directory to write song_data and log_data into
+            scale: number of copies of the source data
+
+        Returns:
+            Integer: number of files generated
+    """
+    num_files = 0
+    for copy in range(scale):
+        for filepath in glob.glob(os.path.join(source, 'song_data', '**', '*.json'), recursive=True):
+            with open(filepath) as f:
+                song = json.load(f)
+            if copy:
+                song['song_id'] = '{}K{}'.format(song['song_id'], copy)
+                song['artist_id'] = '{}K{}'.format(song['artist_id'], copy)
+                song['title'] = '{} #{}'.format(song['title'], copy)
+
+            with open(_copy_path(source, target, filepath, copy), 'w') as f:
+                json.dump(song, f)
+            num_files += 1
+
+        for filepath in glob.glob(os.path.join(source, 'log_data', '**', '*.json'), recursive=True):
+            with open(filepath) as f, open(_copy_path(source, target, filepath, copy), 'w') as out:
+                for line in f:
+                    event = json.loads(line)
+                    if copy:
+                        event['ts'] += copy * LOG_SHIFT_MS
+                        event['sessionId'] += copy * SESSION_SHIFT
+                    out.write(json.dumps(event) + '\n')
+            num_files += 1
+
+    return num_files
+
+
+def _copy_path(source, target, filepath, copy):
+    stem, ext = os.path.splitext(os.path.relpath(filepath, source))
+    path = os.path.join(target, '{}_{}{}'.format(stem, copy, ext))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return path
+
+
+def reset_database():
+    """
+        Description: Drops and creates the throwaway benchmark database and its tables.
+
+        Arguments:
+            None
+
+        Returns:
+            None
+    """
+    conn = psycopg2.connect(DEFAULT_DSN)
+    conn.set_session(autocommit=True)
+    cur = conn.cursor()
+    cur.execute("DROP DATABASE IF EXISTS {}".format(BENCH_DB))
+    cur.execute("CREATE DATABASE {} WITH ENCODING 'utf8' TEMPLATE template0".format(BENCH_DB))
+    conn.close()
+
+    conn = psycopg2.connect(BENCH_DSN)
+    cur = conn.cursor()
+    create_tables.create_tables(cur, conn)
+    conn.close()
+
+
+def drop_database():
+    """
+        Description: Drops the throwaway benchmark database.
+
+        Arguments:
+            None
+
+        Returns:
+            None
+    """
+    conn = psycopg2.connect(DEFAULT_DSN)
+    conn.set_session(autocommit=True)
+    conn.cursor().execute("DROP DATABASE IF EXISTS {}".format(BENCH_DB))
+    conn.close()
+
+
+def count_rows():
+    """
+        Description: Counts the rows of each table of the benchmark database.
+
+        Arguments:
+            None
+
+        Returns:
+            Dict of table name to number of rows
+    """
+    conn = psycopg2.connect(BENCH_DSN)
+    cur = conn.cursor()
+    rows = {}
+    for table in TABLES:
+        cur.execute("SELECT COUNT(*) FROM {}".format(table))
+        rows[table] = cur.fetchone()[0]
+    conn.close()
+    return rows
+
+
+def run_etl(data_dir, etl_args, results):
+    """
+        Description: Runs `etl.main` end to end in a fresh process and reports its
+            wall time, per-stage and per-table timings and peak RSS.
+
+        Arguments:
+            data_dir: directory holding song_data and log_data
+            etl_args: list of extra etl.py options
+            results: queue receiving the measurements
+
+        Returns:
+            None
+    """
+    import etl
+    from instrumentation import STATS
+
+    start = time.perf_counter()
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        etl.main(['--dsn', BENCH_DSN, '--data-dir', data_dir] + etl_args)
+    seconds = time.perf_counter() - start
+
+    # ru_maxrss is in kilobytes on Linux; worker processes are reported as children
+    results.put({'seconds': seconds,
+                 'stages': STATS.stages.as_dict(),
+                 'tables': STATS.tables.as_dict(),
+                 'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+                 'peak_worker_rss_mb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024})
+
+
+def benchmark(scale, source, work_dir, etl_args):
+    """
+        Description: Generates the data of a scale, loads it into a fresh benchmark
+            database and measures the run.
+
+        Arguments:
+            scale: number of copies of the source data
+            source: directory holding the sample song_data and log_data
+            work_dir: directory the synthetic data is generated into
+            etl_args: list of extra etl.py options
+
+        Returns:
+            Dict of measurements
+    """
+    data_dir = os.path.join(work_dir, 'scale_{}'.format(scale))
+    if not os.path.isdir(data_dir):
+        generate_data(source, data_dir, scale)
+    num_files = len(glob.glob(os.path.join(data_dir, '**', '*.json'), recursive=True))
+
+    reset_database()
+
+    # a spawned process starts with a fresh peak RSS and fresh stage timings
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    process = context.Process(target=run_etl, args=(data_dir, etl_args, results))
+    process.start()
+    process.join()
+    if process.exitcode != 0:
+        raise RuntimeError('etl.py failed at scale {}'.format(scale))
+    measurements = results.get()
+
+    rows = count_rows()
+    seconds = measurements['seconds']
+    measurements.update({'scale': scale,
+                         'etl_args': etl_args,
+                         'files': num_files,
+                         'rows': rows,
+                         'files_per_sec': num_files / seconds,
+                         'rows_per_sec': sum(rows.values()) / seconds})
+    return measurements
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    """
+    Description:
+        - Generates synthetic song_data and log_data trees at each scale.
+        - Runs etl.py end to end against a throwaway local database for each of them.
+        - Reports files/sec, rows/sec, peak RSS and per-stage timings, and appends
+          them as JSON lines to the output file so runs can be compared over time.
+
+    Usage:
+        python benchmark.py --scales 1 10 100 -- --bulk --song-index --workers 4
+    """
+    parser = argparse.ArgumentParser(description='Benchmark etl.py against a throwaway local database.')
+    parser.add_argument('--scales', type=int, nargs='+', default=[1, 10],
+                        help='sizes of the generated data, in copies of the sample data (default: 1 10)')
+    parser.add_argument('--source', default='data',
+                        help='directory holding the sample song_data and log_data (default: %(default)s)')
+    parser.add_argument('--work-dir', default=None,
+                        help='directory keeping the generated data between runs (default: a temporary directory)')
+    parser.add_argument('--output', default=os.path.join('results', 'benchmark_results.jsonl'),
+                        help='file the results are appended to (default: %(default)s)')
+    parser.add_argument('etl_args', nargs=argparse.REMAINDER,
+                        help='options passed to etl.py, after --')
+    args = parser.parse_args()
+
+    etl_args = [arg for arg in args.etl_args if arg != '--']
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='sparkify_bench_')
+    os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+    run = {'started_at': datetime.datetime.now(datetime.timezone.utc).isoformat(), 'commit': git_commit()}
+
+    try:
+        for scale in args.scales:
+            result = dict(run, **benchmark(scale, args.source, work_dir, etl_args))
+            print('scale {scale}: {files} files in {seconds:.2f}s, {files_per_sec:.1f} files/s, '
+                  '{rows_per_sec:.0f} rows/s, peak RSS {peak_rss_mb:.0f} MB'.format(**result))
+            for name, stage in sorted(result['stages'].items()):
+                print('    {:<10} {:8.2f}s {:8d} calls {:10d} rows'.format(
+                    name, stage['seconds'], stage['calls'], stage['rows']))
+
+            with open(args.output, 'a') as f:
+                f.write(json.dumps(result) + '\n')
+    finally:
+        drop_database()
+        if args.work_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+class CommitPolicy:
+    """
+        Description: Transaction granularity of the ETL pipeline: commit after every
+            `size` files, or after at least `size` rows have been loaded.
+
+            Processed files are recorded in the etl_manifest table in the same
+            transaction as their data, so each commit is also a checkpoint a crashed
+            run can resume from with `etl.py --resume`.
+    """
+
+    UNITS = ('files', 'rows')
+
+    def __init__(self, unit='files', size=1):
+        if unit not in self.UNITS:
+            raise ValueError('unit must be one of {}, not {!r}'.format(self.UNITS, unit))
+        if size < 1:
+            raise ValueError('size must be at least 1, not {}'.format(size))
+
+        self.unit = unit
+        self.size = size
+        self.files = 0
+        self.rows = 0
+
+    def add(self, files=0, rows=0):
+        """
+            Description: Counts files and rows loaded since the last commit.
+
+            Arguments:
+                files: number of files loaded
+                rows: number of rows loaded
+
+            Returns:
+                Boolean: True when a commit is due, the counters are then reset
+        """
+        self.files += files
+        self.rows += rows
+
+        if getattr(self, self.unit) < self.size:
+            return False
+
+        self.reset()
+        return True
+
+    def reset(self):
+        """
+            Description: Clears the counters, once the stage using the policy has
+                committed, so that the next stage starts from a fresh count.
+
+            Arguments:
+                None
+
+            Returns:
+                None
+        """
+        self.files = 0
+        self.rows = 0
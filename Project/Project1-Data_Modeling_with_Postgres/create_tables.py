@@ -1,15 +1,18 @@
+import argparse
 import psycopg2
 from sql_queries import create_table_queries, drop_table_queries
+from instrumentation import InstrumentedCursor, timed, summary
 
 
-def create_database():
+@timed
+def create_database(incremental=False):
     """
         Description: 
             - Creates and connects to the sparkifydb
             - Returns the connection and cursor to sparkifydb
     
         Arguments:
-            None
+            incremental: keep the sparkifydb if it already exists
     
         Returns:
             None
@@ -17,26 +20,31 @@ def create_database():
 
     # connect to default database
     conn = psycopg2.connect(
-        "host=127.0.0.1 dbname=studentdb user=student password=student")
+        "host=127.0.0.1 dbname=studentdb user=student password=student", cursor_factory=InstrumentedCursor)
     conn.set_session(autocommit=True)
     cur = conn.cursor()
 
+    cur.execute("SELECT 1 FROM pg_database WHERE datname = 'sparkifydb'")
+    exists = cur.fetchone() is not None
+
     # create sparkify database with UTF8 encoding
-    cur.execute("DROP DATABASE IF EXISTS sparkifydb")
-    cur.execute(
-        "CREATE DATABASE sparkifydb WITH ENCODING 'utf8' TEMPLATE template0")
+    if not (incremental and exists):
+        cur.execute("DROP DATABASE IF EXISTS sparkifydb")
+        cur.execute(
+            "CREATE DATABASE sparkifydb WITH ENCODING 'utf8' TEMPLATE template0")
 
     # close connection to default database
     conn.close()
 
     # connect to sparkify database
     conn = psycopg2.connect(
-        "host=127.0.0.1 dbname=sparkifydb user=student password=student")
+        "host=127.0.0.1 dbname=sparkifydb user=student password=student", cursor_factory=InstrumentedCursor)
     cur = conn.cursor()
 
     return cur, conn
 
 
+@timed
 def drop_tables(cur, conn):
     """
         Description:
@@ -54,6 +62,7 @@ def drop_tables(cur, conn):
         conn.commit()
 
 
+@timed
 def create_tables(cur, conn):
     """
         Description:
@@ -81,19 +90,33 @@ def main():
         - Creates all tables needed.
         - Finally, closes the connection.
 
+        With --incremental, the sparkify database and its tables are kept and 
+        only the missing tables are created.
+
     Arguments:
         None
     
     Returns:
         None
     """
-    cur, conn = create_database()
+    parser = argparse.ArgumentParser(description='Create the sparkifydb and its tables.')
+    parser.add_argument('--incremental', action='store_true',
+                        help='keep the existing database and tables, only create missing ones')
+    parser.add_argument('--summary', action='store_true',
+                        help='print the time spent per function and per table')
+    args = parser.parse_args()
 
-    drop_tables(cur, conn)
+    cur, conn = create_database(args.incremental)
+
+    if not args.incremental:
+        drop_tables(cur, conn)
     create_tables(cur, conn)
 
     conn.close()
 
+    if args.summary:
+        print(summary())
+
 
 if __name__ == "__main__":
     main()
@@ -1,90 +1,346 @@
 import os
+import io
 import glob
+import argparse
+import functools
+import itertools
+import collections
+import multiprocessing
 import psycopg2
+from psycopg2.extras import execute_values
 import pandas as pd
 from sql_queries import *
+from song_index import SongIndex
+from manifest import Manifest, source_key
+from commit_policy import CommitPolicy
+from time_dimension import TimeDimension, build_time_frame
+from instrumentation import (STATS, InstrumentedCursor, stage, timed, timed_iter, run_with_stats, profiled,
+                             log_event, enable_log_events, summary)
 import json
 
-def process_song_file(cur, filepath):
+
+# columns of a record in a log file
+LOG_COLUMNS = ["artist", "auth", "firstName", "gender",
+               "itemInSession", "lastName", "length", "level",
+               "location", "method", "page", "registration",
+               "sessionId", "song", "status", "ts", "userAgent",
+               "userId"]
+
+# connection string of the sparkifydb
+DSN = "host=127.0.0.1 dbname=sparkifydb user=student password=student"
+
+# number of rows sent per multi-row INSERT statement
+SONG_PAGE_SIZE = 1000
+
+
+def read_song_file(filepath):
+    """
+        Description: Opens a song file in JSON format.
+
+        Arguments:
+            filepath: song data file path
+
+        Returns:
+            Dict of the song record
+    """
+    with stage('parse', rows=1), open(filepath, "r") as f:
+        return json.load(f)
+
+
+@timed
+def load_song(cur, song, index=None):
+    """
+        Description: This function is responsible for 
+            - extracting values of the selected columns of a song record,
+            - inserting those values into song and artist tables in the sparkifydb,
+            - adding the song to the song index, if any.
+
+        Arguments:
+            cur: the cursor object
+            song: dict of a song record
+            index: SongIndex refreshed with the inserted song, or None
+        
+        Returns:
+            Integer: number of song records loaded
+    """
+    with stage('transform', rows=1):
+        df = pd.Series(song).to_frame().transpose()
+        song_data = df.loc[[0], ('song_id', 'title', 'artist_id', 'year', 'duration')].values.tolist()[0]
+        artist_data = df.loc[[0], ('artist_id', 'artist_name', 'artist_location', 'artist_latitude', 'artist_longitude')].values.tolist()[0]
+
+    with stage('load', rows=1):
+        # insert song record
+        cur.execute(song_table_insert, song_data)
+
+        # insert artist record
+        cur.execute(artist_table_insert, artist_data)
+
+    if index is not None:
+        index.add_song(song)
+
+    return 1
+
+
+def process_song_file(cur, filepath, index=None):
     """
         Description: This function is responsible for 
             - opening song files in JSON format,
-            - extracting values of the selected columns,
-            - inserting those values into song and artist tables in the sparkifydb.
+            - inserting its song and artist records into the sparkifydb.
 
         Arguments:
             cur: the cursor object
             filepath: song data file path
+            index: SongIndex refreshed with the inserted song, or None
         
+        Returns:
+            Integer: number of song records loaded
+    """
+    return load_song(cur, read_song_file(filepath), index)
+
+
+@timed
+def load_song_batch(cur, songs, index=None):
+    """
+        Description: This function is responsible for 
+            - deduplicating the songs and artists of a batch of song records,
+              keeping the first record of each song_id and artist_id,
+            - inserting them into song and artist tables with one multi-row INSERT each,
+            - adding the songs to the song index, if any.
+
+        Arguments:
+            cur: the cursor object
+            songs: list of dicts of song records
+            index: SongIndex refreshed with the inserted songs, or None
+
         Returns:
             None
     """
-    # open song file
-    df = json.loads(open(filepath, "r").read())
-    df = pd.Series(df).to_frame().transpose()
+    with stage('transform', rows=len(songs)):
+        song_data = {}
+        artist_data = {}
+        for song in songs:
+            song_data.setdefault(song['song_id'], (song['song_id'], song['title'], song['artist_id'],
+                                                   song['year'], song['duration']))
+            artist_data.setdefault(song['artist_id'], (song['artist_id'], song['artist_name'], song['artist_location'],
+                                                       song['artist_latitude'], song['artist_longitude']))
 
-    # insert song record
-    song_data = df.loc[[0], ('song_id', 'title', 'artist_id', 'year', 'duration')].values.tolist()[0]
-    cur.execute(song_table_insert, song_data)
+    with stage('load', rows=len(songs)):
+        execute_values(cur, song_table_batch_insert, list(song_data.values()), page_size=SONG_PAGE_SIZE)
+        execute_values(cur, artist_table_batch_insert, list(artist_data.values()), page_size=SONG_PAGE_SIZE)
 
-    # insert artist record
-    artist_data = df.loc[[0], ('artist_id', 'artist_name', 'artist_location', 'artist_latitude', 'artist_longitude')].values.tolist()[0]
-    cur.execute(artist_table_insert, artist_data)
+    if index is not None:
+        for song in songs:
+            index.add_song(song)
 
 
-def process_log_file(cur, filepath):
+@timed
+def process_song_data(cur, conn, filepath, batch_size, index=None, manifest=None, workers=1, policy=None,
+                      profile_dir=None):
     """
         Description: This function is responsible for 
-            - creating a data frame,
-            - opening a log file in JSON format, 
-            - inserting values in each log in a log file into the dataframe
-            - filtering and transforming the values 
-            - inserting transformed values into time, user, and songplays tables in the sparkifydb.
+            - listing the song files in a directory
+            - skipping the files recorded as unchanged in the manifest, if any
+            - reading the song files `batch_size` at a time, in a pool of worker
+              processes when `workers` is more than 1
+            - loading each batch with multi-row INSERTs and committing when the
+              commit policy is due, at the end of a batch.
 
         Arguments:
-            cur: the cursor object
+            cur: cursor object
+            conn: connection to the database
             filepath: song data file path
-        
+            batch_size: number of song files loaded per batch and transaction
+            index: SongIndex refreshed with the inserted songs, or None
+            manifest: Manifest of processed files, or None to process every file
+            workers: number of worker processes reading the files
+            policy: CommitPolicy of the run, or None to commit after every batch
+            profile_dir: directory a cProfile of each file and batch is written to, or None
+
         Returns:
             None
     """
-    # create data frame
-    df = pd.DataFrame(columns=["artist", "auth","firstName","gender",
-                               "itemInSession","lastName","length","level",
-                               "location","method","page","registration",
-                               "sessionId","song","status","ts","userAgent",
-                               "userId"])
+    all_files = get_files(filepath)
+
+    num_files = len(all_files)
+    print('{} files found in {}'.format(num_files, filepath))
+
+    # skip the files that are unchanged since they were processed
+    if manifest is not None:
+        all_files = manifest.changed_files(cur, all_files)
+        conn.commit()
+        num_files = len(all_files)
+        print('{} new or modified files'.format(num_files))
+
+    if policy is None:
+        policy = CommitPolicy()
+
+    pool = multiprocessing.Pool(workers) if workers > 1 else None
+    try:
+        for start in range(0, num_files, batch_size):
+            batch = all_files[start:start + batch_size]
+            if pool is not None:
+                songs = []
+                parse = functools.partial(run_with_stats, read_song_file, profile_dir=profile_dir)
+                for song, worker_stats in pool.map(parse, batch):
+                    songs.append(song)
+                    STATS.merge(worker_stats)
+            else:
+                songs = []
+                for datafile in batch:
+                    with profiled(profile_dir, datafile, 'parse'):
+                        songs.append(read_song_file(datafile))
+
+            with profiled(profile_dir, batch[0], 'load_batch'):
+                load_song_batch(cur, songs, index)
+            if manifest is not None:
+                for datafile in batch:
+                    manifest.record(cur, datafile)
+            if policy.add(files=len(batch), rows=len(songs)):
+                conn.commit()
+            log_event('batch_processed', path=filepath, files=len(batch), rows=len(songs))
+            print('{}/{} files processed.'.format(start + len(batch), num_files))
+
+        conn.commit()
+        policy.reset()
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+
+def read_log_file(filepath, chunksize=None):
+    """
+        Description: This function is responsible for 
+            - parsing a log file in JSON lines format in one bulk pass,
+              or in bounded chunks of `chunksize` lines for very large files,
+            - filtering the records by NextSong action.
+
+        Arguments:
+            filepath: log data file path
+            chunksize: number of lines parsed at a time, None parses the whole file at once
+
+        Returns:
+            Generator of dataframes holding the NextSong records of the file
+    """
+    # keep values as they appear in the JSON (e.g. userId stays a string, and a length
+    # parses to the same float as the duration of its song, which song_select matches on)
+    options = dict(lines=True, dtype=False, convert_dates=False, precise_float=True)
+
+    if chunksize:
+        with pd.read_json(filepath, chunksize=chunksize, **options) as reader:
+            for chunk in timed_iter(reader, 'parse'):
+                yield _filter_next_song(chunk)
+    else:
+        with stage('parse') as timer:
+            df = pd.read_json(filepath, **options)
+            timer.rows = len(df)
+        yield _filter_next_song(df)
+
+
+def _filter_next_song(df):
+    """
+        Description: Aligns a parsed chunk of log records on LOG_COLUMNS and
+            keeps the records of NextSong action.
+
+        Arguments:
+            df: dataframe of parsed log records
+
+        Returns:
+            Dataframe
+    """
+    df = df.reindex(columns=LOG_COLUMNS)
+    return df[df.page == 'NextSong'].copy()
 
-    # open log file
-    for line in open(filepath, "r"):
-        dict = json.loads(line)
-        df = df.append(dict, ignore_index=True)
 
-    # filter by NextSong action
-    df = df[df.page == 'NextSong']
+def transform_log_frame(df, source=None):
+    """
+        Description: This function is responsible for 
+            - converting the timestamp column of NextSong records to datetime,
+            - extracting the time, user, and songplay records from them.
+
+        Arguments:
+            df: dataframe of NextSong records
+            source: key of the log file the records are read from, see `manifest.source_key`
 
+        Returns:
+            Tuple of dataframes: (time_df, user_df, songplay_df)
+    """
+    with stage('transform', rows=len(df)):
+        return _transform_log_frame(df, source)
+
+
+def _transform_log_frame(df, source=None):
     # convert timestamp column to datetime
     t = pd.to_datetime(df.ts, unit='ms')
-    df['ts'] = t
 
-    # insert time data records
-    hour, day, week, month, year, weekday = t.dt.hour, t.dt.day, t.dt.isocalendar().week, t.dt.month, t.dt.year, t.dt.dayofweek
-    time_data = (t, hour, day, week, month, year, weekday)
-    column_labels = ('start_time', 'hour', 'day', 'week', 'month', 'year', 'weekday')
-    time_df = pd.DataFrame({k:v for k,v in zip(column_labels, time_data)})
+    # time data records, one per distinct timestamp
+    time_df = build_time_frame(t)
+
+    # user records
+    user_df = df.loc[:, ('userId', 'firstName', 'lastName', 'gender', 'level')].drop_duplicates()
+
+    # songplay records, song and artist are resolved when the records are loaded
+    songplay_df = pd.DataFrame({'start_time': t,
+                                'user_id': df.userId,
+                                'level': df.level,
+                                'song': df.song,
+                                'artist': df.artist,
+                                'length': df.length,
+                                'session_id': df.sessionId,
+                                'location': df.location,
+                                'user_agent': df.userAgent,
+                                'source_file': source})
 
+    return time_df, user_df, songplay_df
+
+
+@timed
+def load_log_frames(cur, time_df, user_df, songplay_df):
+    """
+        Description: This function is responsible for inserting time, user, and 
+            songplay records into the sparkifydb one row at a time.
+
+        Arguments:
+            cur: the cursor object
+            time_df: dataframe of time records
+            user_df: dataframe of user records
+            songplay_df: dataframe of songplay records with resolved song_id 
+                         and artist_id columns
+
+        Returns:
+            None
+    """
+    # insert time data records
     for i, row in time_df.iterrows():
         cur.execute(time_table_insert, list(row))
 
-    # load user table
-    user_df = df.loc[:, ('userId', 'firstName', 'lastName', 'gender', 'level')].drop_duplicates()
-
     # insert user records
     for i, row in user_df.iterrows():
-        cur.execute(user_table_insert, row)
+        cur.execute(user_table_insert, list(row))
 
     # insert songplay records
-    for index, row in df.iterrows():
+    for index, row in songplay_df.iterrows():
+        songplay_data = (row.start_time, row.user_id, row.level, row.song_id, row.artist_id, row.session_id, row.location, row.user_agent,
+                         row.source_file)
+        cur.execute(songplay_table_insert, songplay_data)
+
+
+@timed
+def select_song_ids(cur, songplay_df):
+    """
+        Description: Resolves song and artist ids of songplay records with one
+            `song_select` query per record.
+
+        Arguments:
+            cur: the cursor object
+            songplay_df: dataframe of songplay records with song, artist and length columns
+
+        Returns:
+            Dataframe with song_id and artist_id columns added
+    """
+    song_ids = []
+    artist_ids = []
+    for index, row in songplay_df.iterrows():
 
         # get songid and artistid from song and artist tables
         cur.execute(song_select, (row.song, row.artist, row.length))
@@ -95,15 +351,237 @@ def process_log_file(cur, filepath):
         else:
             songid, artistid = None, None
 
-        # insert songplay record
-        songplay_data = (row.ts, row.userId, row.level, songid, artistid, row.sessionId, row.location, row.userAgent)
-        cur.execute(songplay_table_insert, songplay_data)
+        song_ids.append(songid)
+        artist_ids.append(artistid)
 
+    resolved = songplay_df.copy()
+    resolved['song_id'] = pd.Series(song_ids, index=resolved.index, dtype=object)
+    resolved['artist_id'] = pd.Series(artist_ids, index=resolved.index, dtype=object)
+    return resolved
 
-def process_data(cur, conn, filepath, func):
+
+@timed
+def copy_frame(cur, df, table):
+    """
+        Description: This function is responsible for streaming a dataframe
+            into a table with PostgreSQL `COPY FROM STDIN` in CSV format.
+
+        Arguments:
+            cur: the cursor object
+            df: dataframe whose columns match the columns of the table
+            table: name of the table to copy into
+
+        Returns:
+            None
+    """
+    buffer = io.StringIO()
+    df.to_csv(buffer, index=False, header=False)
+    buffer.seek(0)
+    cur.copy_expert(staging_copy.format(table, ', '.join(df.columns)), buffer)
+
+
+@timed
+def delete_songplays(cur, source):
+    """
+        Description: Deletes every songplay previously loaded from a log file, so that
+            a reprocessed log file replaces its songplays, including those of events
+            it no longer holds, rather than duplicating them.
+
+        Arguments:
+            cur: the cursor object
+            source: key of the log file, see `manifest.source_key`
+
+        Returns:
+            None
+    """
+    cur.execute(songplay_table_delete, (source,))
+
+
+@timed
+def bulk_load_log_frames(cur, time_df, user_df, songplay_df):
+    """
+        Description: This function is responsible for 
+            - copying time, user, and songplay records into temporary staging tables,
+            - merging the staging tables into time, users, and songplays tables 
+              with set-based `INSERT ... ON CONFLICT` statements.
+
+        Arguments:
+            cur: the cursor object
+            time_df: dataframe of time records
+            user_df: dataframe of user records
+            songplay_df: dataframe of songplay records, with song_id and artist_id
+                         columns when they were resolved by a SongIndex
+
+        Returns:
+            None
+    """
+    for query in create_staging_queries + truncate_staging_queries:
+        cur.execute(query)
+
+    # a user may appear with several levels in a batch, the last one wins as in row mode
+    user_df = user_df.drop_duplicates('userId', keep='last')
+    user_df.columns = ['user_id', 'first_name', 'last_name', 'gender', 'level']
+
+    copy_frame(cur, time_df, 'time_staging')
+    copy_frame(cur, user_df, 'user_staging')
+    copy_frame(cur, songplay_df, 'songplay_staging')
+
+    if 'song_id' in songplay_df.columns:
+        merge_queries = merge_resolved_staging_queries
+    else:
+        merge_queries = merge_staging_queries
+
+    for query in merge_queries:
+        cur.execute(query)
+
+
+def transform_log_file(filepath, chunksize=None, source=None):
+    """
+        Description: This function is responsible for 
+            - reading a log file in JSON format into dataframes filtered by NextSong action,
+            - transforming each of them into time, user, and songplay records.
+
+        Arguments:
+            filepath: log data file path
+            chunksize: number of lines parsed at a time, None parses the whole file at once
+            source: key of the log file recorded on its songplays, see `manifest.source_key`
+
+        Returns:
+            Generator of (time_df, user_df, songplay_df) tuples
+    """
+    for df in read_log_file(filepath, chunksize):
+        if df.empty:
+            continue
+
+        yield transform_log_frame(df, source)
+
+
+@timed
+def parse_log_file(filepath, root=None):
+    """
+        Description: Transforms a whole log file at once, so that a worker process
+            can hand its batch over to the writer. The file is not parsed in chunks,
+            they would all cross the process boundary together anyway.
+
+        Arguments:
+            filepath: log data file path
+            root: data directory the key of the file is relative to, see `manifest.source_key`
+
+        Returns:
+            Tuple: (key of the file, list of (time_df, user_df, songplay_df) tuples)
+    """
+    source = source_key(filepath, root)
+    return source, list(transform_log_file(filepath, source=source))
+
+
+@timed
+def load_log_batches(cur, batches, bulk=False, index=None, time_dim=None):
+    """
+        Description: This function is responsible for inserting transformed
+            log batches into time, user, and songplays tables in the sparkifydb.
+
+        Arguments:
+            cur: the cursor object
+            batches: iterable of (time_df, user_df, songplay_df) tuples
+            bulk: load the records through COPY and staging tables instead of row by row
+            index: SongIndex resolving song and artist ids in memory, or None to query them
+            time_dim: TimeDimension filtering out the start times already inserted, or None
+
+        Returns:
+            Integer: number of songplay records loaded
+    """
+    load = bulk_load_log_frames if bulk else load_log_frames
+
+    rows = 0
+    for time_df, user_df, songplay_df in batches:
+        if time_dim is not None:
+            with stage('transform', rows=len(time_df)):
+                time_df = time_dim.unseen(time_df)
+
+        # without an index, bulk mode resolves the ids while merging the songplays
+        with stage('lookup', rows=len(songplay_df)):
+            if index is not None:
+                songplay_df = index.resolve(songplay_df)
+            elif not bulk:
+                songplay_df = select_song_ids(cur, songplay_df)
+
+        with stage('load', rows=len(songplay_df)):
+            load(cur, time_df, user_df, songplay_df)
+        rows += len(songplay_df)
+    return rows
+
+
+def load_log_file(cur, parsed, bulk=False, index=None, time_dim=None, replace=False):
+    """
+        Description: Loads a log file transformed by `parse_log_file` in a worker process.
+
+        Arguments:
+            cur: the cursor object
+            parsed: tuple returned by `parse_log_file`
+            bulk: load the records through COPY and staging tables instead of row by row
+            index: SongIndex resolving song and artist ids in memory, or None to query them
+            time_dim: TimeDimension filtering out the start times already inserted, or None
+            replace: delete the songplays previously loaded from the file first
+
+        Returns:
+            Integer: number of songplay records loaded
+    """
+    source, batches = parsed
+    if replace:
+        delete_songplays(cur, source)
+    return load_log_batches(cur, batches, bulk, index, time_dim)
+
+
+def process_log_file(cur, filepath, chunksize=None, bulk=False, index=None, time_dim=None, root=None, replace=False):
+    """
+        Description: This function is responsible for 
+            - reading a log file in JSON format into dataframes filtered by NextSong action,
+            - transforming the values 
+            - inserting transformed values into time, user, and songplays tables in the sparkifydb.
+
+        Arguments:
+            cur: the cursor object
+            filepath: log data file path
+            chunksize: number of lines parsed at a time, None parses the whole file at once
+            bulk: load the records through COPY and staging tables instead of row by row
+            index: SongIndex resolving song and artist ids in memory, or None to query them
+            time_dim: TimeDimension filtering out the start times already inserted, or None
+            root: data directory the key of the file is relative to, see `manifest.source_key`
+            replace: delete the songplays previously loaded from the file first
+        
+        Returns:
+            Integer: number of songplay records loaded
+    """
+    source = source_key(filepath, root)
+    if replace:
+        delete_songplays(cur, source)
+    return load_log_batches(cur, transform_log_file(filepath, chunksize, source), bulk, index, time_dim)
+
+
+def get_files(filepath):
+    """
+        Description: Lists the JSON files in a directory and its subdirectories.
+
+        Arguments:
+            filepath: log data or song data file path
+
+        Returns:
+            List of absolute file paths
+    """
+    all_files = []
+    for root, dirs, files in os.walk(filepath):
+        files = glob.glob(os.path.join(root,'*.json'))
+        for f in files :
+            all_files.append(os.path.abspath(f))
+    return all_files
+
+
+@timed
+def process_data(cur, conn, filepath, func, manifest=None, policy=None, profile_dir=None):
     """
         Description: This function is responsible for 
             - listing the files in a directory
+            - skipping the files recorded as unchanged in the manifest, if any
             - executing the ingest process for each file according to the function that 
               performs the transformation to save it to the database.
 
@@ -111,35 +589,242 @@ def process_data(cur, conn, filepath, func):
             cur: cursor object
             conn: connection to the database
             filepath: log data or song data file path
-            func: function that transforms the data and inserts it into the database
+            func: function that transforms the data, inserts it into the database
+                  and returns the number of rows loaded
+            manifest: Manifest of processed files, or None to process every file
+            policy: CommitPolicy of the run, or None to commit after every file
+            profile_dir: directory a cProfile of each file is written to, or None
 
         Returns:
             None
     """
     # get all files matching extension from directory
-    all_files = []
-    for root, dirs, files in os.walk(filepath):
-        files = glob.glob(os.path.join(root,'*.json'))
-        for f in files :
-            all_files.append(os.path.abspath(f))
+    all_files = get_files(filepath)
 
     # get total number of files found
     num_files = len(all_files)
     print('{} files found in {}'.format(num_files, filepath))
 
+    # skip the files that are unchanged since they were processed
+    if manifest is not None:
+        all_files = manifest.changed_files(cur, all_files)
+        conn.commit()
+        num_files = len(all_files)
+        print('{} new or modified files'.format(num_files))
+
+    if policy is None:
+        policy = CommitPolicy()
+
     # iterate over files and process
     for i, datafile in enumerate(all_files, 1):
-        func(cur, datafile)
-        conn.commit()
+        with profiled(profile_dir, datafile, 'process'), STATS.functions.time('file') as timer:
+            rows = func(cur, datafile)
+            timer.rows = rows or 0
+        if manifest is not None:
+            manifest.record(cur, datafile)
+        if policy.add(files=1, rows=rows or 0):
+            conn.commit()
+        log_event('file_processed', path=datafile, rows=rows, seconds=round(timer.seconds, 6))
         print('{}/{} files processed.'.format(i, num_files))
 
+    conn.commit()
+    policy.reset()
+
+
+@timed
+def process_data_parallel(cur, conn, filepath, parse, load, workers, manifest=None, policy=None, profile_dir=None):
+    """
+        Description: This function is responsible for 
+            - listing the files in a directory
+            - skipping the files recorded as unchanged in the manifest, if any
+            - parsing and transforming the files in a pool of worker processes
+            - loading the results in file order through the single connection
+              of this process, so users and time upserts never race each other.
+
+        Arguments:
+            cur: cursor object
+            conn: connection to the database
+            filepath: log data or song data file path
+            parse: picklable function of a file path run in the worker processes
+            load: function of (cur, parsed) that inserts the parsed data into the database
+                  and returns the number of rows loaded
+            workers: number of worker processes
+            manifest: Manifest of processed files, or None to process every file
+            policy: CommitPolicy of the run, or None to commit after every file
+            profile_dir: directory a cProfile of the parse and load of each file is written to, or None
+
+        Returns:
+            None
+    """
+    all_files = get_files(filepath)
+
+    num_files = len(all_files)
+    print('{} files found in {}'.format(num_files, filepath))
+
+    # skip the files that are unchanged since they were processed
+    if manifest is not None:
+        all_files = manifest.changed_files(cur, all_files)
+        conn.commit()
+        num_files = len(all_files)
+        print('{} new or modified files'.format(num_files))
+
+    # keep at most two files per worker in flight, so memory does not grow
+    # with the number of files when the writer is slower than the workers
+    pending = collections.deque()
+    files = iter(all_files)
+
+    if policy is None:
+        policy = CommitPolicy()
+
+    with multiprocessing.Pool(workers) as pool:
+        for datafile in itertools.islice(files, 2 * workers):
+            pending.append(pool.apply_async(run_with_stats, (parse, datafile, profile_dir)))
+
+        for i, datafile in enumerate(all_files, 1):
+            parsed, worker_stats = pending.popleft().get()
+            STATS.merge(worker_stats)
+
+            following = next(files, None)
+            if following is not None:
+                pending.append(pool.apply_async(run_with_stats, (parse, following, profile_dir)))
+
+            with profiled(profile_dir, datafile, 'load'), STATS.functions.time('file') as timer:
+                rows = load(cur, parsed)
+                timer.rows = rows or 0
+            if manifest is not None:
+                manifest.record(cur, datafile)
+            if policy.add(files=1, rows=rows or 0):
+                conn.commit()
+            log_event('file_processed', path=datafile, rows=rows, seconds=round(timer.seconds, 6))
+            print('{}/{} files processed.'.format(i, num_files))
+
+    conn.commit()
+    policy.reset()
+
+
+def positive_int(value):
+    """
+        Description: argparse type of the options counting rows or files, which
+            must be at least 1.
+
+        Arguments:
+            value: option value from the command line
+
+        Returns:
+            Integer
+    """
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError('{} is not a positive integer'.format(value))
+    return number
 
-def main():
-    conn = psycopg2.connect("host=127.0.0.1 dbname=sparkifydb user=student password=student")
+
+def parse_args(argv=None):
+    """
+        Description: Parses the command line options of the ETL pipeline.
+
+        Arguments:
+            argv: list of options, None reads them from the command line
+
+        Returns:
+            argparse.Namespace
+    """
+    parser = argparse.ArgumentParser(description='Load song and log data into the sparkifydb.')
+    parser.add_argument('--dsn', default=DSN,
+                        help='connection string of the sparkifydb (default: %(default)s)')
+    parser.add_argument('--data-dir', default='data',
+                        help='directory holding song_data and log_data (default: %(default)s)')
+    parser.add_argument('--bulk', action='store_true',
+                        help='load log records through COPY into staging tables and merge them')
+    parser.add_argument('--chunksize', type=int, default=None,
+                        help='number of log lines parsed at a time (default: whole file)')
+    parser.add_argument('--song-index', action='store_true',
+                        help='resolve song and artist ids from an in-memory index instead of song_select')
+    parser.add_argument('--preload-time', action='store_true',
+                        help='pre-load the start times of the time table, so that only new ones are inserted')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of processes parsing and transforming files (default: 1)')
+    parser.add_argument('--incremental', '--resume', action='store_true',
+                        help='skip the files recorded as unchanged in the etl_manifest table, '
+                             'which also resumes a crashed run from its last commit; runs with '
+                             '--commit-every above 1 or --song-batch-size record their files too')
+    parser.add_argument('--commit-every', type=int, default=1,
+                        help='number of files or rows loaded per transaction (default: 1)')
+    parser.add_argument('--commit-unit', choices=CommitPolicy.UNITS, default='files',
+                        help='unit of --commit-every (default: files)')
+    parser.add_argument('--song-batch-size', type=positive_int, default=None,
+                        help='load song files in batches of this size with multi-row INSERTs, '
+                             'committing once per batch (default: one file at a time)')
+    parser.add_argument('--log-events', action='store_true',
+                        help='write a structured JSON event per processed file to stderr')
+    parser.add_argument('--profile-dir', default=None,
+                        help='write a cProfile of each processed file into this directory')
+    args = parser.parse_args(argv)
+    if args.chunksize and args.workers > 1:
+        parser.error('--chunksize bounds the memory of a single process, it cannot be used with --workers')
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    song_data = os.path.join(args.data_dir, 'song_data')
+    log_data = os.path.join(args.data_dir, 'log_data')
+
+    if args.log_events:
+        enable_log_events()
+
+    # every statement is accounted to the table it touches
+    conn = psycopg2.connect(args.dsn, cursor_factory=InstrumentedCursor)
     cur = conn.cursor()
 
-    process_data(cur, conn, filepath='data/song_data', func=process_song_file)
-    process_data(cur, conn, filepath='data/log_data', func=process_log_file)
+    index = SongIndex.from_database(cur) if args.song_index else None
+
+    # start times are deduplicated across files for the whole run
+    time_dim = TimeDimension.from_database(cur) if args.preload_time else TimeDimension()
+
+    # an incremental run skips the files recorded as unchanged and replaces the songplays
+    # of the log files, which may have been loaded by an earlier run; a run batching its
+    # commits records every file it processes, so that --resume restarts it from its last commit
+    if args.incremental:
+        manifest = Manifest.from_database(cur, args.data_dir)
+    elif args.commit_every > 1 or args.song_batch_size:
+        manifest = Manifest(args.data_dir)
+    else:
+        manifest = None
+    # shared by the song and log stages, each commits its last files and resets the counters
+    policy = CommitPolicy(args.commit_unit, args.commit_every)
+
+    if args.song_batch_size:
+        process_song_data(cur, conn, filepath=song_data, batch_size=args.song_batch_size,
+                          index=index, manifest=manifest, workers=args.workers, policy=policy,
+                          profile_dir=args.profile_dir)
+    elif args.workers > 1:
+        process_data_parallel(cur, conn, filepath=song_data,
+                              parse=read_song_file,
+                              load=functools.partial(load_song, index=index),
+                              workers=args.workers, manifest=manifest, policy=policy, profile_dir=args.profile_dir)
+    else:
+        process_data(cur, conn, filepath=song_data,
+                     func=functools.partial(process_song_file, index=index), manifest=manifest, policy=policy,
+                     profile_dir=args.profile_dir)
+
+    if args.workers > 1:
+        process_data_parallel(cur, conn, filepath=log_data,
+                              parse=functools.partial(parse_log_file, root=args.data_dir),
+                              load=functools.partial(load_log_file, bulk=args.bulk, index=index, time_dim=time_dim,
+                                                     replace=args.incremental),
+                              workers=args.workers, manifest=manifest, policy=policy, profile_dir=args.profile_dir)
+    else:
+        process_data(cur, conn, filepath=log_data,
+                     func=functools.partial(process_log_file, chunksize=args.chunksize, bulk=args.bulk, index=index,
+                                            time_dim=time_dim, root=args.data_dir, replace=args.incremental),
+                     manifest=manifest, policy=policy, profile_dir=args.profile_dir)
+
+    if index is not None:
+        print('Song index: {songs} songs, {hits} hits, {misses} misses.'.format(**index.stats()))
+    print('Time dimension: {} start times, {} duplicates skipped.'.format(len(time_dim.seen), time_dim.skipped))
+    print(summary())
+    log_event('run_finished', **STATS.as_dict())
 
     conn.close()
 
@@ -0,0 +1,327 @@
+import os
+import re
+import json
+import time
+import types
+import cProfile
+import logging
+import functools
+import contextlib
+import collections
+import psycopg2.extensions
+
+
+# structured log events, one JSON object per message
+logger = logging.getLogger('sparkify')
+
+# table a statement reads or writes, in the order the patterns are tried
+TABLE_PATTERN = re.compile(r'\b(?:INSERT\s+INTO|COPY|UPDATE|TRUNCATE|TABLE(?:\s+IF(?:\s+NOT)?\s+EXISTS)?|FROM)\s+(\w+)',
+                           re.IGNORECASE)
+
+
+class Timings:
+    """
+        Description: Wall time, calls and rows accumulated per name, e.g. per stage
+            of the pipeline, per function, or per table of the database.
+    """
+
+    def __init__(self):
+        self.seconds = collections.defaultdict(float)
+        self.calls = collections.defaultdict(int)
+        self.rows = collections.defaultdict(int)
+
+    @contextlib.contextmanager
+    def time(self, name, rows=0):
+        """
+            Description: Times the enclosed block as one call of a name.
+
+            Arguments:
+                name: name the block is accounted to
+                rows: number of rows handled by the block, the block can also
+                      set it on the timer it is given
+
+            Returns:
+                Context manager yielding the timer of the block, holding its
+                seconds once the block is done
+        """
+        timer = types.SimpleNamespace(rows=rows, seconds=0.0)
+        start = time.perf_counter()
+        try:
+            yield timer
+        finally:
+            timer.seconds = time.perf_counter() - start
+            self.add(name, timer.seconds, 1, timer.rows)
+
+    def add(self, name, seconds, calls, rows):
+        self.seconds[name] += seconds
+        self.calls[name] += calls
+        self.rows[name] += rows
+
+    def merge(self, other):
+        """
+            Description: Adds the timings of another Timings, e.g. from a worker process.
+
+            Arguments:
+                other: dict returned by `as_dict`
+
+            Returns:
+                None
+        """
+        for name, timing in other.items():
+            self.add(name, timing['seconds'], timing['calls'], timing['rows'])
+
+    def as_dict(self):
+        """
+            Description: Returns the timings as plain data.
+
+            Arguments:
+                None
+
+            Returns:
+                Dict of name to dict of seconds, calls and rows
+        """
+        return {name: {'seconds': self.seconds[name],
+                       'calls': self.calls[name],
+                       'rows': self.rows[name]}
+                for name in self.seconds}
+
+    def reset(self):
+        self.seconds.clear()
+        self.calls.clear()
+        self.rows.clear()
+
+
+class Stats:
+    """
+        Description: Instrumentation of the ETL pipeline:
+            - stages: parse, transform, lookup and load,
+            - functions: wall time of the functions decorated with `timed`,
+            - tables: statements sent and database round-trip latency per table,
+              with the rows they affected.
+    """
+
+    def __init__(self):
+        self.stages = Timings()
+        self.functions = Timings()
+        self.tables = Timings()
+
+    def merge(self, other):
+        """
+            Description: Adds the stats of another Stats, e.g. from a worker process.
+
+            Arguments:
+                other: dict returned by `as_dict`
+
+            Returns:
+                None
+        """
+        for name, timings in other.items():
+            getattr(self, name).merge(timings)
+
+    def as_dict(self):
+        return {'stages': self.stages.as_dict(),
+                'functions': self.functions.as_dict(),
+                'tables': self.tables.as_dict()}
+
+    def reset(self):
+        self.stages.reset()
+        self.functions.reset()
+        self.tables.reset()
+
+
+# process-wide stats of the pipeline
+STATS = Stats()
+
+
+def stage(name, rows=0):
+    """
+        Description: Times the enclosed block as one call of a stage in STATS.
+
+        Arguments:
+            name: name of the stage
+            rows: number of rows handled by the block
+
+        Returns:
+            Context manager yielding the timer of the block
+    """
+    return STATS.stages.time(name, rows)
+
+
+def timed_iter(iterable, name):
+    """
+        Description: Times each step of an iterable, e.g. a chunked reader, as one
+            call of a stage in STATS, counting the length of each item as rows.
+
+        Arguments:
+            iterable: iterable of sized items
+            name: name of the stage
+
+        Returns:
+            Generator of the items of the iterable
+    """
+    iterator = iter(iterable)
+    while True:
+        with stage(name) as timer:
+            item = next(iterator, None)
+            if item is not None:
+                timer.rows = len(item)
+        if item is None:
+            return
+        yield item
+
+
+def timed(func):
+    """
+        Description: Decorator accounting the wall time of each call of a function
+            in STATS, with the rows it returns when it returns an integer.
+
+        Arguments:
+            func: function to time
+
+        Returns:
+            Function
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with STATS.functions.time(func.__name__) as timer:
+            result = func(*args, **kwargs)
+            if isinstance(result, int):
+                timer.rows = result
+        return result
+    return wrapper
+
+
+class InstrumentedCursor(psycopg2.extensions.cursor):
+    """
+        Description: Cursor accounting every statement it sends, and the time spent
+            waiting for the database, to the table the statement reads or writes.
+            Pass it as `cursor_factory` to `psycopg2.connect`.
+    """
+
+    def execute(self, query, vars=None):
+        with _statement(self, query):
+            return super().execute(query, vars)
+
+    def executemany(self, query, vars_list):
+        with _statement(self, query):
+            return super().executemany(query, vars_list)
+
+    def copy_expert(self, sql, file, size=8192):
+        with _statement(self, sql):
+            return super().copy_expert(sql, file, size)
+
+
+@contextlib.contextmanager
+def _statement(cur, query):
+    if isinstance(query, bytes):
+        query = query.decode()
+    match = TABLE_PATTERN.search(query if isinstance(query, str) else '')
+    table = match.group(1).lower() if match else 'other'
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STATS.tables.add(table, time.perf_counter() - start, 1, max(cur.rowcount, 0))
+
+
+def log_event(event, **fields):
+    """
+        Description: Logs a structured event as one JSON object.
+
+        Arguments:
+            event: name of the event
+            fields: fields of the event
+
+        Returns:
+            None
+    """
+    if logger.isEnabledFor(logging.INFO):
+        logger.info(json.dumps(dict(fields, event=event), default=str))
+
+
+def enable_log_events():
+    """
+        Description: Writes the structured events to stderr.
+
+        Arguments:
+            None
+
+        Returns:
+            None
+    """
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+
+
+@contextlib.contextmanager
+def profiled(profile_dir, filepath, step):
+    """
+        Description: Captures a cProfile of the enclosed block into
+            `<profile_dir>/<file path>.<step>.prof`, when `profile_dir` is set.
+
+        Arguments:
+            profile_dir: directory the profiles are written to, or None
+            filepath: path of the file being processed
+            step: name of the processing step, e.g. parse or load
+
+        Returns:
+            Context manager
+    """
+    if not profile_dir:
+        yield
+        return
+
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+        name = os.path.relpath(filepath).replace(os.sep, '_').lstrip('._')
+        os.makedirs(profile_dir, exist_ok=True)
+        profile.dump_stats(os.path.join(profile_dir, '{}.{}.prof'.format(name, step)))
+
+
+def run_with_stats(func, filepath, profile_dir=None):
+    """
+        Description: Runs a function of a file path in a worker process and hands
+            the stats it recorded back to the caller, to be merged into the
+            writer's STATS.
+
+        Arguments:
+            func: function to run
+            filepath: file path the function is called with
+            profile_dir: directory a cProfile of the call is written to, or None
+
+        Returns:
+            Tuple: (result of the function, dict of the stats it recorded)
+    """
+    STATS.reset()
+    with profiled(profile_dir, filepath, 'parse'):
+        result = func(filepath)
+    return result, STATS.as_dict()
+
+
+def summary():
+    """
+        Description: Formats STATS as a table per stage, function and table.
+
+        Arguments:
+            None
+
+        Returns:
+            String
+    """
+    lines = []
+    for title, timings in (('Stage', STATS.stages), ('Function', STATS.functions), ('Table', STATS.tables)):
+        if not timings.seconds:
+            continue
+        lines.append('{:<24} {:>10} {:>10} {:>12}'.format(title, 'seconds', 'calls', 'rows'))
+        for name in sorted(timings.seconds, key=timings.seconds.get, reverse=True):
+            lines.append('{:<24} {:>10.3f} {:>10d} {:>12d}'.format(
+                name, timings.seconds[name], timings.calls[name], timings.rows[name]))
+        lines.append('')
+    return '\n'.join(lines)
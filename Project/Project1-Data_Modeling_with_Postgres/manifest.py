@@ -0,0 +1,132 @@
+import os
+import hashlib
+from sql_queries import manifest_select, manifest_table_insert
+
+
+def file_hash(filepath):
+    """
+        Description: Computes the SHA-256 digest of a file's content.
+
+        Arguments:
+            filepath: path of the file
+
+        Returns:
+            String: hex digest
+    """
+    digest = hashlib.sha256()
+    with open(filepath, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def source_key(filepath, root=None):
+    """
+        Description: Key of a file, its path relative to the data directory, recorded
+            in the etl_manifest table and on the songplays loaded from it.
+
+        Arguments:
+            filepath: path of the file
+            root: data directory, None keeps the path as given
+
+        Returns:
+            String: key of the file
+    """
+    # the same file has the same key whatever the working directory
+    return filepath if root is None else os.path.relpath(filepath, root)
+
+
+class Manifest:
+    """
+        Description: Processed files recorded in the etl_manifest table, keyed by
+            path relative to the data directory, with their size, mtime and
+            content hash.
+
+            A file whose size and mtime are unchanged is skipped without being read.
+            Otherwise its content is hashed: a file whose content is unchanged only
+            gets its mtime refreshed, a new or modified one is processed again.
+
+            Songs, artists, users and time are upserted, so reprocessing a modified
+            file is safe for them; the songplays of a log file are replaced by
+            the ETL, see `etl.delete_songplays`.
+    """
+
+    def __init__(self, root, entries=None):
+        """
+            Arguments:
+                root: data directory the recorded paths are relative to
+                entries: dict of path to (size, mtime, sha256)
+        """
+        self.root = root
+        self.entries = entries or {}
+        self.pending = {}
+
+    @classmethod
+    def from_database(cls, cur, root):
+        """
+            Description: Loads the manifest from the etl_manifest table.
+
+            Arguments:
+                cur: the cursor object
+                root: data directory the recorded paths are relative to
+
+            Returns:
+                Manifest
+        """
+        cur.execute(manifest_select)
+        return cls(root, {path: (size, mtime, sha256) for path, size, mtime, sha256 in cur.fetchall()})
+
+    def key(self, filepath):
+        return source_key(filepath, self.root)
+
+    def changed_files(self, cur, filepaths):
+        """
+            Description: Returns the files that are new or modified since they were
+                recorded, refreshing the mtime of files whose content is unchanged.
+
+            Arguments:
+                cur: the cursor object
+                filepaths: file paths to check
+
+            Returns:
+                List of file paths to process
+        """
+        changed = []
+        for filepath in filepaths:
+            path = self.key(filepath)
+            stat = os.stat(filepath)
+            entry = self.entries.get(path)
+
+            if entry is not None and entry[:2] == (stat.st_size, stat.st_mtime):
+                continue
+
+            fingerprint = (stat.st_size, stat.st_mtime, file_hash(filepath))
+            if entry is not None and entry[2] == fingerprint[2]:
+                cur.execute(manifest_table_insert, (path,) + fingerprint)
+                self.entries[path] = fingerprint
+                continue
+
+            self.pending[path] = fingerprint
+            changed.append(filepath)
+        return changed
+
+    def record(self, cur, filepath):
+        """
+            Description: Records a processed file in the etl_manifest table, in the
+                same transaction as its data.
+
+            Arguments:
+                cur: the cursor object
+                filepath: processed file path
+
+            Returns:
+                None
+        """
+        path = self.key(filepath)
+        fingerprint = self.pending.pop(path, None)
+        if fingerprint is None:
+            stat = os.stat(filepath)
+            fingerprint = (stat.st_size, stat.st_mtime, file_hash(filepath))
+
+        cur.execute(manifest_table_insert, (path,) + fingerprint)
+        self.entries[path] = fingerprint
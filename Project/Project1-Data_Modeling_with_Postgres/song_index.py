@@ -0,0 +1,121 @@
+import json
+import pandas as pd
+from sql_queries import song_lookup_select
+
+
+class SongIndex:
+    """
+        Description: In-memory index of songs keyed on (title, artist name, duration)
+            that resolves song and artist ids of songplays without a `song_select`
+            query per event.
+
+            The index mirrors the `songs` JOIN `artists` lookup: the first song
+            stored for a song_id and the first name stored for an artist_id win,
+            the same way `ON CONFLICT DO NOTHING` keeps them in the database.
+    """
+
+    def __init__(self):
+        self.ids = {}
+        self.song_ids = set()
+        self.artist_names = {}
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def from_database(cls, cur):
+        """
+            Description: Builds the index from the songs and artists tables.
+
+            Arguments:
+                cur: the cursor object
+
+            Returns:
+                SongIndex
+        """
+        index = cls()
+        cur.execute(song_lookup_select)
+        for song_id, title, duration, artist_id, name in cur.fetchall():
+            index.song_ids.add(song_id)
+            index.artist_names.setdefault(artist_id, name)
+            index._add_key(title, name, duration, song_id, artist_id)
+        return index
+
+    @classmethod
+    def from_song_files(cls, filepaths):
+        """
+            Description: Builds the index straight from song files in JSON format.
+
+            Arguments:
+                filepaths: song data file paths
+
+            Returns:
+                SongIndex
+        """
+        index = cls()
+        for filepath in filepaths:
+            with open(filepath, "r") as f:
+                index.add_song(json.load(f))
+        return index
+
+    def add_song(self, song):
+        """
+            Description: Adds a song record, refreshing the index incrementally
+                as songs are inserted into the database.
+
+            Arguments:
+                song: dict of a song file with song_id, title, duration,
+                      artist_id and artist_name keys
+
+            Returns:
+                None
+        """
+        artist_id = song['artist_id']
+        name = self.artist_names.setdefault(artist_id, song['artist_name'])
+
+        if song['song_id'] in self.song_ids:
+            return
+        self.song_ids.add(song['song_id'])
+        self._add_key(song['title'], name, song['duration'], song['song_id'], artist_id)
+
+    def _add_key(self, title, name, duration, song_id, artist_id):
+        if title is None or name is None or duration is None:
+            return
+        self.ids.setdefault((title, name, float(duration)), (song_id, artist_id))
+
+    def resolve(self, songplay_df):
+        """
+            Description: Resolves song and artist ids of songplay records in one batch
+                and counts hits and misses.
+
+            Arguments:
+                songplay_df: dataframe of songplay records with song, artist and length columns
+
+            Returns:
+                Dataframe with song_id and artist_id columns added
+        """
+        keys = zip(songplay_df.song, songplay_df.artist, songplay_df.length)
+        matches = [self.ids.get(key, (None, None)) for key in keys]
+
+        # object columns keep missing ids as None rather than NaN
+        resolved = songplay_df.copy()
+        resolved['song_id'] = pd.Series([song_id for song_id, artist_id in matches],
+                                        index=resolved.index, dtype=object)
+        resolved['artist_id'] = pd.Series([artist_id for song_id, artist_id in matches],
+                                          index=resolved.index, dtype=object)
+
+        hits = int(resolved.song_id.notna().sum())
+        self.hits += hits
+        self.misses += len(resolved) - hits
+        return resolved
+
+    def stats(self):
+        """
+            Description: Returns the size of the index and the hit and miss counts.
+
+            Arguments:
+                None
+
+            Returns:
+                Dict
+        """
+        return {'songs': len(self.ids), 'hits': self.hits, 'misses': self.misses}
@@ -5,6 +5,7 @@ user_table_drop = "DROP TABLE IF EXISTS users"
 song_table_drop = "DROP TABLE IF EXISTS songs"
 artist_table_drop = "DROP TABLE IF EXISTS artists"
 time_table_drop = "DROP TABLE IF EXISTS time"
+manifest_table_drop = "DROP TABLE IF EXISTS etl_manifest"
 
 # CREATE TABLES
 
@@ -18,7 +19,8 @@ songplay_table_create = ("""CREATE TABLE IF NOT EXISTS songplays
                                 artist_id VARCHAR,
                                 session_id INT,
                                 location VARCHAR,
-                                user_agent VARCHAR
+                                user_agent VARCHAR,
+                                source_file VARCHAR
                             );"""
                         )
 
@@ -64,6 +66,23 @@ time_table_create = ("""CREATE TABLE IF NOT EXISTS time
                         );"""
                     )
 
+# songplays tables created before the log file of each songplay was recorded
+songplay_source_column_add = "ALTER TABLE songplays ADD COLUMN IF NOT EXISTS source_file VARCHAR"
+
+songplay_source_index_create = ("""CREATE INDEX IF NOT EXISTS songplays_source_idx 
+                                   ON songplays (source_file);"""
+                               )
+
+manifest_table_create = ("""CREATE TABLE IF NOT EXISTS etl_manifest 
+                            (
+                                path VARCHAR PRIMARY KEY, 
+                                size BIGINT NOT NULL, 
+                                mtime DOUBLE PRECISION NOT NULL, 
+                                sha256 CHAR(64) NOT NULL, 
+                                processed_at TIMESTAMP NOT NULL DEFAULT now()
+                            );"""
+                        )
+
 
 # INSERT RECORDS
 
@@ -77,9 +96,10 @@ songplay_table_insert = ("""INSERT INTO songplays
                                 artist_id, 
                                 session_id, 
                                 location, 
-                                user_agent
+                                user_agent,
+                                source_file
                             )
-                            VALUES (DEFAULT, %s, %s, %s, %s, %s, %s, %s, %s) 
+                            VALUES (DEFAULT, %s, %s, %s, %s, %s, %s, %s, %s, %s) 
                             ON CONFLICT (songplay_id) 
                             DO NOTHING;"""
                         )
@@ -136,6 +156,45 @@ time_table_insert = ("""INSERT INTO time
                         DO NOTHING;"""
                     )
 
+song_table_batch_insert = ("""INSERT INTO songs 
+                              (
+                                  song_id, title, 
+                                  artist_id, 
+                                  year, 
+                                  duration
+                              )
+                              VALUES %s
+                              ON CONFLICT (song_id) 
+                              DO NOTHING;""")
+
+artist_table_batch_insert = ("""INSERT INTO artists 
+                                (
+                                    artist_id, name, 
+                                    location, 
+                                    latitude, 
+                                    longitude
+                                ) 
+                                VALUES %s
+                                ON CONFLICT (artist_id) 
+                                DO NOTHING;"""
+                            )
+
+manifest_table_insert = ("""INSERT INTO etl_manifest 
+                            (
+                                path, 
+                                size, 
+                                mtime, 
+                                sha256
+                            ) 
+                            VALUES (%s, %s, %s, %s)
+                            ON CONFLICT (path) 
+                            DO UPDATE
+                            SET size = EXCLUDED.size, 
+                                mtime = EXCLUDED.mtime, 
+                                sha256 = EXCLUDED.sha256, 
+                                processed_at = now();"""
+                        )
+
 # FIND SONGS
 
 song_select = ("""SELECT song_id, artists.artist_id 
@@ -145,7 +204,146 @@ song_select = ("""SELECT song_id, artists.artist_id
                   WHERE songs.title = %s AND artists.name = %s AND songs.duration = %s"""
               )
 
+song_lookup_select = ("""SELECT song_id, title, duration, artists.artist_id, artists.name 
+                         FROM songs 
+                         JOIN artists 
+                         ON songs.artist_id = artists.artist_id"""
+                     )
+
+time_start_select = ("""SELECT start_time 
+                        FROM time"""
+                    )
+
+manifest_select = ("""SELECT path, size, mtime, sha256 
+                      FROM etl_manifest"""
+                  )
+
+# STAGING TABLES
+
+time_staging_create = ("""CREATE TEMP TABLE IF NOT EXISTS time_staging 
+                          (LIKE time);"""
+                      )
+
+user_staging_create = ("""CREATE TEMP TABLE IF NOT EXISTS user_staging 
+                          (LIKE users);"""
+                      )
+
+songplay_staging_create = ("""CREATE TEMP TABLE IF NOT EXISTS songplay_staging 
+                              (
+                                  start_time TIMESTAMP NOT NULL,
+                                  user_id INT NOT NULL,
+                                  level VARCHAR,
+                                  song VARCHAR,
+                                  artist VARCHAR,
+                                  length NUMERIC,
+                                  song_id VARCHAR,
+                                  artist_id VARCHAR,
+                                  session_id INT,
+                                  location VARCHAR,
+                                  user_agent VARCHAR,
+                                  source_file VARCHAR
+                              );"""
+                          )
+
+time_staging_truncate = "TRUNCATE time_staging"
+user_staging_truncate = "TRUNCATE user_staging"
+songplay_staging_truncate = "TRUNCATE songplay_staging"
+
+staging_copy = "COPY {} ({}) FROM STDIN WITH (FORMAT csv)"
+
+# MERGE STAGING TABLES
+
+time_table_merge = ("""INSERT INTO time 
+                       (
+                           start_time,
+                           hour,
+                           day, 
+                           week, 
+                           month, 
+                           year, 
+                           weekday
+                       ) 
+                       SELECT start_time, hour, day, week, month, year, weekday
+                       FROM time_staging
+                       ON CONFLICT (start_time) 
+                       DO NOTHING;"""
+                   )
+
+user_table_merge = ("""INSERT INTO users 
+                       (
+                           user_id, 
+                           first_name, 
+                           last_name, 
+                           gender, 
+                           level
+                       ) 
+                       SELECT user_id, first_name, last_name, gender, level
+                       FROM user_staging
+                       ON CONFLICT (user_id) 
+                       DO UPDATE
+                       SET level = EXCLUDED.level;"""
+                   )
+
+songplay_table_merge = ("""INSERT INTO songplays 
+                           (
+                               start_time,
+                               user_id, 
+                               level, 
+                               song_id, 
+                               artist_id, 
+                               session_id, 
+                               location, 
+                               user_agent,
+                               source_file
+                           )
+                           SELECT sp.start_time, sp.user_id, sp.level, 
+                                  match.song_id, match.artist_id, 
+                                  sp.session_id, sp.location, sp.user_agent, sp.source_file
+                           FROM songplay_staging sp
+                           LEFT JOIN LATERAL 
+                           (
+                               SELECT song_id, artists.artist_id 
+                               FROM songs 
+                               JOIN artists 
+                               ON songs.artist_id = artists.artist_id 
+                               WHERE songs.title = sp.song AND artists.name = sp.artist AND songs.duration = sp.length
+                               LIMIT 1
+                           ) match ON TRUE
+                           ON CONFLICT (songplay_id)
+                           DO NOTHING;"""
+                       )
+
+songplay_table_resolved_merge = ("""INSERT INTO songplays
+                                    (
+                                        start_time,
+                                        user_id,
+                                        level,
+                                        song_id,
+                                        artist_id,
+                                        session_id,
+                                        location,
+                                        user_agent,
+                                        source_file
+                                    )
+                                    SELECT start_time, user_id, level, song_id, artist_id,
+                                           session_id, location, user_agent, source_file
+                                    FROM songplay_staging
+                                    ON CONFLICT (songplay_id)
+                                    DO NOTHING;"""
+                                )
+
+# DELETE RECORDS
+
+# songplays previously loaded from a log file
+songplay_table_delete = ("""DELETE FROM songplays 
+                            WHERE source_file = %s"""
+                        )
+
 # QUERY LISTS
 
-create_table_queries = [songplay_table_create, user_table_create, song_table_create, artist_table_create, time_table_create]
-drop_table_queries = [songplay_table_drop, user_table_drop, song_table_drop, artist_table_drop, time_table_drop]
\ No newline at end of file
+create_table_queries = [songplay_table_create, songplay_source_column_add, songplay_source_index_create, user_table_create, song_table_create, artist_table_create, time_table_create, manifest_table_create]
+drop_table_queries = [songplay_table_drop, user_table_drop, song_table_drop, artist_table_drop, time_table_drop, manifest_table_drop]
+create_staging_queries = [time_staging_create, user_staging_create, songplay_staging_create]
+truncate_staging_queries = [time_staging_truncate, user_staging_truncate, songplay_staging_truncate]
+merge_staging_queries = [time_table_merge, user_table_merge, songplay_table_merge]
+merge_resolved_staging_queries = [time_table_merge, user_table_merge, songplay_table_resolved_merge]
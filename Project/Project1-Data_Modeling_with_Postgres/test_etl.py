@@ -0,0 +1,45 @@
+import os
+import json
+import pytest
+from etl import get_files, read_song_file, read_log_file
+
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+LOG_FILES = get_files(os.path.join(DATA_DIR, 'log_data'))
+
+
+def song_durations():
+    """
+        Description: Returns the duration of every song of the song files, keyed
+            on its title and artist name, as stored in the songs table.
+    """
+    durations = {}
+    for filepath in get_files(os.path.join(DATA_DIR, 'song_data')):
+        song = read_song_file(filepath)
+        durations[(song['title'], song['artist_name'])] = song['duration']
+    return durations
+
+
+@pytest.mark.parametrize('chunksize', [None, 100])
+@pytest.mark.parametrize('filepath', LOG_FILES, ids=os.path.basename)
+def test_log_lengths_parse_exactly(filepath, chunksize):
+    with open(filepath) as f:
+        expected = [record['length'] for record in map(json.loads, f) if record['page'] == 'NextSong']
+
+    lengths = [length for df in read_log_file(filepath, chunksize) for length in df['length']]
+
+    assert lengths == expected
+
+
+def test_log_length_equals_song_duration():
+    durations = song_durations()
+    matched = 0
+    for filepath in LOG_FILES:
+        for df in read_log_file(filepath):
+            for song, artist, length in zip(df['song'], df['artist'], df['length']):
+                if (song, artist) in durations:
+                    assert length == durations[(song, artist)]
+                    matched += 1
+
+    assert matched > 0
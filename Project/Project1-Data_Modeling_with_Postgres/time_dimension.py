@@ -0,0 +1,78 @@
+import pandas as pd
+from sql_queries import time_start_select
+
+
+def build_time_frame(timestamps):
+    """
+        Description: Derives the time records of a series of timestamps, computing
+            hour, day, week, month, year, and weekday once per distinct timestamp
+            in one vectorized pass.
+
+        Arguments:
+            timestamps: series of datetime values
+
+        Returns:
+            Dataframe with start_time, hour, day, week, month, year, weekday columns
+    """
+    t = pd.Series(timestamps.drop_duplicates().values)
+
+    hour, day, week, month, year, weekday = t.dt.hour, t.dt.day, t.dt.isocalendar().week, t.dt.month, t.dt.year, t.dt.dayofweek
+    time_data = (t, hour, day, week, month, year, weekday)
+    column_labels = ('start_time', 'hour', 'day', 'week', 'month', 'year', 'weekday')
+    return pd.DataFrame({k:v for k,v in zip(column_labels, time_data)})
+
+
+def _nanoseconds(timestamps):
+    return pd.to_datetime(pd.Series(timestamps)).astype('datetime64[ns]').to_numpy().view('int64')
+
+
+class TimeDimension:
+    """
+        Description: Start times already sent to the time table during the run,
+            or pre-loaded from it, so that only unseen timestamps are inserted
+            instead of relying on `ON CONFLICT (start_time) DO NOTHING` for all of them.
+    """
+
+    def __init__(self):
+        self.seen = set()
+        self.skipped = 0
+
+    @classmethod
+    def from_database(cls, cur):
+        """
+            Description: Pre-loads the start times of the time table.
+
+            Arguments:
+                cur: the cursor object
+
+            Returns:
+                TimeDimension
+        """
+        dimension = cls()
+        cur.execute(time_start_select)
+        rows = cur.fetchall()
+        if rows:
+            dimension.seen.update(_nanoseconds([start_time for start_time, in rows]).tolist())
+        return dimension
+
+    def unseen(self, time_df):
+        """
+            Description: Keeps the time records whose start_time has not been seen yet
+                and marks them as seen.
+
+            Arguments:
+                time_df: dataframe of time records with distinct start_time values
+
+            Returns:
+                Dataframe of the unseen time records
+        """
+        if time_df.empty:
+            return time_df
+
+        keys = _nanoseconds(time_df.start_time).tolist()
+        mask = [key not in self.seen for key in keys]
+        self.seen.update(keys)
+
+        unseen = time_df[mask]
+        self.skipped += len(time_df) - len(unseen)
+        return unseen
@@ -0,0 +1,257 @@
+import csv
+import time
+import argparse
+from cassandra.cluster import Cluster
+from cassandra.concurrent import execute_concurrent
+from cql_queries import *
+from event_data import get_event_files, iter_event_rows, tee_rows
+from partition_batcher import PartitionBatcher
+
+
+# number of statements in flight at once
+CONCURRENCY = 100
+
+
+def song_library_values(row):
+    return (int(row[8]), int(row[3]), row[0], row[9], float(row[5]))
+
+
+def user_history_values(row):
+    return (int(row[10]), int(row[8]), int(row[3]), row[0], row[9], row[1], row[4])
+
+
+def song_history_values(row):
+    return (row[9], int(row[10]), row[1], row[4])
+
+
+# table name -> (insert query, function of an event row returning the values of the insert,
+#                number of leading values forming the partition key)
+TABLES = {'song_library': (song_library_insert, song_library_values, 1),
+          'user_history': (user_history_insert, user_history_values, 2),
+          'song_history': (song_history_insert, song_history_values, 1)}
+
+
+def connect(hosts=('127.0.0.1',), keyspace='sparkify'):
+    """
+        Description: Connects to the Cassandra cluster, creates the keyspace if it
+            does not exist and sets it on the session.
+
+        Arguments:
+            hosts: contact points of the cluster
+            keyspace: name of the keyspace
+
+        Returns:
+            Tuple: (cluster, session)
+    """
+    cluster = Cluster(list(hosts))
+    session = cluster.connect()
+    session.execute(keyspace_create.format(keyspace))
+    session.set_keyspace(keyspace)
+    return cluster, session
+
+
+def reset_tables(session):
+    """
+        Description: Drops and creates song_library, user_history and song_history.
+
+        Arguments:
+            session: the session object
+
+        Returns:
+            None
+    """
+    for query in drop_table_queries + create_table_queries:
+        session.execute(query)
+
+
+def prepare_inserts(session, tables=None):
+    """
+        Description: Prepares the insert statement of each table once, so that rows
+            are sent as bound values instead of a query string per row.
+
+        Arguments:
+            session: the session object
+            tables: names of the tables to load, None loads all of TABLES
+
+        Returns:
+            Dict of table name to (prepared statement, values function, partition key size)
+    """
+    return {table: (session.prepare(TABLES[table][0]),) + TABLES[table][1:]
+            for table in (tables or TABLES)}
+
+
+def read_event_rows(filepath):
+    """
+        Description: Reads the rows of a pre-processed event data file lazily.
+
+        Arguments:
+            filepath: path of event_datafile_new.csv
+
+        Returns:
+            Generator of lists of values, in the order of event_data.EVENT_COLUMNS
+    """
+    with open(filepath, encoding='utf8', newline='') as f:
+        csvreader = csv.reader(f)
+        next(csvreader)  # skip header
+        for line in csvreader:
+            yield line
+
+
+def load_rows(session, rows, tables=None, concurrency=CONCURRENCY, batch_size=1, histograms=None):
+    """
+        Description: This function is responsible for
+            - fanning each event row out to the insert of every table, in a single pass,
+            - grouping the inserts of each table by partition key into unlogged
+              single-partition batches of at most `batch_size` inserts,
+            - executing the statements asynchronously with at most `concurrency`
+              statements in flight, stopping at the first error.
+
+        Arguments:
+            session: the session object
+            rows: iterable of event rows, in the order of event_data.EVENT_COLUMNS
+            tables: names of the tables to load, None loads all of TABLES
+            concurrency: maximum number of statements in flight
+            batch_size: maximum number of inserts per batch, 1 sends every insert on its own
+            histograms: dict filled with the table name to a Counter of the number of
+                        inserts per statement sent, or None
+
+        Returns:
+            Dict of table name to number of rows inserted
+    """
+    inserts = prepare_inserts(session, tables)
+    counts = dict.fromkeys(inserts, 0)
+    batchers = {table: PartitionBatcher(prepared, key_size, batch_size)
+                for table, (prepared, values, key_size) in inserts.items()}
+
+    def statements():
+        for row in rows:
+            for table, (prepared, values, key_size) in inserts.items():
+                counts[table] += 1
+                yield from batchers[table].add(values(row))
+
+        for batcher in batchers.values():
+            yield from batcher.flush()
+
+    # results are consumed as they complete, so rows are never all held in memory
+    for success, result in execute_concurrent(session, statements(), concurrency=concurrency,
+                                              raise_on_first_error=True, results_generator=True):
+        pass
+
+    if histograms is not None:
+        histograms.update({table: batcher.histogram for table, batcher in batchers.items()})
+    return counts
+
+
+def load_event_files(session, file_path_list, tables=None, concurrency=CONCURRENCY, output=None, batch_size=1,
+                     histograms=None):
+    """
+        Description: This function is responsible for
+            - reading the daily event CSV files once, projecting their song play rows
+              on the fly,
+            - routing each row straight to the prepared inserts of the tables,
+              without writing and reading back event_datafile_new.csv,
+            - writing event_datafile_new.csv on the way only when `output` is set.
+
+        Arguments:
+            session: the session object
+            file_path_list: event data file paths
+            tables: names of the tables to load, None loads all of TABLES
+            concurrency: maximum number of statements in flight
+            output: path of the intermediate CSV file to write, or None
+            batch_size: maximum number of inserts per single-partition batch
+            histograms: dict filled with the table name to a Counter of the number of
+                        inserts per statement sent, or None
+
+        Returns:
+            Dict of table name to number of rows inserted
+    """
+    rows = iter_event_rows(file_path_list)
+    if output is None:
+        return load_rows(session, rows, tables, concurrency, batch_size, histograms)
+
+    with open(output, 'w', encoding='utf8', newline='') as f:
+        return load_rows(session, tee_rows(f, rows), tables, concurrency, batch_size, histograms)
+
+
+def positive_int(value):
+    """
+        Description: argparse type of the options counting statements or inserts,
+            which must be at least 1.
+
+        Arguments:
+            value: option value from the command line
+
+        Returns:
+            Integer
+    """
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError('{} is not a positive integer'.format(value))
+    return number
+
+
+def main():
+    """
+    Description:
+        - Connects to Cassandra and sets the sparkify keyspace.
+        - Optionally drops and creates the tables.
+        - Loads event_datafile_new.csv, or the daily event files directly with
+          --event-dir, into song_library, user_history and song_history with
+          prepared statements executed concurrently.
+        - Reports the number of rows inserted per second.
+
+    Usage:
+        python cassandra_loader.py --reset --concurrency 200
+        python cassandra_loader.py --reset --event-dir event_data --batch-size 20
+    """
+    parser = argparse.ArgumentParser(description='Load event data into the sparkify keyspace.')
+    parser.add_argument('--hosts', nargs='+', default=['127.0.0.1'],
+                        help='contact points of the Cassandra cluster (default: 127.0.0.1)')
+    parser.add_argument('--keyspace', default='sparkify',
+                        help='keyspace of the tables (default: %(default)s)')
+    parser.add_argument('--file', default='event_datafile_new.csv',
+                        help='pre-processed event data file (default: %(default)s)')
+    parser.add_argument('--event-dir', default=None,
+                        help='load the daily event CSV files of this directory directly, instead of --file')
+    parser.add_argument('--write-csv', default=None,
+                        help='with --event-dir, also write the pre-processed rows to this file')
+    parser.add_argument('--tables', nargs='+', choices=list(TABLES), default=None,
+                        help='tables to load (default: all)')
+    parser.add_argument('--concurrency', type=positive_int, default=CONCURRENCY,
+                        help='maximum number of statements in flight (default: %(default)s)')
+    parser.add_argument('--batch-size', type=positive_int, default=1,
+                        help='group the inserts of a partition into unlogged batches of at most this size '
+                             '(default: 1, no batches)')
+    parser.add_argument('--reset', action='store_true',
+                        help='drop and create the tables before loading them')
+    args = parser.parse_args()
+    if args.write_csv and not args.event_dir:
+        parser.error('--write-csv requires --event-dir')
+
+    cluster, session = connect(args.hosts, args.keyspace)
+    try:
+        if args.reset:
+            reset_tables(session)
+
+        start = time.perf_counter()
+        histograms = {}
+        if args.event_dir:
+            counts = load_event_files(session, get_event_files(args.event_dir), args.tables, args.concurrency,
+                                      output=args.write_csv, batch_size=args.batch_size, histograms=histograms)
+        else:
+            counts = load_rows(session, read_event_rows(args.file), args.tables, args.concurrency,
+                               args.batch_size, histograms)
+        seconds = time.perf_counter() - start
+
+        for table, rows in counts.items():
+            print('{}: {} rows in {} statements'.format(table, rows, sum(histograms[table].values())))
+            for size, statements in sorted(histograms[table].items()):
+                print('    {:>5} inserts per statement: {}'.format(size, statements))
+        print('{} rows inserted in {:.2f}s, {:.0f} rows/s.'.format(
+            sum(counts.values()), seconds, sum(counts.values()) / seconds))
+    finally:
+        cluster.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+# KEYSPACE
+
+keyspace_create = ("""CREATE KEYSPACE IF NOT EXISTS {}
+                      WITH REPLICATION = {{'class' : 'SimpleStrategy', 'replication_factor' : 1 }}"""
+                  )
+
+# DROP TABLES
+
+song_library_drop = "DROP TABLE IF EXISTS song_library"
+user_history_drop = "DROP TABLE IF EXISTS user_history"
+song_history_drop = "DROP TABLE IF EXISTS song_history"
+
+# CREATE TABLES
+
+song_library_create = ("""CREATE TABLE IF NOT EXISTS song_library
+                          (
+                              session_id int,
+                              item_in_session int,
+                              artist text,
+                              song text,
+                              length double,
+                              PRIMARY KEY (session_id, item_in_session)
+                          )"""
+                      )
+
+user_history_create = ("""CREATE TABLE IF NOT EXISTS user_history
+                          (
+                              user_id int,
+                              session_id int,
+                              item_in_session int,
+                              artist text,
+                              song text,
+                              first_name text,
+                              last_name text,
+                              PRIMARY KEY ((user_id, session_id), item_in_session)
+                          )"""
+                      )
+
+song_history_create = ("""CREATE TABLE IF NOT EXISTS song_history
+                          (
+                              song text,
+                              user_id int,
+                              first_name text,
+                              last_name text,
+                              PRIMARY KEY (song, user_id)
+                          )"""
+                      )
+
+# INSERT RECORDS, prepared once with ? markers
+
+song_library_insert = ("""INSERT INTO song_library (session_id, item_in_session, artist, song, length)
+                          VALUES (?, ?, ?, ?, ?)"""
+                      )
+
+user_history_insert = ("""INSERT INTO user_history (user_id, session_id, item_in_session, artist, song, first_name, last_name)
+                          VALUES (?, ?, ?, ?, ?, ?, ?)"""
+                      )
+
+song_history_insert = ("""INSERT INTO song_history (song, user_id, first_name, last_name)
+                          VALUES (?, ?, ?, ?)"""
+                      )
+
+# FIND RECORDS, prepared once with ? markers by the notebook
+
+song_library_select = "SELECT artist, song, length FROM song_library WHERE session_id = ? AND item_in_session = ?"
+user_history_select = "SELECT artist, song, first_name, last_name FROM user_history WHERE user_id = ? AND session_id = ?"
+song_history_select = "SELECT first_name, last_name FROM song_history WHERE song = ?"
+
+# QUERY LISTS
+
+create_table_queries = [song_library_create, user_history_create, song_history_create]
+drop_table_queries = [song_library_drop, user_history_drop, song_history_drop]
@@ -0,0 +1,193 @@
+import os
+import csv
+import glob
+import shutil
+import argparse
+import tempfile
+import multiprocessing
+
+
+# columns of event_datafile_new.csv, projected from the daily event_data files
+EVENT_COLUMNS = ['artist', 'firstName', 'gender', 'itemInSession', 'lastName', 'length',
+                 'level', 'location', 'sessionId', 'song', 'userId']
+
+# formatting of event_datafile_new.csv
+DIALECT = dict(quoting=csv.QUOTE_ALL, skipinitialspace=True)
+
+
+def get_event_files(filepath):
+    """
+        Description: Lists the daily event CSV files of a directory, in date order.
+
+        Arguments:
+            filepath: event data directory
+
+        Returns:
+            List of file paths
+    """
+    return sorted(glob.glob(os.path.join(filepath, '*.csv')))
+
+
+def project_rows(filepath):
+    """
+        Description: This function is responsible for
+            - reading a daily event CSV file lazily, one line at a time,
+            - projecting each line on EVENT_COLUMNS, located by the header of the file,
+            - skipping the lines without an artist, which are not song plays.
+
+        Arguments:
+            filepath: event data file path
+
+        Returns:
+            Generator of tuples of values, in the order of EVENT_COLUMNS
+    """
+    with open(filepath, 'r', encoding='utf8', newline='') as csvfile:
+        csvreader = csv.reader(csvfile)
+        header = next(csvreader)
+        positions = [header.index(column) for column in EVENT_COLUMNS]
+        artist = header.index('artist')
+
+        for line in csvreader:
+            if line[artist] == '':
+                continue
+            yield tuple(line[i] for i in positions)
+
+
+def iter_event_rows(file_path_list):
+    """
+        Description: Chains the projected rows of the daily event files, in order.
+
+        Arguments:
+            file_path_list: event data file paths
+
+        Returns:
+            Generator of tuples of values, in the order of EVENT_COLUMNS
+    """
+    for filepath in file_path_list:
+        yield from project_rows(filepath)
+
+
+def write_rows(f, rows, header=True):
+    """
+        Description: Writes rows to an open CSV file as they are produced.
+
+        Arguments:
+            f: file object opened for writing with newline=''
+            rows: iterable of rows
+            header: write the EVENT_COLUMNS header first
+
+        Returns:
+            Integer: number of rows written, without the header
+    """
+    writer = csv.writer(f, **DIALECT)
+    if header:
+        writer.writerow(EVENT_COLUMNS)
+
+    num_rows = 0
+    for row in rows:
+        writer.writerow(row)
+        num_rows += 1
+    return num_rows
+
+
+def tee_rows(f, rows):
+    """
+        Description: Writes rows to an open CSV file, after the EVENT_COLUMNS header,
+            while passing them on to the caller, so that the intermediate file can
+            be kept as a by-product of a single pass.
+
+        Arguments:
+            f: file object opened for writing with newline=''
+            rows: iterable of rows
+
+        Returns:
+            Generator of the rows
+    """
+    writer = csv.writer(f, **DIALECT)
+    writer.writerow(EVENT_COLUMNS)
+    for row in rows:
+        writer.writerow(row)
+        yield row
+
+
+def _write_part(args):
+    """
+        Description: Projects one daily event file into a headerless part file,
+            in a worker process.
+
+        Arguments:
+            args: tuple (event data file path, part file path)
+
+        Returns:
+            Tuple: (part file path, number of rows written)
+    """
+    filepath, part = args
+    with open(part, 'w', encoding='utf8', newline='') as f:
+        return part, write_rows(f, project_rows(filepath), header=False)
+
+
+def merge_event_files(file_path_list, output, workers=1):
+    """
+        Description: This function is responsible for
+            - streaming the projected rows of the daily event files into a single CSV
+              file, so that memory does not grow with the number of events,
+            - with `workers` above 1, projecting the files into part files in a pool
+              of worker processes and concatenating the parts in file order.
+
+        Arguments:
+            file_path_list: event data file paths
+            output: path of the consolidated CSV file, e.g. event_datafile_new.csv
+            workers: number of worker processes
+
+        Returns:
+            Integer: number of rows written, without the header
+    """
+    with open(output, 'w', encoding='utf8', newline='') as f:
+        if workers <= 1:
+            return write_rows(f, iter_event_rows(file_path_list))
+
+        write_rows(f, [])
+        num_rows = 0
+        with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(output))) as parts, \
+                multiprocessing.Pool(workers) as pool:
+            tasks = [(filepath, os.path.join(parts, '{}.csv'.format(i)))
+                     for i, filepath in enumerate(file_path_list)]
+
+            # parts come back in file order and are removed once they are copied
+            for part, part_rows in pool.imap(_write_part, tasks):
+                f.flush()
+                with open(part, 'r', encoding='utf8', newline='') as p:
+                    shutil.copyfileobj(p, f)
+                os.remove(part)
+                num_rows += part_rows
+        return num_rows
+
+
+def main():
+    """
+    Description:
+        - Lists the daily event CSV files.
+        - Streams their song play rows, projected on EVENT_COLUMNS, into the
+          consolidated event_datafile_new.csv.
+
+    Usage:
+        python event_data.py --workers 4
+    """
+    parser = argparse.ArgumentParser(description='Consolidate the daily event CSV files into one CSV file.')
+    parser.add_argument('--event-dir', default='event_data',
+                        help='directory of the daily event CSV files (default: %(default)s)')
+    parser.add_argument('--output', default='event_datafile_new.csv',
+                        help='consolidated CSV file (default: %(default)s)')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of processes projecting files in parallel (default: 1)')
+    args = parser.parse_args()
+
+    file_path_list = get_event_files(args.event_dir)
+    print('{} files found in {}'.format(len(file_path_list), args.event_dir))
+
+    num_rows = merge_event_files(file_path_list, args.output, args.workers)
+    print('{} rows written to {}'.format(num_rows, args.output))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+import collections
+from cassandra.query import BatchStatement, BatchType
+
+
+# number of partitions of a table grouped at once, the oldest is sent when it is exceeded
+MAX_OPEN_PARTITIONS = 1000
+
+
+class PartitionBatcher:
+    """
+        Description: Groups the rows of a table by partition key and sends each group
+            as an unlogged batch of at most `max_size` inserts. A batch never spans
+            several partitions, so its coordinator is a replica of the partition
+            and writes it in a single mutation.
+
+            Rows are kept in at most `max_open` open partitions; the partition
+            opened first is sent when another one has to be opened. The size of
+            every statement sent is counted in `histogram`.
+    """
+
+    def __init__(self, prepared, key_size, max_size, max_open=MAX_OPEN_PARTITIONS):
+        if max_size < 1:
+            raise ValueError('max_size must be at least 1, not {}'.format(max_size))
+
+        self.prepared = prepared
+        self.key_size = key_size
+        self.max_size = max_size
+        self.max_open = max_open
+        self.partitions = {}
+        self.histogram = collections.Counter()
+
+    def add(self, values):
+        """
+            Description: Adds the values of an insert to the group of their partition.
+
+            Arguments:
+                values: tuple of values of the insert, starting with the partition key
+
+            Returns:
+                List of (statement, parameters) tuples ready to be executed
+        """
+        if self.max_size == 1:
+            self.histogram[1] += 1
+            return [(self.prepared, values)]
+
+        key = values[:self.key_size]
+        ready = []
+        if key not in self.partitions and len(self.partitions) >= self.max_open:
+            ready.append(self._statement(self.partitions.pop(next(iter(self.partitions)))))
+
+        rows = self.partitions.setdefault(key, [])
+        rows.append(values)
+        if len(rows) >= self.max_size:
+            ready.append(self._statement(self.partitions.pop(key)))
+        return ready
+
+    def flush(self):
+        """
+            Description: Sends the groups of every open partition.
+
+            Arguments:
+                None
+
+            Returns:
+                List of (statement, parameters) tuples ready to be executed
+        """
+        ready = [self._statement(rows) for rows in self.partitions.values()]
+        self.partitions.clear()
+        return ready
+
+    def _statement(self, rows):
+        self.histogram[len(rows)] += 1
+        if len(rows) == 1:
+            return self.prepared, rows[0]
+
+        batch = BatchStatement(batch_type=BatchType.UNLOGGED)
+        for values in rows:
+            batch.add(self.prepared, values)
+        return batch, None
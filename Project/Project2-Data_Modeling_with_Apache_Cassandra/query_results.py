@@ -0,0 +1,60 @@
+import copy
+import pandas as pd
+from cassandra.query import SimpleStatement, PreparedStatement, BoundStatement
+
+
+# number of rows fetched per page
+FETCH_SIZE = 5000
+
+# dtype pandas infers for the values of a CQL type, given to the columns of an empty result
+CQL_DTYPES = {'tinyint': 'int64', 'smallint': 'int64', 'int': 'int64', 'bigint': 'int64', 'counter': 'int64',
+              'float': 'float64', 'double': 'float64', 'boolean': 'bool', 'timestamp': 'datetime64[ns]',
+              'text': str, 'varchar': str, 'ascii': str}
+
+
+def fetch_frame(session, query, parameters=None, fetch_size=FETCH_SIZE, columns=None):
+    """
+        Description: This function is responsible for
+            - executing a query and paging through its result `fetch_size` rows at a time,
+            - appending the values of each page column by column,
+            - building the DataFrame once, after the last page, instead of
+              appending a row to it for each row returned.
+
+            Only one page of rows is held at a time next to the columns being built.
+            A statement passed in is left untouched, the fetch size is set on a copy.
+
+        Arguments:
+            session: the session object
+            query: CQL query string, or a prepared or simple statement
+            parameters: values bound to the query, or None
+            fetch_size: number of rows fetched per page
+            columns: column names of the DataFrame, None takes them from the result
+
+        Returns:
+            DataFrame of the rows returned, typed from the result metadata when empty
+    """
+    if isinstance(query, str):
+        statement = SimpleStatement(query, fetch_size=fetch_size)
+    elif isinstance(query, PreparedStatement):
+        statement = BoundStatement(query, fetch_size=fetch_size).bind(parameters or ())
+        parameters = None
+    else:
+        statement = copy.copy(query)
+        statement.fetch_size = fetch_size
+
+    result = session.execute(statement, parameters)
+    columns = list(columns or result.column_names or [])
+    types = result.column_types or [None] * len(columns)
+    values = [[] for column in columns]
+
+    while True:
+        for column, page_values in zip(values, zip(*result.current_rows)):
+            column.extend(page_values)
+        if not result.has_more_pages:
+            break
+        result.fetch_next_page()
+
+    if not any(values):
+        return pd.DataFrame({column: pd.Series(dtype=CQL_DTYPES.get(getattr(cql_type, 'typename', None), object))
+                             for column, cql_type in zip(columns, types)}, columns=columns)
+    return pd.DataFrame(dict(zip(columns, values)), columns=columns)
@@ -2,7 +2,10 @@ import pandas as pd
 import boto3
 from botocore.exceptions import ClientError
 import json
-import configparser
+import time
+import argparse
+import concurrent.futures
+from dwh_config import read_config
 import botocore.exceptions
 
 ######################## Getter functions ################################# 
@@ -17,8 +20,7 @@ def get_AWS_credential():
             Index 0: access key id 
             Index 1: secret
     """
-    config = configparser.ConfigParser()
-    config.read_file(open('dwh.cfg'))
+    config = read_config()
     return [config.get('AWS','KEY'), config.get('AWS','SECRET')]
 
 def get_iam_role_name():
@@ -31,8 +33,7 @@ def get_iam_role_name():
         String: IAM ROLE NAME 
     """
     # Open configuration file 
-    config = configparser.ConfigParser()
-    config.read_file(open('dwh.cfg'))
+    config = read_config()
 
     return config.get("CLUSTER", "DB_IAM_ROLE_NAME")
 
@@ -54,8 +55,7 @@ def get_DB_config():
                   DB_PORT
                   DB_REGION
     """
-    config = configparser.ConfigParser()
-    config.read_file(open('dwh.cfg')) 
+    config = read_config()
 
     db_dict = {}
     settings = ["DB_CLUSTER_TYPE",
@@ -116,22 +116,27 @@ def create_client_resource (service, type):
 def create_iam_role (iam_client):
     """
     Description:
-        Create a new IAM role
+        Create a new IAM role, or return the existing role of the same name
     Arguments:
         Iam_client: client representing IAM service
     Return:
         Dict
     """
-    role = iam_client.create_role( 
-            Path='/',
-            RoleName= get_iam_role_name(),
-            Description = "Allows Redshift clusters to call AWS services on your behalf.",
-            AssumeRolePolicyDocument=json.dumps(
-                {'Statement': [{'Action': 'sts:AssumeRole',
-                 'Effect': 'Allow',
-                 'Principal': {'Service': 'redshift.amazonaws.com'}}],
-                 'Version': '2012-10-17'})
-                )    
+    try:
+        role = iam_client.create_role( 
+                Path='/',
+                RoleName= get_iam_role_name(),
+                Description = "Allows Redshift clusters to call AWS services on your behalf.",
+                AssumeRolePolicyDocument=json.dumps(
+                    {'Statement': [{'Action': 'sts:AssumeRole',
+                     'Effect': 'Allow',
+                     'Principal': {'Service': 'redshift.amazonaws.com'}}],
+                     'Version': '2012-10-17'})
+                    )    
+    except ClientError as error:
+        if error.response['Error']['Code'] != 'EntityAlreadyExists':
+            raise
+        role = iam_client.get_role(RoleName=get_iam_role_name())
     return role
     
 def attach_policy (iam_client):
@@ -148,32 +153,40 @@ def attach_policy (iam_client):
                                  )['ResponseMetadata']['HTTPStatusCode']
 
 
-def create_redshift_cluster (iam_client, redshift_client):
+def create_redshift_cluster (iam_client, redshift_client, security_group_ids=None):
     """
     Description:
-        Creates a new Redshift cluster.
+        Creates a new Redshift cluster, or returns the existing cluster of the same identifier.
     Arguments:
         Iam_client: client representing IAM service
         Redshift_client: client representing Redshift service
+        Security_group_ids: list, VPC security groups of the cluster, None for the default one
     Return:
         Dict
     """
     db_config = get_DB_config()
-    response = redshift_client.create_cluster(        
-                                            #HW
-                                            ClusterType= db_config["DB_CLUSTER_TYPE"],
-                                            NodeType=db_config["DB_NODE_TYPE"],
-                                            NumberOfNodes=int(db_config["DB_NUM_NODES"]),
-
-                                            #Identifiers & Credentials
-                                            DBName=db_config["DB_NAME"],
-                                            ClusterIdentifier=db_config["DB_CLUSTER_IDENTIFIER"],
-                                            MasterUsername=db_config["DB_USER"],
-                                            MasterUserPassword=db_config["DB_PASSWORD"],
+    options = {'VpcSecurityGroupIds': security_group_ids} if security_group_ids else {}
+    try:
+        response = redshift_client.create_cluster(        
+                                                #HW
+                                                ClusterType= db_config["DB_CLUSTER_TYPE"],
+                                                NodeType=db_config["DB_NODE_TYPE"],
+                                                NumberOfNodes=int(db_config["DB_NUM_NODES"]),
+
+                                                #Identifiers & Credentials
+                                                DBName=db_config["DB_NAME"],
+                                                ClusterIdentifier=db_config["DB_CLUSTER_IDENTIFIER"],
+                                                MasterUsername=db_config["DB_USER"],
+                                                MasterUserPassword=db_config["DB_PASSWORD"],
         
-                                            #Roles (for s3 access)
-                                            IamRoles=[get_ARN(iam_client)]  
-                                            )
+                                                #Roles (for s3 access)
+                                                IamRoles=[get_ARN(iam_client)],
+                                                **options
+                                                )
+    except ClientError as error:
+        if error.response['Error']['Code'] != 'ClusterAlreadyExists':
+            raise
+        response = {'Cluster': describe_cluster(redshift_client)}
     return response
 
 def wait_cluster_available(redshift_client):
@@ -234,38 +247,192 @@ def write_endpoint_arn(redshift_client):
         file.write(new)
         file.close()
 
-def open_tcp(ec2_client, redshift_client):
+    # the stages run after this one in the same process read the cached configuration
+    config = read_config()
+    config.set('CLUSTER', 'HOST', rdshift['Endpoint']['Address'])
+    config.set('IAM_ROLE', 'ARN', rdshift['IamRoles'][0]['IamRoleArn'])
+
+def default_vpc_id(ec2_client):
     """
     Description:
-        Add an ingress rules to defult security group to get an access to the Redshift cluster.
+        Returns the id of the default VPC of the region, the VPC of a cluster created without subnet group.
     Arguments:
-        EC2_client: client representing EC2 sevice
-        Redshift_client: client representing Redshift service 
+        EC2_client: resource representing EC2 sevice
     Return:
-        None
+        String: VPC id
     """
+    return list(ec2_client.vpcs.filter(Filters=[{'Name': 'isDefault', 'Values': ['true']}]))[0].id
+
+def authorize_port(ec2_client, vpc_id):
+    """
+    Description:
+        Add an ingress rule for the port of the cluster to the default security group of a VPC,
+        unless it already has one.
+    Arguments:
+        EC2_client: resource representing EC2 sevice
+        Vpc_id: str, id of the VPC
+    Return:
+        String: id of the security group
+    """
+    db_config = get_DB_config()
+    vpc = ec2_client.Vpc(id=vpc_id)
+    defaultSg = list(vpc.security_groups.filter(Filters=[{'Name': 'group-name', 'Values': ['default']}]))[0]
     try:
-        rdshift = describe_cluster(redshift_client)
-        db_config = get_DB_config()
-        vpc = ec2_client.Vpc(id=rdshift['VpcId'])
-        defaultSg = list(vpc.security_groups.all())[0]
         defaultSg.authorize_ingress(
-                GroupName=defaultSg.group_name,
                 CidrIp='0.0.0.0/0',
                 IpProtocol='TCP',
                 FromPort=int(db_config['DB_PORT']),
                 ToPort=int(db_config['DB_PORT'])
         )
     except botocore.exceptions.ClientError as error:
-        if error.response['Error']['Code'] == 'InvalidPermission.Duplicate':
-            pass
+        if error.response['Error']['Code'] != 'InvalidPermission.Duplicate':
+            raise
+    return defaultSg.id
+
+def open_tcp(ec2_client, redshift_client):
+    """
+    Description:
+        Add an ingress rules to defult security group to get an access to the Redshift cluster.
+    Arguments:
+        EC2_client: client representing EC2 sevice
+        Redshift_client: client representing Redshift service 
+    Return:
+        None
+    """
+    rdshift = describe_cluster(redshift_client)
+    authorize_port(ec2_client, rdshift.get('VpcId') or default_vpc_id(ec2_client))
+
+def poll_cluster_available(redshift_client, progress=None, delay=5, max_delay=60, timeout=1800, sleep=time.sleep):
+    """
+    Description:
+        Wait for Redshift cluster to be created, polling its status with exponential backoff:
+        the delay between two polls doubles from `delay` up to `max_delay`.
+    Arguments:
+        Redshift_client: client representing Redshift service 
+        Progress: function called with the step, the status and the seconds elapsed at each poll
+        Delay: seconds before the second poll
+        Max_delay: longest delay between two polls
+        Timeout: seconds after which to give up
+        Sleep: function waiting a number of seconds
+    Return:
+        Dict: properties of the available cluster
+    """
+    start = time.monotonic()
+    waited = 0
+    while True:
+        cluster = describe_cluster(redshift_client)
+        # the seconds slept count even when `sleep` does not really sleep, e.g. against moto
+        elapsed = max(time.monotonic() - start, waited)
+        if progress is not None:
+            progress('cluster', cluster['ClusterStatus'], elapsed)
+        if cluster['ClusterStatus'] == 'available' and cluster.get('Endpoint'):
+            return cluster
+        if elapsed + delay > timeout:
+            raise TimeoutError('cluster {} not available after {:.0f}s'.format(cluster['ClusterIdentifier'], elapsed))
+        sleep(delay)
+        waited += delay
+        delay = min(delay * 2, max_delay)
+
+def print_progress(step, status, elapsed):
+    """
+    Description:
+        Default progress callback, prints a step of the provisioning.
+    Arguments:
+        Step: str, iam, network or cluster
+        Status: str, status of the step
+        Elapsed: float, seconds since the step started
+    Return:
+        None
+    """
+    print("{:<8} {:<12} {:6.0f}s".format(step, status, elapsed))
+
+def setup_iam_role(iam_client, progress=None):
+    """
+    Description:
+        Create the IAM role, or reuse it, and attach the S3 read policy to it.
+    Arguments:
+        Iam_client: client representing IAM service
+        Progress: function called with the step, the status and the seconds elapsed
+    Return:
+        String: ARN of the role
+    """
+    start = time.monotonic()
+    create_iam_role(iam_client)
+    attach_policy(iam_client)
+    if progress is not None:
+        progress('iam', 'ready', time.monotonic() - start)
+    return get_ARN(iam_client)
+
+def setup_network(ec2_client, progress=None):
+    """
+    Description:
+        Open the port of the cluster on the default security group of the default VPC.
+    Arguments:
+        EC2_client: resource representing EC2 sevice
+        Progress: function called with the step, the status and the seconds elapsed
+    Return:
+        String: id of the security group
+    """
+    start = time.monotonic()
+    group_id = authorize_port(ec2_client, default_vpc_id(ec2_client))
+    if progress is not None:
+        progress('network', 'ready', time.monotonic() - start)
+    return group_id
+
+def provision(ec2, iam, redshift, progress=print_progress, timeout=1800):
+    """
+    Description:
+        Provision the cluster without blocking on each step in turn:
+            - the IAM role and the security group are set up concurrently,
+            - the cluster is created in that security group with that role,
+            - its status is polled with exponential backoff until it is available,
+            - its endpoint and role ARN are written to dwh.cfg.
+        Resources that already exist are reused, so that provisioning can be run again.
+    Arguments:
+        EC2: resource representing EC2 sevice
+        Iam: client representing IAM service
+        Redshift: client representing Redshift service
+        Progress: function called with the step, the status and the seconds elapsed
+        Timeout: seconds to wait for the cluster
+    Return:
+        Dict: properties of the available cluster
+    """
+    with concurrent.futures.ThreadPoolExecutor(2) as executor:
+        role = executor.submit(setup_iam_role, iam, progress)
+        network = executor.submit(setup_network, ec2, progress)
+        role.result()
+        group_id = network.result()
+
+    create_redshift_cluster(iam, redshift, security_group_ids=[group_id])
+    cluster = poll_cluster_available(redshift, progress, timeout=timeout)
+    write_endpoint_arn(redshift)
+    return cluster
 
 def main():
+    """
+    Description:
+        Creates the IAM role, the Redshift cluster and the ingress rule of its port, and writes
+        its endpoint and role ARN to dwh.cfg.
+    Usage:
+        python create_cluster.py
+        python create_cluster.py --sequential
+    """
+    parser = argparse.ArgumentParser(description='Create the Redshift cluster.')
+    parser.add_argument('--sequential', action='store_true',
+                        help='run the steps one after the other, waiting with the boto3 waiter')
+    parser.add_argument('--timeout', type=float, default=1800,
+                        help='seconds to wait for the cluster (default: %(default)s)')
+    args = parser.parse_args()
 
     print("Create clients for IAM, EC2, and Redshift")
     ec2 = create_client_resource('ec2', 'resource')   
     iam = create_client_resource('iam', 'client')
     redshift = create_client_resource('redshift', 'client')
+
+    if not args.sequential:
+        print("Set up IAM role and network, create redshift cluster")
+        provision(ec2, iam, redshift, timeout=args.timeout)
+        return
     
     print("Create IAM role")
     create_iam_role(iam) 
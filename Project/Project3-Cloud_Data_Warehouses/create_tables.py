@@ -1,56 +1,71 @@
-import configparser
-import psycopg2
+import argparse
 from sql_queries import create_table_queries, drop_table_queries
+from local_warehouse import LocalWarehouse, translate
+from dwh_config import read_config
+from db import ConnectionPool, connection_string, transaction
 
 
-def drop_tables(cur, conn):
+def drop_tables(cur, local=False):
     """
-        Description: This function is responsible for droping tables.
+        Description: This function is responsible for droping tables, in the transaction of the cursor.
 
         Arguments:
             cur: the cursor object
-            conn: the connection object
-        
+            local: translate the statements for the local PostgreSQL stand-in
+
         Returns:
             None
     """
     for query in drop_table_queries:
-        cur.execute(query)
-        conn.commit()
+        cur.execute(translate(query) if local else query)
 
 
-def create_tables(cur, conn):
+def create_tables(cur, local=False):
     """
-        Description: This function is responsible for creating tables.
+        Description: This function is responsible for creating tables, in the transaction of the cursor.
 
         Arguments:
             cur: the cursor object
-            conn: the connection object
-        
+            local: translate the statements for the local PostgreSQL stand-in
+
         Returns:
             None
     """
     for query in create_table_queries:
-        cur.execute(query)
-        conn.commit()
+        cur.execute(translate(query) if local else query)
 
 
 def main():
-    config = configparser.ConfigParser()
-    config.read('dwh.cfg')
+    parser = argparse.ArgumentParser(description='Drop and create the staging tables and the star schema.')
+    parser.add_argument('--incremental', action='store_true',
+                        help='keep the existing tables and the etl_loaded_objects state, only create missing tables')
+    parser.add_argument('--local', action='store_true',
+                        help='create the tables in the local PostgreSQL stand-in instead of Redshift')
+    parser.add_argument('--statement-timeout', type=float, default=0,
+                        help='seconds after which a statement is cancelled, 0 for no limit (default: %(default)s)')
+    args = parser.parse_args()
 
-    print("Connect to the redshift")
-    conn = psycopg2.connect("host={} dbname={} user={} password={} port={}".format(*config['CLUSTER'].values()))
-    cur = conn.cursor()
+    if args.local:
+        print("Connect to the local stand-in")
+        warehouse = LocalWarehouse()
+        warehouse.create_database()
+        dsn = warehouse.dsn
+    else:
+        print("Connect to the redshift")
+        dsn = connection_string(read_config())
+    pool = ConnectionPool(dsn, statement_timeout=args.statement_timeout)
 
-    print("Drop tables")
-    drop_tables(cur, conn)
+    # the tables are dropped and created in one transaction, a failed run leaves the previous tables
+    with pool.connection() as conn, transaction(conn) as cur:
+        if not args.incremental:
+            print("Drop tables")
+            drop_tables(cur, args.local)
 
-    print("Create tables")
-    create_tables(cur, conn)
+        print("Create tables")
+        create_tables(cur, args.local)
 
-    conn.close()
+    pool.closeall()
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
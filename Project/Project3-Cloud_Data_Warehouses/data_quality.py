@@ -0,0 +1,224 @@
+import time
+import argparse
+import concurrent.futures
+from local_warehouse import LocalWarehouse, DATA_DIR, translate
+from dwh_config import read_config
+from db import ConnectionPool, connection_string
+
+
+# CHECK QUERIES, each returns one number: the rows of a table, or the rows breaking a rule
+
+row_count_select = "SELECT COUNT(*) FROM {table};"
+
+null_keys_select = "SELECT COUNT(*) FROM {table} WHERE {condition};"
+
+# rows of a fact table whose key is set but not found in the dimension table
+orphans_select = ("""SELECT COUNT(*)
+                     FROM {table} f
+                     LEFT JOIN {ref_table} d
+                     ON (f.{column} = d.{ref_column})
+                     WHERE f.{column} IS NOT NULL
+                       AND d.{ref_column} IS NULL;""")
+
+duplicates_select = ("""SELECT COUNT(*)
+                        FROM (SELECT {columns}
+                              FROM {table}
+                              GROUP BY {columns}
+                              HAVING COUNT(*) > 1) d;""")
+
+# 1 when the latest row of a table is older than the latest row of the table it is loaded from;
+# an empty source, e.g. staging tables emptied by an incremental run without new objects, is fresh
+freshness_select = ("""SELECT CASE WHEN (SELECT MAX({source_column}) FROM {source}) IS NULL
+                                   THEN 0
+                                   WHEN (SELECT MAX({column}) FROM {table}) >= (SELECT MAX({source_column}) FROM {source})
+                                   THEN 0 ELSE 1 END;""")
+
+
+# CHECKS, run after the star schema is inserted
+
+CHECKS = [
+    {'name': 'songplays_rows', 'kind': 'row_count', 'table': 'songplays', 'min_rows': 1},
+    {'name': 'users_rows', 'kind': 'row_count', 'table': 'users', 'min_rows': 1},
+    {'name': 'songs_rows', 'kind': 'row_count', 'table': 'songs', 'min_rows': 1},
+    {'name': 'artists_rows', 'kind': 'row_count', 'table': 'artists', 'min_rows': 1},
+    {'name': 'time_rows', 'kind': 'row_count', 'table': 'time', 'min_rows': 1},
+
+    {'name': 'songplays_null_keys', 'kind': 'null_keys', 'table': 'songplays', 'columns': ['start_time', 'user_id']},
+    {'name': 'users_null_keys', 'kind': 'null_keys', 'table': 'users', 'columns': ['user_id']},
+    {'name': 'songs_null_keys', 'kind': 'null_keys', 'table': 'songs', 'columns': ['song_id', 'artist_id']},
+    {'name': 'artists_null_keys', 'kind': 'null_keys', 'table': 'artists', 'columns': ['artist_id']},
+    {'name': 'time_null_keys', 'kind': 'null_keys', 'table': 'time', 'columns': ['start_time']},
+
+    {'name': 'songplays_orphan_songs', 'kind': 'orphans', 'table': 'songplays', 'column': 'song_id',
+     'ref_table': 'songs', 'ref_column': 'song_id'},
+    {'name': 'songplays_orphan_artists', 'kind': 'orphans', 'table': 'songplays', 'column': 'artist_id',
+     'ref_table': 'artists', 'ref_column': 'artist_id'},
+    {'name': 'songplays_orphan_users', 'kind': 'orphans', 'table': 'songplays', 'column': 'user_id',
+     'ref_table': 'users', 'ref_column': 'user_id'},
+    {'name': 'songplays_orphan_times', 'kind': 'orphans', 'table': 'songplays', 'column': 'start_time',
+     'ref_table': 'time', 'ref_column': 'start_time'},
+
+    {'name': 'songplays_duplicates', 'kind': 'duplicates', 'table': 'songplays', 'columns': ['songplay_id']},
+    {'name': 'users_duplicates', 'kind': 'duplicates', 'table': 'users', 'columns': ['user_id']},
+    {'name': 'songs_duplicates', 'kind': 'duplicates', 'table': 'songs', 'columns': ['song_id']},
+    {'name': 'artists_duplicates', 'kind': 'duplicates', 'table': 'artists', 'columns': ['artist_id']},
+    {'name': 'time_duplicates', 'kind': 'duplicates', 'table': 'time', 'columns': ['start_time']},
+
+    {'name': 'songplays_freshness', 'kind': 'freshness', 'table': 'songplays', 'column': 'start_time',
+     'source': "staging_events WHERE page = 'NextSong'", 'source_column': 'ts'},
+]
+
+
+class DataQualityError(Exception):
+    """
+        Description: Raised when a check fails, with the results of the checks that ran.
+    """
+
+    def __init__(self, results):
+        failed = [result['name'] for result in results if not result['passed']]
+        super().__init__('data quality checks failed: {}'.format(', '.join(failed)))
+        self.results = results
+
+
+def compile_check(check):
+    """
+        Description: Compiles a check into the SQL query computing it on the warehouse.
+
+        Arguments:
+            check: dict of CHECKS
+
+        Returns:
+            String: query returning one number
+    """
+    kind = check['kind']
+    if kind == 'row_count':
+        return row_count_select.format(**check)
+    if kind == 'null_keys':
+        return null_keys_select.format(table=check['table'],
+                                       condition=' OR '.join('{} IS NULL'.format(column) for column in check['columns']))
+    if kind == 'orphans':
+        return orphans_select.format(**check)
+    if kind == 'duplicates':
+        return duplicates_select.format(table=check['table'], columns=', '.join(check['columns']))
+    if kind == 'freshness':
+        return freshness_select.format(**check)
+    raise ValueError('unknown check kind {!r} of {}'.format(kind, check['name']))
+
+
+def passed(check, value):
+    """
+        Description: Tells whether the number computed by a check is acceptable: at
+            least `min_rows` for row counts, no offending row for the other checks.
+
+        Arguments:
+            check: dict of CHECKS
+            value: number returned by the query of the check
+
+        Returns:
+            Boolean
+    """
+    if check['kind'] == 'row_count':
+        return value >= check.get('min_rows', 1)
+    return value == 0
+
+
+def run_check(pool, check, warehouse=None):
+    """
+        Description: Runs the query of a check on a connection of the pool.
+
+        Arguments:
+            pool: ConnectionPool
+            check: dict of CHECKS
+            warehouse: LocalWarehouse stand-in, or None for the Redshift cluster
+
+        Returns:
+            Dict: name, value, passed and seconds of the check
+    """
+    query = compile_check(check)
+    with pool.connection() as conn:
+        cur = conn.cursor()
+        start = time.perf_counter()
+        cur.execute(query if warehouse is None else translate(query))
+        value, = cur.fetchone()
+        seconds = time.perf_counter() - start
+        conn.commit()
+    return {'name': check['name'], 'value': value, 'passed': passed(check, value), 'seconds': seconds}
+
+
+def run_checks(pool, checks=CHECKS, workers=4, warehouse=None, fail_fast=True):
+    """
+        Description: This function is responsible for running checks concurrently,
+        each as one query on a connection of the pool, and printing their results.
+        With `fail_fast`, the checks not started yet are cancelled at the first failure.
+
+        Arguments:
+            pool: ConnectionPool of at least `workers` connections
+            checks: list of dicts, see CHECKS
+            workers: number of checks running at once
+            warehouse: LocalWarehouse stand-in, or None for the Redshift cluster
+            fail_fast: stop at the first failed check
+
+        Returns:
+            List of dicts: results of the checks that ran, in the order of `checks`
+
+        Raises:
+            DataQualityError: when a check failed
+    """
+    order = {check['name']: i for i, check in enumerate(checks)}
+    results = []
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        futures = [executor.submit(run_check, pool, check, warehouse) for check in checks]
+        for future in concurrent.futures.as_completed(futures):
+            if future.cancelled():
+                continue
+            result = future.result()
+            results.append(result)
+            print("{:<28} {:<6} {:>10} {:8.4f}s".format(result['name'], 'ok' if result['passed'] else 'FAILED',
+                                                       result['value'], result['seconds']))
+            if fail_fast and not result['passed']:
+                for pending in futures:
+                    pending.cancel()
+
+    results.sort(key=lambda result: order[result['name']])
+    if not all(result['passed'] for result in results):
+        raise DataQualityError(results)
+    return results
+
+
+def main():
+    """
+    Description:
+        - Runs the data quality checks of the star schema concurrently.
+        - Prints the value and the time of each check, and exits with an error when one fails.
+
+    Usage:
+        python data_quality.py
+        python data_quality.py --local --workers 8 --no-fail-fast
+    """
+    parser = argparse.ArgumentParser(description='Check the star schema.')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='number of checks running at once, each on its own connection (default: %(default)s)')
+    parser.add_argument('--no-fail-fast', dest='fail_fast', action='store_false',
+                        help='run every check rather than stopping at the first failure')
+    parser.add_argument('--statement-timeout', type=float, default=0,
+                        help='seconds after which a check is cancelled, 0 for no limit (default: %(default)s)')
+    parser.add_argument('--local', action='store_true',
+                        help='check the local PostgreSQL stand-in instead of Redshift')
+    args = parser.parse_args()
+
+    warehouse = LocalWarehouse(DATA_DIR) if args.local else None
+    dsn = warehouse.dsn if args.local else connection_string(read_config())
+    pool = ConnectionPool(dsn, maxconn=args.workers, statement_timeout=args.statement_timeout)
+
+    start = time.perf_counter()
+    try:
+        results = run_checks(pool, workers=args.workers, warehouse=warehouse, fail_fast=args.fail_fast)
+    except DataQualityError as error:
+        parser.exit(1, '{}\n'.format(error))
+    finally:
+        pool.closeall()
+    print("{} checks passed in {:.2f}s".format(len(results), time.perf_counter() - start))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+import contextlib
+import psycopg2
+import psycopg2.pool
+import psycopg2.extensions
+
+
+def connection_string(config):
+    """
+        Description: Builds the connection string of the Redshift cluster from the
+            [CLUSTER] section of dwh.cfg, by name rather than by position.
+
+        Arguments:
+            config: ConfigParser of dwh.cfg
+
+        Returns:
+            String: connection string
+    """
+    cluster = config['CLUSTER']
+    return "host={} dbname={} user={} password={} port={}".format(
+        *(cluster.get(key).strip() for key in ('HOST', 'DB_NAME', 'DB_USER', 'DB_PASSWORD', 'DB_PORT')))
+
+
+@contextlib.contextmanager
+def transaction(conn):
+    """
+        Description: Groups statements into one transaction: commits once they all
+            succeed, rolls back if one of them fails.
+
+        Arguments:
+            conn: the connection object
+
+        Returns:
+            Context manager yielding a cursor
+    """
+    cur = conn.cursor()
+    try:
+        yield cur
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+
+
+class ConnectionPool:
+    """
+        Description: Pool of connections shared by the stages and threads of a run.
+            A connection is checked when it is taken from the pool, by setting its
+            statement timeout, and replaced when the check fails, e.g. after the
+            cluster closed an idle connection.
+    """
+
+    def __init__(self, dsn, maxconn=1, statement_timeout=0):
+        """
+            Arguments:
+                dsn: connection string
+                maxconn: maximum number of connections open at once
+                statement_timeout: seconds after which a statement is cancelled, 0 for no limit
+        """
+        self.pool = psycopg2.pool.ThreadedConnectionPool(1, maxconn, dsn)
+        self.statement_timeout = statement_timeout
+
+    def _check(self, conn):
+        # the SET is a round trip to the server as well
+        cur = conn.cursor()
+        cur.execute("SET statement_timeout TO %s", (int(self.statement_timeout * 1000),))
+        cur.close()
+        conn.commit()
+
+    def getconn(self):
+        """
+            Description: Takes a healthy connection from the pool, opening a new one
+                in place of a broken one.
+
+            Arguments:
+                None
+
+            Returns:
+                the connection object
+        """
+        conn = self.pool.getconn()
+        try:
+            self._check(conn)
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            self.pool.putconn(conn, close=True)
+            conn = self.pool.getconn()
+            self._check(conn)
+        return conn
+
+    def putconn(self, conn):
+        """
+            Description: Gives a connection back to the pool, rolling back what it
+                left uncommitted.
+
+            Arguments:
+                conn: the connection object
+
+            Returns:
+                None
+        """
+        if not conn.closed and conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            conn.rollback()
+        self.pool.putconn(conn, close=bool(conn.closed))
+
+    @contextlib.contextmanager
+    def connection(self):
+        """
+            Description: Lends a connection of the pool for the duration of a block.
+
+            Arguments:
+                None
+
+            Returns:
+                Context manager yielding the connection object
+        """
+        conn = self.getconn()
+        try:
+            yield conn
+        finally:
+            self.putconn(conn)
+
+    def closeall(self):
+        self.pool.closeall()
@@ -0,0 +1,27 @@
+import configparser
+
+
+CONFIG_FILE = 'dwh.cfg'
+
+# path -> configuration read from it, each file is read once per process
+_configs = {}
+
+
+def read_config(path=CONFIG_FILE):
+    """
+        Description: Reads a configuration file the first time it is asked for, and
+            returns the same parser on later calls, so that every stage of a run
+            sees the values written by the stages before it.
+
+        Arguments:
+            path: configuration file path
+
+        Returns:
+            ConfigParser
+    """
+    if path not in _configs:
+        config = configparser.ConfigParser()
+        with open(path) as f:
+            config.read_file(f)
+        _configs[path] = config
+    return _configs[path]
@@ -1,58 +1,416 @@
-import configparser
+import time
+import argparse
+import concurrent.futures
+import boto3
 import psycopg2
-from sql_queries import copy_table_queries, insert_table_queries
+from psycopg2.extras import execute_values
+from sql_queries import (copy_parameters, render, copy_table_query_map, insert_table_query_map, table_dependencies, staging_clear_query_map,
+                         staging_raw_create_query_map, staging_insert_query_map, staging_raw_drop_query_map,
+                         songplay_match_rate_select, songplay_incremental_match_rate_select, upsert_table_query_map,
+                         merge_table_query_map, table_swap_prepare_queries, table_swap_queries,
+                         load_state_select, load_state_insert)
+from local_warehouse import LocalWarehouse, DATA_DIR, translate
+from dwh_config import read_config
+from db import ConnectionPool, connection_string, transaction
+from data_quality import run_checks
+import load_metrics
+from s3_manifest import S3ManifestSource, parse_s3_url
 
 
-def load_staging_tables(cur, conn):
+# ways of merging the staging tables into the star schema
+MERGE_MODES = ('delete-insert', 'swap')
+
+
+def load_table(cur, table, query, warehouse=None, metrics=None):
+    """
+        Description: This function is responsible for running the statement loading a table,
+        on the Redshift cluster or translated for the local stand-in.
+
+        Arguments:
+            cur: the cursor object
+            table: name of the table the statement loads
+            query: the statement, or a list of statements run in order
+            warehouse: LocalWarehouse stand-in, or None for the Redshift cluster
+            metrics: list the rows, bytes, time and rejected rows of each statement are
+                     appended to, see `load_metrics`, None to not collect them
+
+        Returns:
+            None
+    """
+    if isinstance(query, list):
+        for statement in query:
+            load_table(cur, table, statement, warehouse, metrics)
+        return
+
+    if metrics is not None and load_metrics.statement_kind(query) not in load_metrics.RECORDED_STATEMENTS:
+        metrics = None
+    start = time.perf_counter()
+    try:
+        if warehouse is None:
+            cur.execute(query)
+            counters = None
+        else:
+            counters = warehouse.execute(cur, table, query)
+    except psycopg2.Error as error:
+        if metrics is not None:
+            metrics.append(load_metrics.collect_error(cur, table, query, time.perf_counter() - start, error,
+                                                      local=warehouse is not None))
+        raise
+    if metrics is not None:
+        metrics.append(load_metrics.collect(cur, table, query, time.perf_counter() - start, counters))
+
+
+def execute_query(cur, query, warehouse=None):
     """
-        Description: This function is responsible for loading values into staging tables in the Redshift cluster.
+        Description: Runs a statement on the Redshift cluster, or translated for the local stand-in.
+
+        Arguments:
+            cur: the cursor object
+            query: the statement
+            warehouse: LocalWarehouse stand-in, or None for the Redshift cluster
+
+        Returns:
+            None
+    """
+    cur.execute(query if warehouse is None else translate(query))
+
+
+def staging_table_queries(table, query, clear=False):
+    """
+        Description: Returns the statements loading a staging table: the COPY into its
+        raw staging table, followed by the insert of the raw rows with the match keys
+        songplays are joined on, so that the rows are distributed on their key as they
+        are written rather than updated once loaded.
+
+        Arguments:
+            table: staging_events or staging_songs
+            query: the COPY statement
+            clear: empty the staging table first
+
+        Returns:
+            List of statements
+    """
+    queries = (staging_raw_create_query_map[table] +
+               [query, staging_insert_query_map[table], staging_raw_drop_query_map[table]])
+    return [staging_clear_query_map[table]] + queries if clear else queries
+
+
+def load_staging_tables(cur, conn, warehouse=None, clear=False, parameters=None, metrics=None):
+    """
+        Description: This function is responsible for loading values into staging tables in the Redshift cluster,
+        and computing their match keys, in one transaction.
 
         Arguments:
             cur: the cursor object
             conn: the connection object
-        
+            warehouse: LocalWarehouse stand-in, or None for the Redshift cluster
+            clear: empty each staging table before loading it, in the same transaction
+            parameters: COPY parameters of the run, see `copy_parameters`
+            metrics: list collecting the metrics of each statement, see `load_table`
+
         Returns:
             None
     """
-    for query in copy_table_queries:
+    for table, query in copy_table_query_map.items():
+        query = render(query, parameters)
         print("Load staging tables: {}".format(query))
-        cur.execute(query)
-        conn.commit()
+        load_table(cur, table, staging_table_queries(table, query, clear), warehouse, metrics)
+    conn.commit()
 
 
-def insert_tables(cur, conn):
+def insert_tables(cur, conn, warehouse=None, metrics=None):
     """
-        Description: This function is responsible for inserting values into 
-        songplays, songs, users, artists, and time tables in the Redshift cluster.
+        Description: This function is responsible for inserting values into
+        songplays, songs, users, artists, and time tables in the Redshift cluster, in one transaction.
 
         Arguments:
             cur: the cursor object
             conn: the connection object
-        
+            warehouse: LocalWarehouse stand-in, or None for the Redshift cluster
+            metrics: list collecting the metrics of each statement, see `load_table`
+
         Returns:
             None
-    """    
-    for query in insert_table_queries:
+    """
+    for table, query in insert_table_query_map.items():
         print("Insert tables: {}".format(query))
-        cur.execute(query)
+        load_table(cur, table, query, warehouse, metrics)
+    conn.commit()
+
+
+def report_match_rate(cur, warehouse=None, incremental=False):
+    """
+        Description: Prints how many plays of the staging tables matched a song; the
+        others are kept in songplays with no song_id and artist_id. The plays are
+        matched on the staging tables, without scanning songplays.
+
+        Arguments:
+            cur: the cursor object
+            warehouse: LocalWarehouse stand-in, or None for the Redshift cluster
+            incremental: match the plays against all loaded songs, as the upsert of an
+                         incremental load does, rather than against staging_songs
+
+        Returns:
+            Tuple: (number of plays, number of plays matching a song)
+    """
+    execute_query(cur, songplay_incremental_match_rate_select if incremental else songplay_match_rate_select,
+                  warehouse)
+    plays, matched = cur.fetchone()
+    print("Songplays: {} of {} plays matched a song ({:.2%})".format(matched, plays, matched / plays if plays else 0))
+    return plays, matched
+
+
+def merge_table_queries(table, mode):
+    """
+        Description: Returns the statements merging the staging tables into a table,
+        so that loading the same staging data again leaves the table unchanged:
+            - delete-insert deletes the rows whose primary key is in the staging
+              tables, (start_time, user_id, session_id) for songplays, and inserts them again,
+            - swap rebuilds the table into <table>_new and renames it over the table.
+
+        Arguments:
+            table: name of a table of the star schema
+            mode: delete-insert or swap
+
+        Returns:
+            List of statements, to be run in one transaction
+    """
+    if mode == 'delete-insert':
+        return list(merge_table_query_map[table])
+    if mode == 'swap':
+        insert = insert_table_query_map[table].replace('INSERT INTO {} '.format(table),
+                                                       'INSERT INTO {}_new '.format(table), 1)
+        return ([query.format(table) for query in table_swap_prepare_queries] + [insert] +
+                [query.format(table) for query in table_swap_queries])
+    raise ValueError('mode must be one of {}, not {!r}'.format(MERGE_MODES, mode))
+
+
+def merge_tables(cur, conn, mode, warehouse=None, metrics=None):
+    """
+        Description: This function is responsible for merging the staging tables into
+        songplays, songs, users, artists, and time tables, one transaction per table.
+
+        Arguments:
+            cur: the cursor object
+            conn: the connection object
+            mode: delete-insert or swap, see `merge_table_queries`
+            warehouse: LocalWarehouse stand-in, or None for the Redshift cluster
+            metrics: list collecting the metrics of each statement, see `load_table`
+
+        Returns:
+            None
+    """
+    for table in insert_table_query_map:
+        print("Merge tables: {} ({})".format(table, mode))
+        load_table(cur, table, merge_table_queries(table, mode), warehouse, metrics)
         conn.commit()
 
 
+def _load_table_on_connection(pool, table, query, warehouse=None, metrics=None):
+    """
+        Description: Loads a table on a connection of the pool, in one transaction.
+
+        Arguments:
+            pool: ConnectionPool
+            table: name of the table
+            query: the statement loading it, or a list of statements
+            warehouse: LocalWarehouse stand-in, or None for the Redshift cluster
+            metrics: list collecting the metrics of each statement, see `load_table`
+
+        Returns:
+            None
+    """
+    with pool.connection() as conn, transaction(conn) as cur:
+        print("Load {}".format(table))
+        load_table(cur, table, query, warehouse, metrics)
+
+
+def load_tables_parallel(pool, queries, workers, warehouse=None, metrics=None):
+    """
+        Description: This function is responsible for loading tables concurrently,
+        each on a separate connection of the pool. A table starts loading once every table it is
+        loaded from (see `table_dependencies`) is done, e.g. songplays waits for both
+        staging tables, while users and time only wait for staging_events.
+
+        Arguments:
+            pool: ConnectionPool of at least `workers` connections
+            queries: dict of table name to the statement, or list of statements, loading it,
+                     in the order of a sequential run
+            workers: maximum number of tables loaded at once
+            warehouse: LocalWarehouse stand-in, or None for the Redshift cluster
+            metrics: list collecting the metrics of each statement, see `load_table`
+
+        Returns:
+            None
+    """
+    pending = dict(queries)
+    done = set()
+    running = {}
+
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        while pending or running:
+            # dependencies outside of `queries` are already loaded
+            ready = [table for table in pending
+                     if all(dependency in done or dependency not in queries
+                            for dependency in table_dependencies.get(table, []))]
+            for table in ready:
+                running[executor.submit(_load_table_on_connection, pool, table, pending.pop(table), warehouse,
+                                         metrics)] = table
+
+            if not running:
+                raise ValueError('circular dependencies between {}'.format(', '.join(pending)))
+
+            finished, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                table = running.pop(future)
+                # stop at the first failure, the loads already running are waited for
+                future.result()
+                done.add(table)
+
+
+def load_incremental(cur, conn, source, warehouse=None, metrics=None):
+    """
+        Description: This function is responsible for
+            - listing the objects of each staging table that are not recorded in the
+              etl_loaded_objects control table yet,
+            - loading only those objects into the emptied staging tables,
+            - merging the staging tables into the star schema with upserts,
+            - recording the loaded objects,
+        in a single transaction, so that a failed run loads the same objects again.
+
+        Arguments:
+            cur: the cursor object
+            conn: the connection object
+            source: S3ManifestSource, or the LocalWarehouse stand-in, listing objects and
+                    returning the COPY of a list of them
+            warehouse: LocalWarehouse stand-in, or None for the Redshift cluster
+            metrics: list collecting the metrics of each statement, see `load_table`
+
+        Returns:
+            Integer: number of objects loaded
+    """
+    loaded = []
+    for table in copy_table_query_map:
+        cur.execute(load_state_select, (table,))
+        known = {key for key, in cur.fetchall()}
+        objects = [obj for obj in source.list_objects(table) if obj[0] not in known]
+        print("Load staging tables: {} new objects into {}".format(len(objects), table))
+
+        if objects:
+            load_table(cur, table, staging_table_queries(table, source.copy_query(table, objects), clear=True),
+                       warehouse, metrics)
+        else:
+            load_table(cur, table, staging_clear_query_map[table], warehouse, metrics)
+        loaded.extend((key, table, size, last_modified) for key, size, last_modified in objects)
+
+    if loaded:
+        for table, queries in upsert_table_query_map.items():
+            print("Upsert tables: {}".format(table))
+            load_table(cur, table, queries, warehouse, metrics)
+        execute_values(cur, load_state_insert, loaded)
+        report_match_rate(cur, warehouse, incremental=True)
+
+    conn.commit()
+    return len(loaded)
+
+
+def connect_redshift(config):
+    return psycopg2.connect(connection_string(config))
+
+
 def main():
-    config = configparser.ConfigParser()
-    config.read('dwh.cfg')
+    parser = argparse.ArgumentParser(description='Load the staging tables and the star schema.')
+    parser.add_argument('--parallel', type=int, default=1,
+                        help='number of tables loaded concurrently, each on its own connection (default: 1)')
+    parser.add_argument('--local', action='store_true',
+                        help='run against the local PostgreSQL stand-in, loading JSON files from --data-dir')
+    parser.add_argument('--incremental', action='store_true',
+                        help='load only the objects not recorded in etl_loaded_objects and upsert them')
+    parser.add_argument('--merge', choices=MERGE_MODES, default=None,
+                        help='empty the staging tables before loading them and merge them into the star schema '
+                             'keyed on primary keys, so that runs can be repeated (default: plain inserts)')
+    parser.add_argument('--data-dir', default=DATA_DIR,
+                        help='local directory holding song_data and log_data (default: %(default)s)')
+    parser.add_argument('--statement-timeout', type=float, default=0,
+                        help='seconds after which a statement is cancelled, 0 for no limit (default: %(default)s)')
+    parser.add_argument('--check', action='store_true',
+                        help='run the data quality checks of data_quality.py once the tables are loaded')
+    parser.add_argument('--check-workers', type=int, default=4,
+                        help='number of checks running at once (default: %(default)s)')
+    args = parser.parse_args()
+    if args.incremental and args.parallel > 1:
+        parser.error('--incremental loads in a single transaction, it cannot be combined with --parallel')
+    if args.incremental and args.merge == 'swap':
+        parser.error('--incremental merges new objects only, it cannot rebuild tables with --merge swap')
+
+    if args.local:
+        warehouse = LocalWarehouse(args.data_dir)
+        dsn = warehouse.dsn
+        parameters = None
+    else:
+        warehouse = None
+        config = read_config()
+        if args.incremental:
+            # checked before the objects are listed, the manifests are written mid-transaction
+            try:
+                parse_s3_url(config.get('S3', 'MANIFEST_PREFIX'))
+            except ValueError:
+                parser.error('--incremental requires MANIFEST_PREFIX in dwh.cfg, an S3 prefix receiving '
+                             'the COPY manifests, e.g. s3://my-bucket/manifests')
+        dsn = connection_string(config)
+        parameters = copy_parameters(config)
+    pool = ConnectionPool(dsn, maxconn=max(args.parallel, args.check_workers if args.check else 1),
+                          statement_timeout=args.statement_timeout)
+    metrics = []
+
+    try:
+        if args.parallel > 1:
+            print("Load tables on {} connections".format(args.parallel))
+            queries = {table: staging_table_queries(table, render(query, parameters), clear=bool(args.merge))
+                       for table, query in copy_table_query_map.items()}
+            if args.merge:
+                queries.update({table: merge_table_queries(table, args.merge) for table in insert_table_query_map})
+            else:
+                queries.update(insert_table_query_map)
+            load_tables_parallel(pool, queries, args.parallel, warehouse, metrics)
+
+            with pool.connection() as conn:
+                report_match_rate(conn.cursor(), warehouse)
+        else:
+            print("Connect Redshift")
+            with pool.connection() as conn:
+                cur = conn.cursor()
 
-    print("Connect Redshift")
-    conn = psycopg2.connect("host={} dbname={} user={} password={} port={}".format(*config['CLUSTER'].values()))
-    cur = conn.cursor()
-    
-    print("Load staging tables")
-    load_staging_tables(cur, conn)
-    print("Insert tables")
-    insert_tables(cur, conn)
+                if args.incremental:
+                    if warehouse is None:
+                        s3 = boto3.client('s3', region_name=config.get('CLUSTER', 'DB_REGION'),
+                                          aws_access_key_id=config.get('AWS', 'KEY'),
+                                          aws_secret_access_key=config.get('AWS', 'SECRET'))
+                        source = S3ManifestSource(s3, config.get('S3', 'MANIFEST_PREFIX'), parameters)
+                    else:
+                        source = warehouse
+                    print("{} objects loaded".format(load_incremental(cur, conn, source, warehouse, metrics)))
+                else:
+                    print("Load staging tables")
+                    load_staging_tables(cur, conn, warehouse, clear=bool(args.merge), parameters=parameters,
+                                        metrics=metrics)
+                    if args.merge:
+                        print("Merge tables")
+                        merge_tables(cur, conn, args.merge, warehouse, metrics)
+                    else:
+                        print("Insert tables")
+                        insert_tables(cur, conn, warehouse, metrics)
+                    report_match_rate(cur, warehouse)
 
-    conn.close()
+        if args.check:
+            print("Check tables")
+            run_checks(pool, workers=args.check_workers, warehouse=warehouse)
+    finally:
+        # the metrics of a failed load are recorded as well
+        if metrics:
+            load_metrics.record_run(pool, metrics)
+        pool.closeall()
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,157 @@
+import uuid
+import logging
+import psycopg2
+from psycopg2.extras import execute_values
+from db import transaction
+from sql_queries import copy_metrics_select, load_errors_select, load_history_insert
+
+
+logger = logging.getLogger('sparkify')
+
+
+# rejected rows detailed in the history, the others are only counted
+MAX_ERROR_DETAILS = 10
+
+# statements moving rows, whose metrics are recorded; DDL statements are not
+RECORDED_STATEMENTS = ('COPY', 'INSERT', 'UPDATE', 'DELETE')
+
+
+def new_run_id():
+    return uuid.uuid4().hex
+
+
+def statement_kind(query):
+    """
+        Description: Returns the kind of a statement, e.g. COPY or INSERT.
+
+        Arguments:
+            query: SQL statement
+
+        Returns:
+            String: first keyword of the statement, upper case
+    """
+    words = query.split(None, 1)
+    return words[0].upper() if words else ''
+
+
+def collect(cur, table, query, seconds, counters=None):
+    """
+        Description: Returns the metrics of a statement that succeeded: on the cluster,
+            the rows, bytes, files and rejected rows of a COPY from the STL_LOAD_COMMITS,
+            STL_FILE_SCAN and STL_LOAD_ERRORS system tables, and the row count of the
+            cursor otherwise; on the local stand-in, the counters of its file load.
+
+        Arguments:
+            cur: the cursor object the statement ran on
+            table: name of the table the statement loads
+            query: the statement
+            seconds: elapsed time of the statement
+            counters: dict returned by `LocalWarehouse.execute`, None on the cluster
+
+        Returns:
+            Dict: table, statement, rows, bytes, files, seconds, rejected and errors
+    """
+    metrics = {'table': table, 'statement': statement_kind(query), 'rows': None, 'bytes': None, 'files': None,
+               'seconds': seconds, 'rejected': 0, 'errors': None}
+    if counters is not None:
+        metrics.update(counters)
+    elif metrics['statement'] == 'COPY':
+        cur.execute(copy_metrics_select)
+        metrics['rows'], metrics['bytes'], metrics['files'], metrics['rejected'] = cur.fetchone()
+    else:
+        metrics['rows'] = cur.rowcount
+    return metrics
+
+
+def collect_error(cur, table, query, seconds, error, local=False):
+    """
+        Description: Returns the metrics of a statement that failed, with the rejected
+            rows of the failed COPY from STL_LOAD_ERRORS on the cluster. The aborted
+            transaction is rolled back first, the system tables cannot be read in it.
+
+        Arguments:
+            cur: the cursor object the statement ran on
+            table: name of the table the statement loads
+            query: the statement
+            seconds: elapsed time until the failure
+            error: the psycopg2 error raised by the statement
+            local: the statement ran on the local stand-in, which has no system tables
+
+        Returns:
+            Dict: table, statement, rows, bytes, files, seconds, rejected and errors
+    """
+    metrics = {'table': table, 'statement': statement_kind(query), 'rows': 0, 'bytes': None, 'files': None,
+               'seconds': seconds, 'rejected': None, 'errors': str(error).strip()}
+    cur.connection.rollback()
+    if not local and metrics['statement'] == 'COPY':
+        try:
+            cur.execute(load_errors_select)
+            rejected = cur.fetchall()
+            cur.connection.rollback()
+        except psycopg2.Error:
+            cur.connection.rollback()
+        else:
+            metrics['rejected'] = len(rejected)
+            metrics['errors'] = '\n'.join([metrics['errors']] +
+                                          ['line {}, column {}: {}'.format(*row) for row in rejected[:MAX_ERROR_DETAILS]])
+    return metrics
+
+
+def write_history(cur, run_id, metrics):
+    """
+        Description: Appends the metrics of a run to the etl_load_history table.
+
+        Arguments:
+            cur: the cursor object
+            run_id: identifier of the run, see `new_run_id`
+            metrics: list of dicts from `collect` and `collect_error`
+
+        Returns:
+            None
+    """
+    execute_values(cur, load_history_insert,
+                   [(run_id, m['table'], m['statement'], m['rows'], m['bytes'], m['files'], m['seconds'],
+                     m['rejected'], m['errors']) for m in metrics])
+
+
+def record_run(pool, metrics):
+    """
+        Description: Prints the metrics of a run and appends them to the etl_load_history
+            table, in a transaction of their own. Called once the run is over, failed or
+            not, so a failure to record them is logged rather than raised, which would
+            mask the error of the run, e.g. after the connection to the cluster was lost.
+
+        Arguments:
+            pool: ConnectionPool
+            metrics: list of dicts from `collect` and `collect_error`
+
+        Returns:
+            Boolean: True when the metrics were recorded
+    """
+    print_metrics(metrics)
+    try:
+        with pool.connection() as conn, transaction(conn) as cur:
+            write_history(cur, new_run_id(), metrics)
+    except Exception as error:
+        logger.error('could not record the load history: %s', str(error).strip())
+        return False
+    return True
+
+
+def print_metrics(metrics):
+    """
+        Description: Prints the metrics of a run, one line per statement.
+
+        Arguments:
+            metrics: list of dicts from `collect` and `collect_error`
+
+        Returns:
+            None
+    """
+    for m in metrics:
+        print("{:<16} {:<7} {:>9} rows {:>12} bytes {:8.2f}s {:>6} rejected".format(
+            m['table'], m['statement'], m['rows'] if m['rows'] is not None else '-',
+            m['bytes'] if m['bytes'] is not None else '-', m['seconds'],
+            m['rejected'] if m['rejected'] is not None else '-'))
+        if m['errors']:
+            print("    {}".format(m['errors'].replace('\n', '\n    ')))
@@ -0,0 +1,225 @@
+import io
+import os
+import re
+import csv
+import glob
+import json
+import datetime
+import psycopg2
+from sql_queries import manifest_copy_query_map
+
+
+# connection strings of the default database and of the local stand-in database
+DEFAULT_DSN = "host=127.0.0.1 dbname=studentdb user=student password=student"
+LOCAL_DB = "sparkifydw"
+LOCAL_DSN = "host=127.0.0.1 dbname={} user=student password=student".format(LOCAL_DB)
+
+# local copy of the song_data and log_data prefixes of the S3 bucket
+DATA_DIR = os.path.join('..', 'Project1-Data_Modeling_with_Postgres', 'data')
+
+# Redshift-only syntax -> PostgreSQL equivalent, applied in order
+TRANSLATIONS = [
+    (re.compile(r'IDENTITY\s*\(\s*0\s*,\s*1\s*\)', re.IGNORECASE),
+     'GENERATED BY DEFAULT AS IDENTITY (MINVALUE 0 START WITH 0)'),
+    # Redshift does not enforce primary keys, the stand-in does not declare them
+    (re.compile(r',\s*PRIMARY\s+KEY\s*\([^)]*\)', re.IGNORECASE), ''),
+    (re.compile(r'\bDISTSTYLE\s+\w+', re.IGNORECASE), ''),
+    (re.compile(r'\b(?:COMPOUND\s+|INTERLEAVED\s+)?(?:DISTKEY|SORTKEY)\s*\([^)]*\)', re.IGNORECASE), ''),
+    (re.compile(r'\b(?:DISTKEY|SORTKEY)\b', re.IGNORECASE), ''),
+    (re.compile(r'\bENCODE\s+\w+', re.IGNORECASE), ''),
+    (re.compile(r'\bdayofweek\b', re.IGNORECASE), 'dow'),
+    (re.compile(r'\bGETDATE\(\)', re.IGNORECASE), 'CURRENT_TIMESTAMP'),
+    # CREATE TABLE ... LIKE inherits the IDENTITY of a Redshift table with its defaults
+    (re.compile(r'\bINCLUDING\s+DEFAULTS\b', re.IGNORECASE), 'INCLUDING DEFAULTS INCLUDING IDENTITY'),
+]
+
+# COPY statement of the cluster, replaced by a local file load
+COPY_PATTERN = re.compile(r'\s*COPY\b', re.IGNORECASE)
+
+# staging table -> (prefix of the data directory, columns in the order of the table)
+STAGING_TABLES = {
+    'staging_events': ('log_data', ['artist', 'auth', 'firstName', 'gender', 'itemInSession', 'lastName',
+                                    'length', 'level', 'location', 'method', 'page', 'registration',
+                                    'sessionId', 'song', 'status', 'ts', 'userAgent', 'userId']),
+    'staging_songs': ('song_data', ['num_songs', 'artist_id', 'artist_latitude', 'artist_longitude',
+                                    'artist_location', 'artist_name', 'song_id', 'title', 'duration', 'year']),
+}
+
+
+def translate(query):
+    """
+        Description: Rewrites a Redshift statement into its PostgreSQL equivalent.
+
+        Arguments:
+            query: Redshift SQL statement
+
+        Returns:
+            String: PostgreSQL statement
+    """
+    for pattern, replacement in TRANSLATIONS:
+        query = pattern.sub(replacement, query)
+    return query
+
+
+def read_records(filepath):
+    """
+        Description: Reads the JSON records of a song file or a log file, one
+            record per line.
+
+        Arguments:
+            filepath: JSON file path
+
+        Returns:
+            Generator of dicts
+    """
+    with open(filepath) as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def _value(column, value):
+    # COPY ... TIMEFORMAT as 'epochmillisecs', and empty user ids of logged out events
+    if column == 'ts' and value is not None:
+        return datetime.datetime.fromtimestamp(value / 1000, datetime.timezone.utc).replace(tzinfo=None)
+    if column == 'userId' and value == '':
+        return None
+    return value
+
+
+class LocalWarehouse:
+    """
+        Description: Local PostgreSQL stand-in for the Redshift cluster. Redshift
+            statements are translated to PostgreSQL, and the COPY of a staging
+            table from S3 is replaced by a `COPY FROM STDIN` of the JSON files of
+            a local data directory in the same layout as the bucket.
+    """
+
+    def __init__(self, data_dir=DATA_DIR, dsn=LOCAL_DSN):
+        self.data_dir = data_dir
+        self.dsn = dsn
+        # staging table -> files listed by the manifest of its next COPY, see `copy_query`
+        self.manifests = {}
+
+    def connect(self):
+        return psycopg2.connect(self.dsn)
+
+    def create_database(self):
+        """
+            Description: Creates the local stand-in database if it does not exist.
+
+            Arguments:
+                None
+
+            Returns:
+                None
+        """
+        conn = psycopg2.connect(DEFAULT_DSN)
+        conn.set_session(autocommit=True)
+        cur = conn.cursor()
+        cur.execute("SELECT 1 FROM pg_database WHERE datname = %s", (LOCAL_DB,))
+        if cur.fetchone() is None:
+            cur.execute("CREATE DATABASE {} WITH ENCODING 'utf8' TEMPLATE template0".format(LOCAL_DB))
+        conn.close()
+
+    def execute(self, cur, table, query):
+        """
+            Description: Runs a statement loading a table: a local file load for
+                the COPY of a staging table, the translated statement otherwise.
+
+            Arguments:
+                cur: the cursor object
+                table: name of the table the statement loads
+                query: Redshift SQL statement
+
+            Returns:
+                Dict: rows loaded, and bytes and files read by a file load, the
+                      counters of the system tables of the cluster
+        """
+        if table in STAGING_TABLES and COPY_PATTERN.match(query):
+            files = self.manifests.pop(table, None)
+            if files is None:
+                files = self.list_files(table)
+            return {'rows': self.copy_staging_table(cur, table, files),
+                    'bytes': sum(os.path.getsize(filepath) for filepath in files), 'files': len(files)}
+        cur.execute(translate(query))
+        return {'rows': cur.rowcount, 'bytes': None, 'files': None}
+
+    def list_files(self, table):
+        """
+            Description: Lists the JSON files of the prefix of a staging table in the
+                data directory.
+
+            Arguments:
+                table: staging_events or staging_songs
+
+            Returns:
+                List of file paths
+        """
+        prefix, columns = STAGING_TABLES[table]
+        return sorted(glob.glob(os.path.join(self.data_dir, prefix, '**', '*.json'), recursive=True))
+
+    def list_objects(self, table):
+        """
+            Description: Lists the files of a staging table as the objects of a bucket,
+                keyed by their path relative to the data directory.
+
+            Arguments:
+                table: staging_events or staging_songs
+
+            Returns:
+                List of (key, size, last modified) tuples
+        """
+        objects = []
+        for filepath in self.list_files(table):
+            stat = os.stat(filepath)
+            objects.append((os.path.relpath(filepath, self.data_dir).replace(os.sep, '/'), stat.st_size,
+                            datetime.datetime.fromtimestamp(stat.st_mtime)))
+        return objects
+
+    def copy_query(self, table, objects):
+        """
+            Description: Keeps a subset of the files of a staging table as the manifest
+                of its next COPY, which `execute` then loads, as the `COPY ... MANIFEST`
+                of the cluster does.
+
+            Arguments:
+                table: staging_events or staging_songs
+                objects: list of (key, size, last modified) tuples from `list_objects`
+
+            Returns:
+                String: COPY statement
+        """
+        self.manifests[table] = [os.path.join(self.data_dir, key) for key, size, mtime in objects]
+        return manifest_copy_query_map[table]
+
+    def copy_staging_table(self, cur, table, files=None):
+        """
+            Description: Loads the JSON files of the data directory into the raw
+                staging table of a staging table, e.g. staging_events_raw, with
+                `COPY FROM STDIN` in CSV format, mapping the JSON keys to the columns
+                as the COPY statements of the cluster do.
+
+            Arguments:
+                cur: the cursor object
+                table: staging_events or staging_songs
+                files: file paths to load, None loads every file of the table
+
+            Returns:
+                Integer: number of records loaded
+        """
+        prefix, columns = STAGING_TABLES[table]
+        if files is None:
+            files = self.list_files(table)
+
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        num_records = 0
+        for filepath in files:
+            for record in read_records(filepath):
+                writer.writerow([_value(column, record.get(column)) for column in columns])
+                num_records += 1
+
+        buffer.seek(0)
+        cur.copy_expert("COPY {}_raw ({}) FROM STDIN WITH (FORMAT csv)".format(table, ', '.join(columns)), buffer)
+        return num_records
@@ -1,7 +1,4 @@
-import os
+from pipeline import main
 
-os.chdir(os.getcwd())  
-for script in ["create_cluster.py", "create_tables.py", "etl.py"]:
-    with open(script) as f:
-        contents = f.read()
-    exec(contents)
\ No newline at end of file
+
+main()
\ No newline at end of file
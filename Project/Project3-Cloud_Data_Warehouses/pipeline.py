@@ -0,0 +1,116 @@
+import argparse
+import create_cluster
+from create_tables import drop_tables, create_tables
+from etl import MERGE_MODES, load_staging_tables, insert_tables, merge_tables, report_match_rate
+from sql_queries import copy_parameters
+from local_warehouse import LocalWarehouse, DATA_DIR
+from dwh_config import read_config
+from db import ConnectionPool, connection_string, transaction
+from data_quality import run_checks
+import load_metrics
+
+
+STAGES = ('cluster', 'tables', 'etl', 'check')
+
+
+def run_pipeline(conn, stages, parameters=None, warehouse=None, merge=None, metrics=None):
+    """
+        Description: This function is responsible for running the table and ETL
+        stages of the pipeline over one connection: the tables are dropped and
+        created in one transaction, the staging tables loaded in a second one and
+        the star schema inserted in a third one.
+
+        Arguments:
+            conn: the connection object
+            stages: stages to run, among tables and etl
+            parameters: COPY parameters of the run, see `sql_queries.copy_parameters`
+            warehouse: LocalWarehouse stand-in, or None for the Redshift cluster
+            merge: delete-insert or swap to merge the staging tables into the star schema,
+                   None for plain inserts
+            metrics: list collecting the metrics of each load statement, see `etl.load_table`
+
+        Returns:
+            None
+    """
+    local = warehouse is not None
+
+    if 'tables' in stages:
+        with transaction(conn) as cur:
+            print("Drop tables")
+            drop_tables(cur, local)
+            print("Create tables")
+            create_tables(cur, local)
+
+    if 'etl' in stages:
+        cur = conn.cursor()
+        print("Load staging tables")
+        load_staging_tables(cur, conn, warehouse, clear=bool(merge), parameters=parameters, metrics=metrics)
+        if merge:
+            print("Merge tables")
+            merge_tables(cur, conn, merge, warehouse, metrics)
+        else:
+            print("Insert tables")
+            insert_tables(cur, conn, warehouse, metrics)
+        report_match_rate(cur, warehouse)
+
+
+def main():
+    """
+    Description:
+        - Reads dwh.cfg once.
+        - Creates the Redshift cluster, then drops and creates the tables and loads
+          them in the same process, over one connection.
+        - Runs the data quality checks of the loaded tables concurrently.
+
+    Usage:
+        python pipeline.py
+        python pipeline.py --stages tables etl --merge delete-insert
+        python pipeline.py --local
+    """
+    parser = argparse.ArgumentParser(description='Create the cluster, create the tables and load them.')
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=list(STAGES),
+                        help='stages to run (default: all, without cluster when --local)')
+    parser.add_argument('--merge', choices=MERGE_MODES, default=None,
+                        help='merge the staging tables into the star schema rather than inserting them, see etl.py')
+    parser.add_argument('--statement-timeout', type=float, default=0,
+                        help='seconds after which a statement is cancelled, 0 for no limit (default: %(default)s)')
+    parser.add_argument('--check-workers', type=int, default=4,
+                        help='number of data quality checks running at once (default: %(default)s)')
+    parser.add_argument('--local', action='store_true',
+                        help='run the tables and etl stages against the local PostgreSQL stand-in')
+    parser.add_argument('--data-dir', default=DATA_DIR,
+                        help='local directory holding song_data and log_data (default: %(default)s)')
+    args = parser.parse_args()
+
+    if args.local:
+        warehouse = LocalWarehouse(args.data_dir)
+        warehouse.create_database()
+        dsn = warehouse.dsn
+        parameters = None
+    else:
+        warehouse = None
+        config = read_config()
+        if 'cluster' in args.stages:
+            print("Create redshift cluster")
+            create_cluster.provision(create_cluster.create_client_resource('ec2', 'resource'),
+                                     create_cluster.create_client_resource('iam', 'client'),
+                                     create_cluster.create_client_resource('redshift', 'client'))
+        dsn = connection_string(config)
+        parameters = copy_parameters(config)
+    pool = ConnectionPool(dsn, maxconn=args.check_workers, statement_timeout=args.statement_timeout)
+    metrics = []
+
+    try:
+        with pool.connection() as conn:
+            run_pipeline(conn, args.stages, parameters, warehouse, args.merge, metrics)
+        if 'check' in args.stages:
+            print("Check tables")
+            run_checks(pool, workers=args.check_workers, warehouse=warehouse)
+    finally:
+        if metrics:
+            load_metrics.record_run(pool, metrics)
+        pool.closeall()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+import json
+import datetime
+from sql_queries import manifest_copy_query_map, render
+
+
+# staging table -> COPY parameter holding the S3 prefix its objects are listed from
+STAGING_PREFIXES = {'staging_events': 'log_data', 'staging_songs': 'song_data'}
+
+
+def parse_s3_url(url):
+    """
+        Description: Splits an S3 url, quoted as in dwh.cfg or not, into bucket and key.
+
+        Arguments:
+            url: e.g. 's3://udacity-dend/log_data'
+
+        Returns:
+            Tuple: (bucket, key)
+    """
+    url = url.strip().strip("'\"")
+    if not url.startswith('s3://'):
+        raise ValueError('not an S3 url: {}'.format(url))
+    bucket, _, key = url[len('s3://'):].partition('/')
+    return bucket, key
+
+
+class S3ManifestSource:
+    """
+        Description: JSON objects of the S3 prefixes of the staging tables. A subset
+            of them is loaded by writing a COPY manifest listing their urls under
+            `manifest_url` and running the `COPY ... MANIFEST` of the staging table,
+            rendered with the COPY parameters of the run, see `etl.load_table`.
+    """
+
+    def __init__(self, s3_client, manifest_url, parameters):
+        self.s3 = s3_client
+        self.manifest_url = manifest_url
+        self.parameters = parameters
+
+    def list_objects(self, table):
+        """
+            Description: Lists the JSON objects of the S3 prefix of a staging table.
+
+            Arguments:
+                table: staging_events or staging_songs
+
+            Returns:
+                List of (url, size, last modified) tuples
+        """
+        bucket, prefix = parse_s3_url(self.parameters[STAGING_PREFIXES[table]])
+        objects = []
+        for page in self.s3.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix):
+            for item in page.get('Contents', []):
+                if item['Key'].endswith('.json'):
+                    objects.append(('s3://{}/{}'.format(bucket, item['Key']), item['Size'], item['LastModified']))
+        return objects
+
+    def copy_query(self, table, objects):
+        """
+            Description: Writes a COPY manifest of objects and returns the COPY
+                statement loading them into a staging table.
+
+            Arguments:
+                table: staging_events or staging_songs
+                objects: list of (url, size, last modified) tuples
+
+            Returns:
+                String: COPY statement
+        """
+        bucket, prefix = parse_s3_url(self.manifest_url)
+        key = '{}/{}-{}.manifest'.format(prefix.rstrip('/'), table,
+                                         datetime.datetime.now(datetime.timezone.utc).strftime('%Y%m%dT%H%M%S%f'))
+        manifest = {'entries': [{'url': url, 'mandatory': True} for url, size, last_modified in objects]}
+        self.s3.put_object(Bucket=bucket, Key=key.lstrip('/'), Body=json.dumps(manifest).encode())
+
+        url = 's3://{}/{}'.format(bucket, key.lstrip('/'))
+        return render(manifest_copy_query_map[table], dict(self.parameters, manifest=url))
@@ -0,0 +1,332 @@
+import os
+import re
+import json
+import time
+import argparse
+import datetime
+import statistics
+import sql_queries
+from etl import connect_redshift, execute_query, load_staging_tables, insert_tables
+from local_warehouse import LocalWarehouse, DATA_DIR, translate
+from dwh_config import read_config
+
+
+# star schema table -> its CREATE statement in sql_queries.py
+STAR_TABLES = {'songplays': sql_queries.songplay_table_create,
+               'users': sql_queries.user_table_create,
+               'songs': sql_queries.song_table_create,
+               'artists': sql_queries.artist_table_create,
+               'time': sql_queries.time_table_create}
+
+# column type -> compression encoding, when a variant compresses its columns
+ENCODINGS = {'SMALLINT': 'AZ64', 'INTEGER': 'AZ64', 'BIGINT': 'AZ64', 'DECIMAL': 'AZ64', 'NUMERIC': 'AZ64',
+             'TIMESTAMP': 'AZ64', 'VARCHAR': 'ZSTD', 'CHAR': 'ZSTD'}
+
+# variant -> table -> layout: diststyle (ALL, EVEN, KEY or AUTO), distkey, sortkey columns, encode
+# columns; tables not listed keep the DDL of sql_queries.py
+VARIANTS = {
+    'baseline': {},
+    'time_sorted': {
+        'songplays': dict(diststyle='KEY', distkey='start_time', sortkey=['start_time'], encode=True),
+        'time': dict(diststyle='KEY', distkey='start_time', sortkey=['start_time'], encode=True),
+        'users': dict(diststyle='ALL', sortkey=['user_id'], encode=True),
+        'songs': dict(diststyle='ALL', sortkey=['song_id'], encode=True),
+        'artists': dict(diststyle='ALL', sortkey=['artist_id'], encode=True),
+    },
+    'song_distributed': {
+        'songplays': dict(diststyle='KEY', distkey='song_id', sortkey=['start_time'], encode=True),
+        'songs': dict(diststyle='KEY', distkey='song_id', sortkey=['song_id'], encode=True),
+        'artists': dict(diststyle='ALL', sortkey=['artist_id'], encode=True),
+        'users': dict(diststyle='ALL', sortkey=['user_id'], encode=True),
+        'time': dict(diststyle='ALL', sortkey=['start_time'], encode=True),
+    },
+    'even_user_sorted': {
+        'songplays': dict(diststyle='EVEN', sortkey=['user_id', 'start_time']),
+        'users': dict(diststyle='ALL', sortkey=['user_id']),
+        'time': dict(diststyle='ALL', sortkey=['start_time']),
+    },
+}
+
+# fixed set of analytical queries timed on each variant
+BENCHMARK_QUERIES = {
+    'plays_by_hour': """SELECT t.hour, COUNT(*) AS plays
+                        FROM songplays sp
+                        JOIN time t ON (sp.start_time = t.start_time)
+                        GROUP BY t.hour
+                        ORDER BY t.hour;""",
+    'plays_by_weekday_level': """SELECT t.weekday, sp.level, COUNT(*) AS plays
+                                 FROM songplays sp
+                                 JOIN time t ON (sp.start_time = t.start_time)
+                                 GROUP BY t.weekday, sp.level
+                                 ORDER BY t.weekday, sp.level;""",
+    'top_users': """SELECT u.user_id, u.first_name, u.last_name, COUNT(*) AS plays
+                    FROM songplays sp
+                    JOIN users u ON (sp.user_id = u.user_id)
+                    GROUP BY u.user_id, u.first_name, u.last_name
+                    ORDER BY plays DESC
+                    LIMIT 10;""",
+    'top_songs': """SELECT s.song_id, s.title, COUNT(*) AS plays
+                    FROM songplays sp
+                    JOIN songs s ON (sp.song_id = s.song_id)
+                    GROUP BY s.song_id, s.title
+                    ORDER BY plays DESC
+                    LIMIT 10;""",
+    'top_artists': """SELECT a.artist_id, a.name, COUNT(*) AS plays
+                      FROM songplays sp
+                      JOIN artists a ON (sp.artist_id = a.artist_id)
+                      GROUP BY a.artist_id, a.name
+                      ORDER BY plays DESC
+                      LIMIT 10;""",
+    'plays_last_month': """SELECT COUNT(*) AS plays
+                           FROM songplays
+                           WHERE start_time >= (SELECT MAX(start_time) - INTERVAL '30 days' FROM songplays);""",
+}
+
+# table sizes and distribution skew of the cluster
+table_info_select = """SELECT "table", size, tbl_rows, skew_rows, sortkey1, diststyle
+                       FROM svv_table_info
+                       WHERE "table" IN ('songplays', 'users', 'songs', 'artists', 'time')
+                       ORDER BY "table";"""
+
+local_table_info_select = """SELECT relname, pg_total_relation_size(oid) / (1024 * 1024), reltuples::BIGINT
+                             FROM pg_class
+                             WHERE relname IN ('songplays', 'users', 'songs', 'artists', 'time')
+                             ORDER BY relname;"""
+
+COLUMN_PATTERN = re.compile(r'^(\s*)(\w+)(\s+)([A-Za-z]+)([^\n]*?)(,?)(\s*)$', re.MULTILINE)
+
+
+def table_ddl(table, layout):
+    """
+        Description: Rewrites the CREATE statement of a table of sql_queries.py with
+            the distribution style, sort key and column encodings of a layout.
+
+        Arguments:
+            table: name of a star schema table
+            layout: dict with diststyle, distkey, sortkey and encode keys, or None
+                    to keep the statement as it is
+
+        Returns:
+            String: CREATE statement
+    """
+    ddl = STAR_TABLES[table]
+    if not layout:
+        return ddl
+
+    # drop the hand-written distribution of sql_queries.py
+    ddl = re.sub(r'\bDISTSTYLE\s+\w+', '', ddl)
+    ddl = re.sub(r'\bDISTKEY\b', '', ddl).rstrip().rstrip(';').rstrip()
+
+    sortkey = layout.get('sortkey') or []
+
+    def encode(match):
+        indent, column, space, column_type, rest, comma, end = match.groups()
+        encoding = ENCODINGS.get(column_type.upper())
+        if column.upper() == 'PRIMARY' or encoding is None:
+            return match.group(0)
+        # the leading sort key column is left uncompressed, so that range-restricted scans stay cheap
+        if sortkey and column == sortkey[0]:
+            encoding = 'RAW'
+        return '{}{}{}{}{} ENCODE {}{}{}'.format(indent, column, space, column_type, rest.rstrip(), encoding, comma, end)
+
+    if layout.get('encode'):
+        ddl = COLUMN_PATTERN.sub(encode, ddl)
+
+    attributes = ['DISTSTYLE {}'.format(layout.get('diststyle', 'AUTO'))]
+    if layout.get('distkey'):
+        attributes.append('DISTKEY({})'.format(layout['distkey']))
+    if sortkey:
+        attributes.append('COMPOUND SORTKEY({})'.format(', '.join(sortkey)))
+    return '{}\n{};'.format(ddl, ' '.join(attributes))
+
+
+def variant_ddl(name):
+    """
+        Description: Generates the CREATE statements of the star schema for a variant.
+
+        Arguments:
+            name: name of a variant of VARIANTS
+
+        Returns:
+            Dict of table name to CREATE statement
+    """
+    return {table: table_ddl(table, VARIANTS[name].get(table)) for table in STAR_TABLES}
+
+
+def sort_key_indexes(name):
+    """
+        Description: Emulates the sort keys of a variant on the local stand-in with a
+            B-tree index each table is clustered on after it is loaded.
+
+        Arguments:
+            name: name of a variant of VARIANTS
+
+        Returns:
+            List of statements
+    """
+    statements = []
+    for table, layout in VARIANTS[name].items():
+        if layout.get('sortkey'):
+            statements.append('CREATE INDEX {0}_sortkey ON {0} ({1});'.format(table, ', '.join(layout['sortkey'])))
+            statements.append('CLUSTER {0} USING {0}_sortkey;'.format(table))
+    return statements
+
+
+def load_variant(conn, name, warehouse=None, parameters=None):
+    """
+        Description: This function is responsible for
+            - dropping the staging tables and the star schema, keeping the incremental
+              load state of etl_loaded_objects, and creating them with the DDL of a variant,
+            - loading the staging tables and inserting the star schema,
+            - clustering the tables on their sort key on the local stand-in,
+            - updating the statistics of the tables.
+
+        Arguments:
+            conn: the connection object
+            name: name of a variant of VARIANTS
+            warehouse: LocalWarehouse stand-in, or None for the Redshift cluster
+            parameters: COPY parameters of the run, see `sql_queries.copy_parameters`
+
+        Returns:
+            Float: seconds spent loading
+    """
+    cur = conn.cursor()
+    for query in sql_queries.drop_schema_queries:
+        execute_query(cur, query, warehouse)
+    for query in sql_queries.create_table_queries:
+        if query not in STAR_TABLES.values():
+            execute_query(cur, query, warehouse)
+    for table, ddl in variant_ddl(name).items():
+        print(ddl)
+        execute_query(cur, ddl, warehouse)
+    conn.commit()
+
+    start = time.perf_counter()
+    load_staging_tables(cur, conn, warehouse, parameters=parameters)
+    insert_tables(cur, conn, warehouse)
+    if warehouse is not None:
+        for query in sort_key_indexes(name):
+            execute_query(cur, query, warehouse)
+    for table in STAR_TABLES:
+        execute_query(cur, 'ANALYZE {};'.format(table), warehouse)
+    conn.commit()
+    return time.perf_counter() - start
+
+
+def time_queries(conn, repeat, warehouse=None):
+    """
+        Description: Times each query of BENCHMARK_QUERIES `repeat` times.
+
+        Arguments:
+            conn: the connection object
+            repeat: number of runs of each query
+            warehouse: LocalWarehouse stand-in, or None for the Redshift cluster
+
+        Returns:
+            Dict of query name to dict of best and median seconds
+    """
+    cur = conn.cursor()
+    if warehouse is None:
+        # time the query, not the result cache of the cluster
+        cur.execute('SET enable_result_cache_for_session TO off;')
+
+    timings = {}
+    for name, query in BENCHMARK_QUERIES.items():
+        query = query if warehouse is None else translate(query)
+        seconds = []
+        for i in range(repeat):
+            start = time.perf_counter()
+            cur.execute(query)
+            cur.fetchall()
+            seconds.append(time.perf_counter() - start)
+        timings[name] = {'best': min(seconds), 'median': statistics.median(seconds)}
+    conn.commit()
+    return timings
+
+
+def table_info(conn, warehouse=None):
+    """
+        Description: Returns the size and distribution of the star schema tables,
+            from svv_table_info on the cluster, from pg_class on the stand-in.
+
+        Arguments:
+            conn: the connection object
+            warehouse: LocalWarehouse stand-in, or None for the Redshift cluster
+
+        Returns:
+            List of rows
+    """
+    cur = conn.cursor()
+    cur.execute(table_info_select if warehouse is None else local_table_info_select)
+    rows = [list(row) for row in cur.fetchall()]
+    conn.commit()
+    return rows
+
+
+def main():
+    """
+    Description:
+        - Creates the star schema with the DDL of each variant: sort keys, column
+          encodings and distribution styles.
+        - Loads it and times a fixed set of analytical queries on it.
+        - Prints the timings and appends them as JSON lines to the output file,
+          with the size and distribution of the tables.
+
+    Usage:
+        python schema_tuning.py --local --repeat 5
+        python schema_tuning.py --variants baseline time_sorted --print-ddl
+    """
+    parser = argparse.ArgumentParser(description='Compare sort key, encoding and distribution variants of the schema.')
+    parser.add_argument('--variants', nargs='+', choices=list(VARIANTS), default=list(VARIANTS),
+                        help='variants to benchmark (default: all)')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='number of runs of each query (default: %(default)s)')
+    parser.add_argument('--print-ddl', action='store_true',
+                        help='only print the DDL of the variants')
+    parser.add_argument('--local', action='store_true',
+                        help='run against the local PostgreSQL stand-in, where sort keys become clustered indexes')
+    parser.add_argument('--data-dir', default=DATA_DIR,
+                        help='local directory holding song_data and log_data (default: %(default)s)')
+    parser.add_argument('--output', default=os.path.join('results', 'schema_tuning_results.jsonl'),
+                        help='file the results are appended to (default: %(default)s)')
+    args = parser.parse_args()
+
+    if args.print_ddl:
+        for name in args.variants:
+            print('-- {}'.format(name))
+            for ddl in variant_ddl(name).values():
+                print(ddl)
+        return
+
+    if args.local:
+        warehouse = LocalWarehouse(args.data_dir)
+        warehouse.create_database()
+        conn = warehouse.connect()
+        parameters = None
+    else:
+        warehouse = None
+        config = read_config()
+        conn = connect_redshift(config)
+        parameters = sql_queries.copy_parameters(config)
+
+    os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+    started_at = datetime.datetime.now(datetime.timezone.utc).isoformat()
+    try:
+        for name in args.variants:
+            load_seconds = load_variant(conn, name, warehouse, parameters)
+            timings = time_queries(conn, args.repeat, warehouse)
+
+            print('{}: loaded in {:.2f}s'.format(name, load_seconds))
+            for query, seconds in timings.items():
+                print('    {:<24} best {:8.4f}s median {:8.4f}s'.format(query, seconds['best'], seconds['median']))
+
+            with open(args.output, 'a') as f:
+                f.write(json.dumps({'started_at': started_at, 'variant': name, 'local': args.local,
+                                    'layout': VARIANTS[name], 'load_seconds': load_seconds, 'queries': timings,
+                                    'tables': table_info(conn, warehouse)}, default=str) + '\n')
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
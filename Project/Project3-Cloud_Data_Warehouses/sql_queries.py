@@ -1,14 +1,34 @@
-import configparser
+# CONFIG, the COPY statements are templates rendered with the parameters of a run
 
+def copy_parameters(config):
+    """
+        Description: Returns the parameters of the COPY statements from the configuration.
 
-# CONFIG
-config = configparser.ConfigParser()
-config.read('dwh.cfg')
+        Arguments:
+            config: ConfigParser of dwh.cfg
 
-ARN = config.get('IAM_ROLE','ARN')
-LOG_DATA = config.get('S3','LOG_DATA')
-LOG_JSONPATH = config.get('S3','LOG_JSONPATH')
-SONG_DATA = config.get('S3','SONG_DATA')
+        Returns:
+            Dict: arn, log_data, log_jsonpath and song_data
+    """
+    return {'arn': config.get('IAM_ROLE', 'ARN'),
+            'log_data': config.get('S3', 'LOG_DATA'),
+            'log_jsonpath': config.get('S3', 'LOG_JSONPATH'),
+            'song_data': config.get('S3', 'SONG_DATA')}
+
+
+def render(query, parameters=None):
+    """
+        Description: Fills in the parameters of a COPY statement template.
+
+        Arguments:
+            query: template, e.g. staging_events_copy
+            parameters: dict from `copy_parameters`, None leaves the template as it is
+                        for the local stand-in, which does not run the COPY statements
+
+        Returns:
+            String: statement
+    """
+    return query if parameters is None else query.format(**parameters)
 
 
 # DROP TABLES
@@ -20,6 +40,7 @@ user_table_drop = "DROP TABLE IF EXISTS users"
 song_table_drop = "DROP TABLE IF EXISTS songs"
 artist_table_drop = "DROP TABLE IF EXISTS artists"
 time_table_drop = "DROP TABLE IF EXISTS time"
+load_state_table_drop = "DROP TABLE IF EXISTS etl_loaded_objects"
 
 # CREATE TABLES
 
@@ -31,7 +52,7 @@ staging_events_table_create= ("""CREATE TABLE IF NOT EXISTS staging_events
                                 gender        CHAR(1),
                                 itemInSession SMALLINT,
                                 lastName      VARCHAR,
-                                length        NUMERIC,
+                                length        DECIMAL(10,6),
                                 level         VARCHAR,
                                 location      VARCHAR,
                                 method        VARCHAR,
@@ -42,7 +63,8 @@ staging_events_table_create= ("""CREATE TABLE IF NOT EXISTS staging_events
                                 status        SMALLINT,
                                 ts            TIMESTAMP,
                                 userAgent     VARCHAR,
-                                userId        INTEGER
+                                userId        INTEGER,
+                                match_key     CHAR(32)       DISTKEY   SORTKEY
                                 )
                             """)
 
@@ -57,10 +79,58 @@ staging_songs_table_create = ("""CREATE TABLE IF NOT EXISTS staging_songs
                                 song_id           VARCHAR, 
                                 title             VARCHAR, 
                                 duration          DECIMAL(10,6),
-                                year              SMALLINT
+                                year              SMALLINT,
+                                match_key         CHAR(32)   DISTKEY   SORTKEY
                                 )
                             """)
 
+# RAW STAGING TABLES, the COPY targets of a load, holding the records until they are
+# inserted into the staging tables with their match keys, so that every row is
+# distributed on its key as it is written; temporary, so dropped with the session
+
+staging_events_raw_table_create = ("""CREATE TEMP TABLE staging_events_raw
+                                     (
+                                     artist        VARCHAR,
+                                     auth          VARCHAR,
+                                     firstName     VARCHAR,
+                                     gender        CHAR(1),
+                                     itemInSession SMALLINT,
+                                     lastName      VARCHAR,
+                                     length        DECIMAL(10,6),
+                                     level         VARCHAR,
+                                     location      VARCHAR,
+                                     method        VARCHAR,
+                                     page          VARCHAR,
+                                     registration  DECIMAL(20, 1),
+                                     sessionId     SMALLINT,
+                                     song          VARCHAR,
+                                     status        SMALLINT,
+                                     ts            TIMESTAMP,
+                                     userAgent     VARCHAR,
+                                     userId        INTEGER
+                                     )
+                                     DISTSTYLE EVEN;
+                                 """)
+
+staging_songs_raw_table_create = ("""CREATE TEMP TABLE staging_songs_raw
+                                    (
+                                    num_songs         SMALLINT, 
+                                    artist_id         VARCHAR, 
+                                    artist_latitude   DECIMAL(10,6), 
+                                    artist_longitude  DECIMAL(10,6),
+                                    artist_location   VARCHAR, 
+                                    artist_name       VARCHAR,
+                                    song_id           VARCHAR, 
+                                    title             VARCHAR, 
+                                    duration          DECIMAL(10,6),
+                                    year              SMALLINT
+                                    )
+                                    DISTSTYLE EVEN;
+                                """)
+
+staging_events_raw_table_drop = "DROP TABLE IF EXISTS staging_events_raw"
+staging_songs_raw_table_drop = "DROP TABLE IF EXISTS staging_songs_raw"
+
 user_table_create = ("""CREATE TABLE IF NOT EXISTS users
                         (
                         user_id     INTEGER  NOT NULL, 
@@ -118,8 +188,8 @@ songplay_table_create = ("""CREATE TABLE IF NOT EXISTS songplays
                             start_time   TIMESTAMP      NOT NULL,
                             user_id      INTEGER        NOT NULL,
                             level        VARCHAR,
-                            song_id      VARCHAR        NOT NULL,
-                            artist_id    VARCHAR        NOT NULL,
+                            song_id      VARCHAR,
+                            artist_id    VARCHAR,
                             session_id   SMALLINT,
                             location     VARCHAR,
                             user_agent   VARCHAR,
@@ -129,25 +199,126 @@ songplay_table_create = ("""CREATE TABLE IF NOT EXISTS songplays
                             DISTSTYLE ALL;
                         """)
 
+load_state_table_create = ("""CREATE TABLE IF NOT EXISTS etl_loaded_objects
+                              (
+                              object_key     VARCHAR(1024)  NOT NULL,
+                              staging_table  VARCHAR(32)    NOT NULL,
+                              size           BIGINT,
+                              last_modified  TIMESTAMP,
+                              loaded_at      TIMESTAMP      NOT NULL   DEFAULT GETDATE(),
+
+                              PRIMARY KEY(object_key)
+                              )
+                              DISTSTYLE ALL;
+                          """)
+
+# one row per statement loading a table, kept across runs, so it is not in drop_table_queries
+load_history_table_create = ("""CREATE TABLE IF NOT EXISTS etl_load_history
+                                (
+                                run_id           VARCHAR(32)      NOT NULL,
+                                table_name       VARCHAR(64)      NOT NULL,
+                                statement        VARCHAR(16)      NOT NULL,
+                                rows_loaded      BIGINT,
+                                bytes_scanned    BIGINT,
+                                files_loaded     INTEGER,
+                                elapsed_seconds  DOUBLE PRECISION,
+                                rejected_rows    BIGINT,
+                                errors           VARCHAR(65535),
+                                recorded_at      TIMESTAMP        NOT NULL   DEFAULT GETDATE()
+                                )
+                                DISTSTYLE ALL;
+                            """)
+
 
-# STAGING TABLES
+# STAGING TABLES, copied into the raw staging tables, the JSONPaths of the log data map
+# to the listed columns by position
 
 staging_events_copy = ("""
-                       COPY staging_events 
-                       FROM {}
-                       CREDENTIALS 'aws_iam_role={}' 
+                       COPY staging_events_raw (artist, auth, firstName, gender, itemInSession, lastName, length, level, location,
+                                            method, page, registration, sessionId, song, status, ts, userAgent, userId)
+                       FROM {log_data}
+                       CREDENTIALS 'aws_iam_role={arn}' 
                        REGION 'us-west-2'
-                       FORMAT as JSON {} 
+                       FORMAT as JSON {log_jsonpath} 
                        TIMEFORMAT as 'epochmillisecs';
-                       """).format(LOG_DATA, ARN, LOG_JSONPATH)
+                       """)
 
 staging_songs_copy = ("""
-                       COPY staging_songs 
-                       FROM {}
-                       CREDENTIALS 'aws_iam_role={}' 
+                       COPY staging_songs_raw 
+                       FROM {song_data}
+                       CREDENTIALS 'aws_iam_role={arn}' 
                        REGION 'us-west-2'
                        FORMAT as JSON 'auto';
-                       """).format(SONG_DATA, ARN)
+                       """)
+
+# INCREMENTAL STAGING TABLES, rendered with the url of the manifest of the run as well
+
+staging_events_manifest_copy = ("""
+                       COPY staging_events_raw (artist, auth, firstName, gender, itemInSession, lastName, length, level, location,
+                                            method, page, registration, sessionId, song, status, ts, userAgent, userId)
+                       FROM '{manifest}'
+                       CREDENTIALS 'aws_iam_role={arn}' 
+                       REGION 'us-west-2'
+                       FORMAT as JSON {log_jsonpath} 
+                       TIMEFORMAT as 'epochmillisecs'
+                       MANIFEST;
+                       """)
+
+staging_songs_manifest_copy = ("""
+                       COPY staging_songs_raw 
+                       FROM '{manifest}'
+                       CREDENTIALS 'aws_iam_role={arn}' 
+                       REGION 'us-west-2'
+                       FORMAT as JSON 'auto'
+                       MANIFEST;
+                       """)
+
+# DELETE rather than TRUNCATE, which commits the transaction on Redshift
+staging_events_clear = "DELETE FROM staging_events"
+staging_songs_clear = "DELETE FROM staging_songs"
+
+# MATCH KEYS, a play matches a song on its trimmed, lowercased artist and title and its duration
+# rounded to the second, hashed into one CHAR(32) column, computed as the raw staging tables
+# are inserted into the staging tables
+
+MATCH_KEY = ("MD5(LOWER(TRIM({artist})) || '|' || LOWER(TRIM({title})) || '|' || "
+             "CAST(CAST(ROUND({duration}) AS INTEGER) AS VARCHAR))")
+
+# the events of other pages match no song, they are spread over the slices by their time
+staging_events_insert = ("""INSERT INTO staging_events (artist, auth, firstName, gender, itemInSession, lastName, length, level,
+                                                        location, method, page, registration, sessionId, song, status, ts,
+                                                        userAgent, userId, match_key)
+                            SELECT artist, auth, firstName, gender, itemInSession, lastName, length, level,
+                                   location, method, page, registration, sessionId, song, status, ts,
+                                   userAgent, userId,
+                                   COALESCE(CASE WHEN page = 'NextSong' THEN {} END, MD5(CAST(ts AS VARCHAR)))
+                            FROM staging_events_raw;
+                        """).format(MATCH_KEY.format(artist='artist', title='song', duration='length'))
+
+staging_songs_insert = ("""INSERT INTO staging_songs (num_songs, artist_id, artist_latitude, artist_longitude, artist_location,
+                                                      artist_name, song_id, title, duration, year, match_key)
+                           SELECT num_songs, artist_id, artist_latitude, artist_longitude, artist_location,
+                                  artist_name, song_id, title, duration, year, {}
+                           FROM staging_songs_raw;
+                       """).format(MATCH_KEY.format(artist='artist_name', title='title', duration='duration'))
+
+# plays of the staging tables, and those matching a song of the staging tables
+songplay_match_rate_select = ("""SELECT COUNT(*), COUNT(s.match_key)
+                                 FROM staging_events e
+                                 LEFT JOIN (SELECT DISTINCT match_key FROM staging_songs) s
+                                 ON (e.match_key = s.match_key)
+                                 WHERE e.page = 'NextSong';""")
+
+# plays of the staging tables, and those matching a song of all loaded songs
+songplay_incremental_match_rate_select = ("""SELECT COUNT(*), COUNT(s.match_key)
+                                             FROM staging_events e
+                                             LEFT JOIN (SELECT DISTINCT {} AS match_key
+                                                        FROM songs s
+                                                        JOIN artists a
+                                                        ON (s.artist_id = a.artist_id)) s
+                                             ON (e.match_key = s.match_key)
+                                             WHERE e.page = 'NextSong';"""
+                                          ).format(MATCH_KEY.format(artist='a.name', title='s.title', duration='s.duration'))
 
 # FINAL TABLES
 
@@ -161,8 +332,8 @@ songplay_table_insert = ("""INSERT INTO songplays (start_time, user_id, level, s
                                    location, 
                                    userAgent  AS user_agent
                             FROM staging_events e 
-                            JOIN staging_songs s
-                            ON (e.artist = s.artist_name AND e.song = s.title)
+                            LEFT JOIN (SELECT DISTINCT match_key, song_id, artist_id FROM staging_songs) s
+                            ON (e.match_key = s.match_key)
                             WHERE page = 'NextSong';
                         """)
 
@@ -205,10 +376,134 @@ time_table_insert = ("""INSERT INTO time (start_time, hour, day, week, month, ye
                         FROM staging_events;
                     """)
 
+# UPSERTS, the rows of the staging tables replace the rows with the same key
+
+user_table_upsert_delete = ("""DELETE FROM users
+                               USING staging_events e
+                               WHERE users.user_id = e.userId
+                                 AND e.page = 'NextSong';
+                           """)
+
+song_table_upsert_delete = ("""DELETE FROM songs
+                               USING staging_songs s
+                               WHERE songs.song_id = s.song_id;
+                           """)
+
+artist_table_upsert_delete = ("""DELETE FROM artists
+                                 USING staging_songs s
+                                 WHERE artists.artist_id = s.artist_id;
+                             """)
+
+time_table_upsert_delete = ("""DELETE FROM time
+                               USING staging_events e
+                               WHERE time.start_time = e.ts;
+                           """)
+
+# songplays have no declared key, a play is identified by its time, user and session
+songplay_table_upsert_delete = ("""DELETE FROM songplays
+                                   USING staging_events e
+                                   WHERE songplays.start_time = e.ts
+                                     AND songplays.user_id = e.userId
+                                     AND songplays.session_id = e.sessionId
+                                     AND e.page = 'NextSong';
+                               """)
+
+# staging_songs only holds the new songs, plays are matched against all loaded songs
+songplay_table_incremental_insert = ("""INSERT INTO songplays (start_time, user_id, level, song_id, artist_id, session_id, location, user_agent)
+                                        SELECT e.ts         AS start_time,
+                                               e.userId     AS user_id,
+                                               e.level,
+                                               s.song_id,
+                                               s.artist_id,
+                                               e.sessionId  AS session_id,
+                                               e.location,
+                                               e.userAgent  AS user_agent
+                                        FROM staging_events e
+                                        LEFT JOIN (SELECT DISTINCT {} AS match_key, s.song_id, s.artist_id
+                                                   FROM songs s
+                                                   JOIN artists a
+                                                   ON (s.artist_id = a.artist_id)) s
+                                        ON (e.match_key = s.match_key)
+                                        WHERE e.page = 'NextSong';
+                                    """).format(MATCH_KEY.format(artist='a.name', title='s.title', duration='s.duration'))
+
+# STAGING SWAP, {0} is the name of the table rebuilt into {0}_new and swapped in
+
+table_swap_prepare_queries = ["DROP TABLE IF EXISTS {0}_new;",
+                              "CREATE TABLE {0}_new (LIKE {0} INCLUDING DEFAULTS);"]
+table_swap_queries = ["ALTER TABLE {0} RENAME TO {0}_old;",
+                      "ALTER TABLE {0}_new RENAME TO {0};",
+                      "DROP TABLE {0}_old;"]
+
 
 # QUERY LISTS
 
-create_table_queries = [staging_events_table_create, staging_songs_table_create, songplay_table_create, user_table_create, song_table_create, artist_table_create, time_table_create]
-drop_table_queries = [staging_events_table_drop, staging_songs_table_drop, songplay_table_drop, user_table_drop, song_table_drop, artist_table_drop, time_table_drop]
+create_table_queries = [staging_events_table_create, staging_songs_table_create, songplay_table_create, user_table_create, song_table_create, artist_table_create, time_table_create, load_state_table_create, load_history_table_create]
+# staging and star schema tables only, a rebuild of the schema keeps the incremental load state
+drop_schema_queries = [staging_events_table_drop, staging_songs_table_drop, songplay_table_drop, user_table_drop, song_table_drop, artist_table_drop, time_table_drop]
+drop_table_queries = drop_schema_queries + [load_state_table_drop]
 copy_table_queries = [staging_events_copy, staging_songs_copy]
 insert_table_queries = [songplay_table_insert, user_table_insert, song_table_insert, artist_table_insert, time_table_insert]
+
+
+# QUERY GRAPH
+
+# table -> statement loading it
+copy_table_query_map = {'staging_events': staging_events_copy, 'staging_songs': staging_songs_copy}
+insert_table_query_map = {'songplays': songplay_table_insert, 'users': user_table_insert, 'songs': song_table_insert,
+                          'artists': artist_table_insert, 'time': time_table_insert}
+
+# table -> tables it is loaded from
+table_dependencies = {'songplays': ['staging_events', 'staging_songs'],
+                      'users': ['staging_events'],
+                      'time': ['staging_events'],
+                      'songs': ['staging_songs'],
+                      'artists': ['staging_songs']}
+
+# staging table -> COPY of the objects listed in a manifest, and statement emptying it
+manifest_copy_query_map = {'staging_events': staging_events_manifest_copy, 'staging_songs': staging_songs_manifest_copy}
+staging_clear_query_map = {'staging_events': staging_events_clear, 'staging_songs': staging_songs_clear}
+
+# staging table -> statements creating the raw staging table it is copied into,
+# statement inserting the raw staging table into it, and statement dropping the raw staging table
+staging_raw_create_query_map = {'staging_events': [staging_events_raw_table_drop, staging_events_raw_table_create],
+                                'staging_songs': [staging_songs_raw_table_drop, staging_songs_raw_table_create]}
+staging_insert_query_map = {'staging_events': staging_events_insert, 'staging_songs': staging_songs_insert}
+staging_raw_drop_query_map = {'staging_events': staging_events_raw_table_drop,
+                              'staging_songs': staging_songs_raw_table_drop}
+
+# table -> statements merging the staging tables into it, in the order they run
+upsert_table_query_map = {'artists': [artist_table_upsert_delete, artist_table_insert],
+                          'songs': [song_table_upsert_delete, song_table_insert],
+                          'users': [user_table_upsert_delete, user_table_insert],
+                          'time': [time_table_upsert_delete, time_table_insert],
+                          'songplays': [songplay_table_upsert_delete, songplay_table_incremental_insert]}
+
+# table -> statements merging the full staging tables into it, keyed on its primary key
+merge_table_query_map = {'songplays': [songplay_table_upsert_delete, songplay_table_insert],
+                         'users': [user_table_upsert_delete, user_table_insert],
+                         'songs': [song_table_upsert_delete, song_table_insert],
+                         'artists': [artist_table_upsert_delete, artist_table_insert],
+                         'time': [time_table_upsert_delete, time_table_insert]}
+
+# CONTROL TABLE
+
+load_state_select = "SELECT object_key FROM etl_loaded_objects WHERE staging_table = %s"
+load_state_insert = "INSERT INTO etl_loaded_objects (object_key, staging_table, size, last_modified) VALUES %s"
+
+# LOAD METRICS
+
+# rows, bytes, files and rejected rows of the last COPY of the session
+copy_metrics_select = ("""SELECT pg_last_copy_count(),
+                                 (SELECT COALESCE(SUM(bytes), 0) FROM stl_file_scan WHERE query = pg_last_copy_id()),
+                                 (SELECT COUNT(DISTINCT name) FROM stl_load_commits WHERE query = pg_last_copy_id()),
+                                 (SELECT COUNT(*) FROM stl_load_errors WHERE query = pg_last_copy_id());""")
+
+# rejected rows of the last COPY of the session that failed
+load_errors_select = ("""SELECT line_number, TRIM(colname), TRIM(err_reason)
+                         FROM stl_load_errors
+                         WHERE query = (SELECT MAX(query) FROM stl_load_errors WHERE session = pg_backend_pid())
+                         ORDER BY line_number;""")
+
+load_history_insert = ("INSERT INTO etl_load_history (run_id, table_name, statement, rows_loaded, bytes_scanned, "
+                       "files_loaded, elapsed_seconds, rejected_rows, errors) VALUES %s")
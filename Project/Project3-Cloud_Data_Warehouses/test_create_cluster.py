@@ -0,0 +1,123 @@
+import os
+import pytest
+
+# moto only knows the AWS managed policies, such as AmazonS3ReadOnlyAccess, when
+# it loads them, which it does when this variable is set before it is imported
+os.environ.setdefault('MOTO_IAM_LOAD_MANAGED_POLICIES', 'true')
+moto = pytest.importorskip('moto')
+
+import dwh_config
+import create_cluster
+from create_cluster import create_client_resource, create_redshift_cluster, poll_cluster_available, provision
+
+
+CONFIG = """[CLUSTER]
+HOST=
+DB_NAME=dev
+DB_USER=awsuser
+DB_PASSWORD=Passw0rd
+DB_PORT=5439
+
+DB_CLUSTER_TYPE=multi-node
+DB_NUM_NODES=2
+DB_NODE_TYPE=dc2.large
+
+DB_REGION=us-west-2
+DB_IAM_ROLE_NAME=dwhRole
+DB_CLUSTER_IDENTIFIER=sparkify-test
+
+[IAM_ROLE]
+ARN=
+
+[AWS]
+KEY=testing
+SECRET=testing
+"""
+
+
+@pytest.fixture
+def clients(tmp_path, monkeypatch):
+    """
+        Description: Writes a dwh.cfg into a temporary working directory and returns
+            the EC2, IAM and Redshift clients of a mocked AWS backend.
+    """
+    (tmp_path / 'dwh.cfg').write_text(CONFIG)
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(dwh_config, '_configs', {})
+    with moto.mock_aws():
+        yield (create_client_resource('ec2', 'resource'), create_client_resource('iam', 'client'),
+               create_client_resource('redshift', 'client'))
+
+
+def with_statuses(monkeypatch, statuses):
+    """
+        Description: Makes `describe_cluster` report each of `statuses` in turn, then
+            the status of the mocked cluster.
+    """
+    describe_cluster = create_cluster.describe_cluster
+    statuses = iter(statuses)
+
+    def describe(redshift_client):
+        cluster = describe_cluster(redshift_client)
+        return dict(cluster, ClusterStatus=next(statuses, cluster['ClusterStatus']))
+
+    monkeypatch.setattr(create_cluster, 'describe_cluster', describe)
+
+
+def test_provision_reuses_existing_resources(clients):
+    ec2, iam, redshift = clients
+    progress = []
+
+    first = provision(ec2, iam, redshift, progress=lambda *step: progress.append(step))
+    second = provision(ec2, iam, redshift, progress=lambda *step: progress.append(step))
+
+    assert first['ClusterIdentifier'] == second['ClusterIdentifier'] == 'sparkify-test'
+    assert len(redshift.describe_clusters()['Clusters']) == 1
+    assert [role['RoleName'] for role in iam.list_roles()['Roles']] == ['dwhRole']
+    assert [policy['PolicyName'] for policy in iam.list_attached_role_policies(RoleName='dwhRole')['AttachedPolicies']] \
+        == ['AmazonS3ReadOnlyAccess']
+
+    group = ec2.SecurityGroup(second['VpcSecurityGroups'][0]['VpcSecurityGroupId'])
+    assert [(rule['FromPort'], rule['IpRanges']) for rule in group.ip_permissions if rule.get('FromPort') == 5439] \
+        == [(5439, [{'CidrIp': '0.0.0.0/0'}])]
+
+    # each run reports its three steps
+    assert sorted(step for step, status, elapsed in progress) == ['cluster', 'cluster', 'iam', 'iam', 'network', 'network']
+    assert all(status in ('ready', 'available') for step, status, elapsed in progress)
+
+    config = dwh_config.read_config()
+    assert config.get('CLUSTER', 'HOST') == second['Endpoint']['Address']
+    assert config.get('IAM_ROLE', 'ARN') == iam.get_role(RoleName='dwhRole')['Role']['Arn']
+    with open('dwh.cfg') as f:
+        assert 'HOST={}'.format(second['Endpoint']['Address']) in f.read()
+
+
+def test_poll_backs_off_until_available(clients, monkeypatch):
+    ec2, iam, redshift = clients
+    iam.create_role(RoleName='dwhRole', AssumeRolePolicyDocument='{}')
+    create_redshift_cluster(iam, redshift)
+    with_statuses(monkeypatch, ['creating'] * 5)
+    sleeps, progress = [], []
+
+    cluster = poll_cluster_available(redshift, progress=lambda *step: progress.append(step), max_delay=40,
+                                     sleep=sleeps.append)
+
+    assert cluster['ClusterStatus'] == 'available'
+    assert sleeps == [5, 10, 20, 40, 40]
+    assert [status for step, status, elapsed in progress] == ['creating'] * 5 + ['available']
+    # the seconds slept are reported, although nothing really slept
+    assert [elapsed for step, status, elapsed in progress][1:] == pytest.approx([5, 15, 35, 75, 115], abs=1)
+
+
+def test_poll_times_out(clients, monkeypatch):
+    ec2, iam, redshift = clients
+    iam.create_role(RoleName='dwhRole', AssumeRolePolicyDocument='{}')
+    create_redshift_cluster(iam, redshift)
+    with_statuses(monkeypatch, ['creating'] * 100)
+    sleeps = []
+
+    with pytest.raises(TimeoutError, match='sparkify-test'):
+        poll_cluster_available(redshift, timeout=30, sleep=sleeps.append)
+
+    # the next poll, 15s + 20s, would be past the timeout
+    assert sleeps == [5, 10]
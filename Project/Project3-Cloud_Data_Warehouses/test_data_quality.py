@@ -0,0 +1,127 @@
+import time
+import psycopg2
+import pytest
+from local_warehouse import LocalWarehouse
+from db import ConnectionPool
+from data_quality import run_checks, DataQualityError
+
+
+# the checks run on tables of their own schema of the local stand-in, next to the warehouse
+SCHEMA = 'data_quality_test'
+
+FRESHNESS = {'name': 'songplays_freshness', 'kind': 'freshness', 'table': SCHEMA + '.songplays', 'column': 'start_time',
+             'source': SCHEMA + ".staging_events WHERE page = 'NextSong'", 'source_column': 'ts'}
+
+
+@pytest.fixture
+def warehouse():
+    """
+        Description: Creates empty songplays and staging_events tables in SCHEMA on
+            the local stand-in, plus a users table, skipping the test when it is
+            not running.
+    """
+    warehouse = LocalWarehouse()
+    try:
+        conn = warehouse.connect()
+    except psycopg2.OperationalError as error:
+        pytest.skip('local stand-in not available: {}'.format(error))
+    conn.set_session(autocommit=True)
+    cur = conn.cursor()
+    cur.execute("DROP SCHEMA IF EXISTS {0} CASCADE; CREATE SCHEMA {0};".format(SCHEMA))
+    cur.execute("CREATE TABLE {}.songplays (songplay_id INT, start_time TIMESTAMP, user_id INT);".format(SCHEMA))
+    cur.execute("CREATE TABLE {}.staging_events (ts TIMESTAMP, page VARCHAR);".format(SCHEMA))
+    cur.execute("CREATE TABLE {}.users (user_id INT);".format(SCHEMA))
+    try:
+        yield warehouse, cur
+    finally:
+        cur.execute("DROP SCHEMA {} CASCADE;".format(SCHEMA))
+        conn.close()
+
+
+@pytest.fixture
+def pool(warehouse):
+    pool = ConnectionPool(warehouse[0].dsn, maxconn=4)
+    yield pool
+    pool.closeall()
+
+
+def test_freshness_passes_on_empty_staging(warehouse, pool):
+    local, cur = warehouse
+    # an incremental run without new objects empties the staging tables
+    cur.execute("INSERT INTO {}.songplays VALUES (1, '2018-11-30 12:00', 1);".format(SCHEMA))
+
+    results = run_checks(pool, [FRESHNESS], warehouse=local)
+
+    assert [(result['name'], result['value'], result['passed']) for result in results] \
+        == [('songplays_freshness', 0, True)]
+
+
+def sleep_check(name, seconds):
+    """
+        Description: Row count check of a one-row subquery taking `seconds` to run.
+    """
+    return {'name': name, 'kind': 'row_count', 'table': '(SELECT pg_sleep({})) s'.format(seconds), 'min_rows': 1}
+
+
+def test_failed_checks_are_reported_per_check(warehouse, pool):
+    local, cur = warehouse
+    cur.execute("INSERT INTO {0}.users VALUES (1); "
+                "INSERT INTO {0}.songplays VALUES (1, '2018-11-01', 1), (1, '2018-11-02', 2), (2, '2018-11-03', NULL); "
+                "INSERT INTO {0}.staging_events VALUES ('2018-11-30', 'NextSong'), ('2018-12-01', 'Home');"
+                .format(SCHEMA))
+    checks = [
+        {'name': 'songplays_rows', 'kind': 'row_count', 'table': SCHEMA + '.songplays', 'min_rows': 1},
+        {'name': 'users_rows', 'kind': 'row_count', 'table': SCHEMA + '.users', 'min_rows': 2},
+        {'name': 'songplays_null_keys', 'kind': 'null_keys', 'table': SCHEMA + '.songplays',
+         'columns': ['start_time', 'user_id']},
+        {'name': 'songplays_orphan_users', 'kind': 'orphans', 'table': SCHEMA + '.songplays', 'column': 'user_id',
+         'ref_table': SCHEMA + '.users', 'ref_column': 'user_id'},
+        {'name': 'songplays_duplicates', 'kind': 'duplicates', 'table': SCHEMA + '.songplays',
+         'columns': ['songplay_id']},
+        FRESHNESS,
+    ]
+
+    with pytest.raises(DataQualityError) as error:
+        run_checks(pool, checks, warehouse=local, fail_fast=False)
+
+    assert [(result['name'], result['value'], result['passed']) for result in error.value.results] == [
+        ('songplays_rows', 3, True),
+        ('users_rows', 1, False),
+        ('songplays_null_keys', 1, False),
+        ('songplays_orphan_users', 1, False),
+        ('songplays_duplicates', 1, False),
+        ('songplays_freshness', 1, False),
+    ]
+    assert str(error.value) == ('data quality checks failed: users_rows, songplays_null_keys, '
+                                'songplays_orphan_users, songplays_duplicates, songplays_freshness')
+
+
+def test_fail_fast_cancels_pending_checks(warehouse, pool):
+    local, cur = warehouse
+    checks = [{'name': 'songplays_rows', 'kind': 'row_count', 'table': SCHEMA + '.songplays', 'min_rows': 1}]
+    checks += [sleep_check('sleep_{}'.format(i), 0.05) for i in range(10)]
+
+    with pytest.raises(DataQualityError) as error:
+        run_checks(pool, checks, workers=1, warehouse=local)
+
+    names = [result['name'] for result in error.value.results]
+    assert names[0] == 'songplays_rows'
+    # the single worker may have started the next check before the others were cancelled
+    assert len(names) <= 2
+
+
+def test_checks_are_timed_and_run_concurrently(warehouse, pool, capsys):
+    local, cur = warehouse
+    checks = [sleep_check('sleep_{}'.format(i), 0.3) for i in range(4)]
+
+    start = time.perf_counter()
+    results = run_checks(pool, checks, workers=4, warehouse=local)
+    elapsed = time.perf_counter() - start
+
+    assert [result['name'] for result in results] == ['sleep_0', 'sleep_1', 'sleep_2', 'sleep_3']
+    assert all(result['passed'] and 0.3 <= result['seconds'] < 1.2 for result in results)
+    assert elapsed < 1.2
+
+    lines = capsys.readouterr().out.splitlines()
+    assert sorted(line.split()[:3] for line in lines) == [[result['name'], 'ok', '1'] for result in results]
+    assert all(line.endswith('s') and float(line.split()[3][:-1]) >= 0.3 for line in lines)